@@ -0,0 +1,316 @@
+"""
+Benchmarks each stage of DataProcessor.process_data on synthetic data (see synthetic_data.py)
+and saves timings and peak memory as JSON so that performance regressions can be caught
+between versions, e.g.
+
+    python benchmark.py --scale district --output bench_new.json --baseline bench_old.json
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import geopandas as gpd
+
+import csv_reader as cr
+import ea_index as eai
+import metrics as mt
+import synthetic_data as sd
+import utils as ut
+from data_processor import DataProcessor, prepare_processing_parameters
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# stage, DataProcessor method, in the same order as DataProcessor.process_data
+STAGES = ["process_raw_listing", "find_wards_to_process", "create_ward_layers",
+          "append_building_attributes_to_ward_level_ea_shp", "update_rollup_store", "record_wards_processed"]
+
+# metrics compared between runs and relative increase flagged as regression
+COMPARED_METRICS = ["wall_seconds", "peak_traced_mb", "peak_rss_mb"]
+
+
+def max_rss_mb():
+    """
+    Returns peak resident memory of this process and of its finished child processes
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1024 ** 2 if sys.platform == "darwin" else 1024
+    rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+
+    return max(rss_self, rss_children)
+
+
+def measure(func, *args, trace_memory=True, **kwargs):
+    """
+    Runs func and measures wall time, CPU time and memory
+    :param trace_memory: measure peak memory allocated by Python (numpy and pandas
+     included) while func runs, this slows func down
+    :return: (value returned by func, dict of metrics), peak_rss_mb is the peak resident
+     memory while func runs, ward timers within func included (Linux only, see metrics.StageTimer)
+    """
+    if trace_memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+    timer = mt.StageTimer()
+    try:
+        value = func(*args, **kwargs)
+    finally:
+        stage = timer.stop()
+    metrics = {"wall_seconds": stage["wall_seconds"], "cpu_seconds": stage["cpu_seconds"],
+               "peak_traced_mb": None, "peak_rss_mb": stage["peak_rss_mb"], "max_rss_mb": max_rss_mb()}
+    if trace_memory:
+        metrics["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+
+    return value, metrics
+
+
+def raw_listing_input_mb(dp):
+    """
+    Returns memory the columns of the raw listing used by process_raw_listing take once read
+    (MB), estimated from its first rows (see csv_reader.row_memory) and the number of rows
+    """
+    row_bytes = cr.row_memory(dp.raw_csv_filename, usecols=dp.columns_to_load(),
+                              dtypes=ut.read_dtypes(dp.params['schema']))
+    with open(dp.raw_csv_filename, "rb") as f:
+        rows = sum(1 for _ in f) - 1
+
+    return row_bytes * rows / 1024 ** 2
+
+
+def benchmark_district(dp, trace_memory=True):
+    """
+    Runs the stages of process_data one at a time for a district, process_raw_listing
+    also gets the memory its input takes (input_mb) and its peak resident memory
+    above the memory held before it ran in proportion to it (peak_rss_over_input)
+    :param dp: DataProcessor
+    :return: list of dicts with stage metrics
+    """
+    records = []
+    ward_dirs, manifest = None, None
+    results = []
+    results_ea = []
+    for stage in STAGES:
+        if stage == "process_raw_listing":
+            input_mb = raw_listing_input_mb(dp)
+            mt.reset_peak_rss()
+            rss_before = mt.peak_rss_mb()
+            _, m = measure(dp.process_raw_listing, trace_memory=trace_memory)
+            m["input_mb"] = input_mb
+            if m["peak_rss_mb"] is not None and rss_before is not None and input_mb:
+                m["peak_rss_over_input"] = (m["peak_rss_mb"] - rss_before) / input_mb
+        elif stage == "find_wards_to_process":
+            (ward_dirs, manifest), m = measure(dp.find_wards_to_process, trace_memory=trace_memory)
+        elif stage == "create_ward_layers":
+            value, m = measure(dp.create_ward_layers, ward_dirs, trace_memory=trace_memory)
+            results += value
+        elif stage == "append_building_attributes_to_ward_level_ea_shp":
+            results_ea, m = measure(dp.append_building_attributes_to_ward_level_ea_shp, ward_dirs,
+                                    trace_memory=trace_memory)
+            results += results_ea
+        elif stage == "update_rollup_store":
+            if not dp.params['rollup_store']:
+                continue
+            _, m = measure(dp.update_rollup_store, results_ea, trace_memory=trace_memory)
+        else:
+            _, m = measure(dp.record_wards_processed, manifest, ward_dirs, results, trace_memory=trace_memory)
+        records.append({"province": dp.province, "district": dp.district, "stage": stage, **m})
+
+    return records
+
+
+def benchmark_ea_lookup(n_eas=2000, n_points=2000000, resolutions=(0.0002, 0.0001, 0.00005), seed=0):
+    """
+    Times point to EA assignment with the geopandas spatial index (as a "within" sjoin),
+    EAIndex and EARaster at several resolutions on irregular synthetic EAs and checks
+    that they all assign the same points to the same EAs
+    :param n_eas: number of EAs in a district sized extent
+    :param n_points: number of points assigned
+    :param resolutions: EARaster cell sizes in degrees
+    :return: list of dicts with method, resolution, build and query seconds and share of boundary cells
+    """
+    rng = np.random.default_rng(seed)
+    extent = (sd.ORIGIN[0], sd.ORIGIN[1] - 0.25, sd.ORIGIN[0] + 0.25, sd.ORIGIN[1])
+    ea = sd.generate_irregular_eas(rng, extent, n_eas)
+    x = rng.uniform(extent[0], extent[2], n_points)
+    y = rng.uniform(extent[1], extent[3], n_points)
+
+    records = []
+    start = time.perf_counter()
+    expected = ea.sindex.query(gpd.points_from_xy(x, y), predicate="within")
+    records.append({"method": "sindex", "resolution": None, "build_seconds": None,
+                    "query_seconds": time.perf_counter() - start, "boundary_share": None})
+    order = np.lexsort((expected[1], expected[0]))
+    expected = expected[0][order], expected[1][order]
+
+    start = time.perf_counter()
+    index = eai.EAIndex.build(ea, layer_hash=None)
+    build_seconds = time.perf_counter() - start
+    lookups = [("ea_index", None, index, build_seconds)]
+    for resolution in resolutions:
+        start = time.perf_counter()
+        raster = eai.EARaster.build(index, resolution)
+        lookups.append(("ea_raster", resolution, raster, time.perf_counter() - start))
+
+    for method, resolution, lookup, build_seconds in lookups:
+        start = time.perf_counter()
+        pts_idx, ea_idx = lookup.query_points(x, y)
+        query_seconds = time.perf_counter() - start
+        if not (np.array_equal(pts_idx, expected[0]) and np.array_equal(ea_idx, expected[1])):
+            raise AssertionError("{} (resolution {}) doesn't match the exact join".format(method, resolution))
+        records.append({"method": method, "resolution": resolution, "build_seconds": build_seconds,
+                        "query_seconds": query_seconds,
+                        "boundary_share": lookup.boundary_share() if method == "ea_raster" else None})
+
+    return records
+
+
+def git_commit():
+    """
+    Returns commit of the code being benchmarked if available
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(scale, work_dir, output_file, params=None, seed=0, trace_memory=True):
+    """
+    Generates synthetic data, runs the benchmark and saves results as JSON
+    :param scale: see synthetic_data.SCALES
+    :param work_dir: directory for synthetic data and outputs
+    :param output_file: JSON file to save results to
+    :param params: processing parameters, defaults to prepare_processing_parameters
+    :return: results dict
+    """
+    params = params or prepare_processing_parameters()
+    work_dir = Path(work_dir)
+    districts = sd.generate(scale, work_dir, seed=seed)
+
+    records = []
+    for d in districts:
+        dp = DataProcessor(raw_csv_dir=d["csv_file"].parent, csv_filename=d["csv_file"],
+                           ea_demarcation_dir=work_dir.joinpath("DEMARCATION_DATA"), province=d["province"],
+                           district=d["district"], params=params)
+        records += benchmark_district(dp, trace_memory=trace_memory)
+
+    totals = {}
+    for r in records:
+        t = totals.setdefault(r["stage"], {"wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_traced_mb": None,
+                                           "peak_rss_mb": None})
+        t["wall_seconds"] += r["wall_seconds"]
+        t["cpu_seconds"] += r["cpu_seconds"]
+        for metric in ["peak_traced_mb", "peak_rss_mb", "peak_rss_over_input"]:
+            if r.get(metric) is not None:
+                t[metric] = max(t.get(metric) or 0, r[metric])
+
+    results = {"created": datetime.datetime.now().isoformat(timespec="seconds"), "git_commit": git_commit(),
+               "python": platform.python_version(), "platform": platform.platform(), "scale": scale,
+               "seed": seed, "params": {k: params[k] for k in ["chunk_size", "storage_format", "ward_workers",
+                                                               "incremental", "ea_index_cache",
+                                                               "memory_budget_mb"]},
+               "max_rss_mb": max_rss_mb(), "stages": totals, "records": records}
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=2, default=str)
+
+    return results
+
+
+def compare_results(baseline, current, tolerance=0.2):
+    """
+    Compares two benchmark results per stage
+    :param baseline, current: results dicts (see run_benchmark)
+    :param tolerance: relative increase of a metric considered a regression
+    :return: list of regressions (dicts with stage, metric, baseline and current value)
+    """
+    regressions = []
+    for stage, metrics in current["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if metrics.get(metric) is None or not base.get(metric):
+                continue
+            if metrics[metric] > base[metric] * (1 + tolerance):
+                regressions.append({"stage": stage, "metric": metric, "baseline": base[metric],
+                                    "current": metrics[metric]})
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", default="district", choices=list(sd.SCALES))
+    parser.add_argument("--work-dir", default="benchmark_data")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="results JSON of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage-format", default=None)
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--ward-workers", type=int, default=None)
+    parser.add_argument("--memory-budget-mb", type=int, default=None,
+                        help="memory budget of process_raw_listing (see DataProcessor.raw_listing_chunk_size)")
+    parser.add_argument("--no-trace-memory", action="store_true")
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip wards unchanged since a previous run in the same work dir")
+    parser.add_argument("--ea-lookup", action="store_true",
+                        help="only benchmark point to EA assignment methods (see benchmark_ea_lookup)")
+    args = parser.parse_args()
+
+    if args.ea_lookup:
+        records = benchmark_ea_lookup(seed=args.seed)
+        with open(args.output, "w") as f:
+            json.dump({"created": datetime.datetime.now().isoformat(timespec="seconds"),
+                       "git_commit": git_commit(), "ea_lookup": records}, f, indent=2)
+        for r in records:
+            print("{:<10} {:>10} build {:>8} query {:>8.2f}s".format(
+                r["method"], r["resolution"] or "", "" if r["build_seconds"] is None
+                else "{:.2f}s".format(r["build_seconds"]), r["query_seconds"]))
+        return
+
+    params = prepare_processing_parameters()
+    params["incremental"] = args.incremental
+    if args.storage_format:
+        params["storage_format"] = args.storage_format
+    if args.chunk_size:
+        params["chunk_size"] = args.chunk_size
+    if args.ward_workers:
+        params["ward_workers"] = args.ward_workers
+    if args.memory_budget_mb:
+        params["memory_budget_mb"] = args.memory_budget_mb
+
+    results = run_benchmark(args.scale, args.work_dir, args.output, params=params, seed=args.seed,
+                            trace_memory=not args.no_trace_memory)
+    for stage, m in results["stages"].items():
+        print("{:<50} {:>10.2f}s {:>10} {:>10} {:>8}".format(
+            stage, m["wall_seconds"], "" if m["peak_traced_mb"] is None else "{:.1f}MB".format(m["peak_traced_mb"]),
+            "" if m["peak_rss_mb"] is None else "{:.1f}MB".format(m["peak_rss_mb"]),
+            "" if m.get("peak_rss_over_input") is None else "{:.2f}x".format(m["peak_rss_over_input"])))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_results(json.load(f), results, tolerance=args.tolerance)
+        for r in regressions:
+            print("REGRESSION {stage} {metric}: {baseline:.2f} -> {current:.2f}".format(**r))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
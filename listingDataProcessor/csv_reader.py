@@ -0,0 +1,339 @@
+"""
+Single pass reader for raw listing CSV exports: text is decoded as UTF-8 and bytes which
+aren't valid UTF-8 as Latin-1 while the file is parsed (see Utf8OrLatin1), quoted values
+(with commas or line breaks) are parsed properly, and malformed rows (wrong number of fields) are saved with
+their line number to a quarantine CSV file rather than failing the read or being dropped
+silently. Parsing is done by pyarrow's CSV reader, column types are inferred as
+pandas.read_csv would
+"""
+import codecs
+import csv
+import io
+import os
+import threading
+
+import pandas as pd
+
+import metrics as mt
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pcsv
+except ImportError:
+    # the reader needs pyarrow, see iter_csv
+    pa = None
+
+# bytes parsed at a time, blocks are parsed ahead of the chunk being read so
+# larger blocks hold more memory without reading faster
+BLOCK_SIZE = 1 << 20
+
+# decodes any bytes, used when a file isn't valid UTF-8 (e.g., exports saved from Excel)
+FALLBACK_ENCODING = "latin1"
+
+QUARANTINE_COLUMNS = ["line", "expected_fields", "actual_fields", "text"]
+
+
+def decode_as_latin1(error):
+    """
+    Decoding error handler which decodes bytes that aren't valid UTF-8 as FALLBACK_ENCODING
+    """
+    return error.object[error.start:error.end].decode(FALLBACK_ENCODING), error.end
+
+
+codecs.register_error("latin1_fallback", decode_as_latin1)
+
+
+class Utf8OrLatin1(io.RawIOBase):
+    """
+    Binary file which returns a file's bytes as UTF-8: valid UTF-8 is returned as it is and
+    bytes which aren't (e.g., accents in exports saved from Excel) are decoded as
+    FALLBACK_ENCODING, anywhere in the file. The file is only read once, unlike checking
+    the whole file before parsing it or restarting the read once an invalid byte is found
+    """
+
+    def __init__(self, file):
+        """
+        :param file: file opened in binary mode
+        """
+        super().__init__()
+        self.file = file
+        # bytes of a character split between two reads
+        self.pending = b""
+        # bytes converted and position of those not returned yet, a read can't return more than asked for
+        self.converted = b""
+        self.start = 0
+        self.fallback_used = False
+
+    def readable(self):
+        return True
+
+    def convert(self, data):
+        """
+        Returns bytes read after the pending ones as UTF-8, no bytes read means the end of the file
+        """
+        final = not data
+        data = self.pending + data
+        try:
+            _, consumed = codecs.utf_8_decode(data, "strict", final)
+            converted = data[:consumed]
+        except UnicodeDecodeError:
+            text, consumed = codecs.utf_8_decode(data, "latin1_fallback", final)
+            converted = text.encode("utf-8")
+            self.fallback_used = True
+        self.pending = data[consumed:]
+
+        return converted
+
+    def read(self, size=-1):
+        while self.start == len(self.converted):
+            data = self.file.read(size)
+            # ASCII, which most exports are, is returned as it is read without being decoded or copied
+            if not self.pending and data.isascii():
+                return data
+            self.converted, self.start = self.convert(data), 0
+            if not data and not self.converted:
+                return b""
+        end = len(self.converted) if size is None or size < 0 else self.start + size
+        data = self.converted[self.start:end]
+        self.start += len(data)
+
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def read_header(file, encoding=None):
+    """
+    Returns column names in the first row of a CSV file
+    :param encoding: encoding of the file, None decodes it as Utf8OrLatin1 does
+    """
+    with open(file, "rb") as f:
+        text = io.TextIOWrapper(f, encoding=encoding or "utf-8", newline="",
+                                errors="strict" if encoding else "latin1_fallback")
+        header = next(csv.reader(text), [])
+
+    # a byte order mark is skipped by the parser too
+    if header and header[0].startswith("\ufeff"):
+        header[0] = header[0][1:]
+
+    return header
+
+
+class Quarantine:
+    """
+    Saves malformed rows to a CSV file with their line number, fields expected and found,
+    and the row text. Used as pyarrow's invalid row handler, the file is only created
+    if there is a malformed row
+    """
+
+    def __init__(self, quarantine_file=None):
+        """
+        :param quarantine_file: CSV file to save malformed rows to, None only counts them
+        """
+        self.quarantine_file = quarantine_file
+        self.count = 0
+        self.file = None
+        self.writer = None
+        self.lock = threading.Lock()
+        # rows quarantined by an earlier read would be mistaken for rows of this one
+        if quarantine_file is not None and os.path.exists(quarantine_file):
+            os.remove(quarantine_file)
+
+    def __call__(self, row):
+        with self.lock:
+            self.count += 1
+            if self.quarantine_file is not None:
+                if self.writer is None:
+                    self.file = open(self.quarantine_file, "w", newline="", encoding="utf-8")
+                    self.writer = csv.writer(self.file)
+                    self.writer.writerow(QUARANTINE_COLUMNS)
+                self.writer.writerow([row.number, row.expected_columns, row.actual_columns, row.text])
+
+        return "skip"
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def arrow_column_types(columns, dtypes):
+    """
+    Returns pyarrow types the columns are parsed as: categoricals are dictionary encoded and
+    all other columns are parsed as text so that a value which isn't a number (e.g., #NULL!)
+    in one block doesn't fail the read, numbers are inferred once a chunk is read (see infer_numbers)
+    """
+    dtypes = dtypes or {}
+    types = {}
+    for c in columns:
+        if c in dtypes and isinstance(pd.api.types.pandas_dtype(dtypes[c]), pd.CategoricalDtype):
+            types[c] = pa.dictionary(pa.int32(), pa.string())
+        else:
+            types[c] = pa.string()
+
+    return types
+
+
+def infer_numbers(table, declared):
+    """
+    Converts text columns which only hold numbers (or missing values) to int64, or float64
+    if any value is missing or fractional, as pandas.read_csv does
+    :param table: pyarrow table with text columns
+    :param declared: columns whose dtype was declared, they are left as they are
+    :return: pyarrow table
+    """
+    for i, name in enumerate(table.column_names):
+        column = table.column(i)
+        if name in declared or not pa.types.is_string(column.type):
+            continue
+        converted = None
+        for number_type in [pa.int64(), pa.float64()]:
+            try:
+                converted = column.cast(number_type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                continue
+            if converted.null_count and number_type == pa.int64():
+                converted = column.cast(pa.float64())
+            break
+        if converted is not None:
+            table = table.set_column(i, name, converted)
+
+    return table
+
+
+def to_frame(batches, schema, declared, start=0):
+    """
+    Converts record batches read to a data frame (see infer_numbers), categories are
+    sorted as pandas.read_csv sorts them. Each column is its own block so that a column
+    removed from the data frame is freed (see utils.separate_rows)
+    :param batches: list of record batches, emptied so that each column's Arrow memory is freed
+     once it is converted
+    :param start: index of the first row, rows of a file read in chunks are numbered across chunks
+    """
+    table = pa.Table.from_batches(batches, schema=schema)
+    batches.clear()
+    table = infer_numbers(table, declared)
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    df.index = pd.RangeIndex(start, start + len(df))
+    for c in df.columns:
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].cat.set_categories(sorted(df[c].cat.categories))
+
+    return df
+
+
+def iter_csv(file, usecols=None, dtypes=None, chunksize=None, quarantine_file=None, stats=None, encoding=None):
+    """
+    Reads a CSV file in a single pass
+    :param file: CSV file
+    :param usecols: columns to load, those missing from the file are ignored, None loads all columns
+    :param dtypes: dict of column name to dtype for text and categorical columns (see utils.read_dtypes),
+     other columns are numbers if all their values are and text otherwise
+    :param chunksize: number of rows in each data frame, None reads the whole file into one
+    :param quarantine_file: CSV file to save malformed rows to (see Quarantine), line numbers
+     count a quoted value spanning several lines as one line
+    :param stats: dict to add the number of malformed rows ("bad_lines") to
+    :param encoding: encoding of the file, None decodes UTF-8 and Latin-1 (see Utf8OrLatin1)
+    :return: iterator of data frames, at least one even if the file has no rows, rows are
+     numbered from 0 across data frames
+    """
+    if pa is None:
+        raise ImportError("pyarrow is needed to read CSV files")
+
+    header = read_header(file, encoding)
+    wanted = set(usecols) if usecols else None
+    columns = [c for c in header if wanted is None or c in wanted]
+    declared = set(dtypes or {})
+
+    quarantine = Quarantine(quarantine_file)
+    read_options = pcsv.ReadOptions(block_size=BLOCK_SIZE,
+                                    encoding="utf8" if encoding in [None, "utf-8"] else encoding)
+    parse_options = pcsv.ParseOptions(newlines_in_values=True, invalid_row_handler=quarantine)
+    convert_options = pcsv.ConvertOptions(include_columns=columns,
+                                          column_types=arrow_column_types(columns, dtypes),
+                                          strings_can_be_null=True)
+    source = file if encoding else Utf8OrLatin1(open(file, "rb"))
+    try:
+        reader = pcsv.open_csv(source, read_options=read_options, parse_options=parse_options,
+                               convert_options=convert_options)
+        batches, rows, start = [], 0, 0
+        for batch in reader:
+            batches.append(batch)
+            rows += batch.num_rows
+            while chunksize and rows >= chunksize:
+                chunk, batches = split_batches(batches, chunksize)
+                rows -= chunksize
+                yield to_frame(chunk, reader.schema, declared, start)
+                start += chunksize
+                # memory the allocator kept from the previous chunk is given back before the next is parsed
+                pa.default_memory_pool().release_unused()
+        if rows or not start:
+            yield to_frame(batches, reader.schema, declared, start)
+    finally:
+        if source is not file:
+            source.close()
+        quarantine.close()
+        mt.add_counts(stats, bad_lines=quarantine.count)
+        if quarantine.count:
+            print("{} malformed rows in {} skipped{}".format(
+                quarantine.count, file, ", see {}".format(quarantine_file) if quarantine_file else ""))
+
+
+def row_memory(file, usecols=None, dtypes=None, sample_rows=10000):
+    """
+    Returns memory held by a row once read (bytes), estimated from the first rows of a CSV file
+    :param sample_rows: number of rows read
+    """
+    reader = iter_csv(file, usecols=usecols, dtypes=dtypes, chunksize=sample_rows)
+    try:
+        df = next(reader)
+    finally:
+        reader.close()
+    if df.empty:
+        return 0
+
+    return df.memory_usage(deep=True).sum() / len(df)
+
+
+def estimate_rows(file, sample_lines=10000):
+    """
+    Returns number of rows of a CSV file estimated from the length of its first lines, a quoted
+    value spanning several lines makes it an overestimate
+    :param sample_lines: number of lines read
+    """
+    size = os.path.getsize(file)
+    with open(file, "rb") as f:
+        sample = [len(line) for _, line in zip(range(sample_lines + 1), f)]
+    if len(sample) <= sample_lines:
+        return max(len(sample) - 1, 0)
+
+    # the header line isn't a row
+    return int(size / (sum(sample[1:]) / sample_lines))
+
+
+def split_batches(batches, n):
+    """
+    Splits record batches into the first n rows and the rest
+    :return: two lists of record batches
+    """
+    chunk, rest, taken = [], [], 0
+    for batch in batches:
+        if taken >= n:
+            rest.append(batch)
+            continue
+        take = min(n - taken, batch.num_rows)
+        chunk.append(batch.slice(0, take))
+        if take < batch.num_rows:
+            rest.append(batch.slice(take))
+        taken += take
+
+    return chunk, rest
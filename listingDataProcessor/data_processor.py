@@ -2,8 +2,29 @@
 This module calls functions from utils to run data processing functions
 """
 from pathlib import Path
+from contextlib import nullcontext
 import os
+import pandas as pd
 import utils as ut
+import storage as st
+import parallel as pl
+import ea_index as eai
+import manifest as mf
+import metrics as mt
+import rollup as rl
+import exchange as ex
+import journal as jr
+import writer as wr
+import csv_reader as cr
+
+# peak memory of the raw listing stage for each row of a chunk relative to the raw columns it holds
+# once read (measured about 2.6 on a synthetic district): the text of a chunk is parsed before numbers
+# are converted (see csv_reader.infer_numbers) and its DFs and POIs are copied out of it
+RAW_LISTING_PEAK_FACTOR = 3
+
+# memory (MB) the raw listing stage holds whatever the chunk size: blocks parsed ahead
+# by the CSV reader, memory kept by allocators and ward file writers
+RAW_LISTING_BASE_MB = 80
 
 
 class DataProcessor:
@@ -26,7 +47,17 @@ class DataProcessor:
         self.province = province
         self.district = district
         self.dir_with_ward_subdirs = None
+        if district:
+            self.dir_with_ward_subdirs = ea_demarcation_dir.joinpath(province, district)
         self.params = params
+        # profiles are saved next to the ward directories, not in a subdirectory which would be taken for a ward
+        profile_file_prefix = None
+        if district:
+            profile_file_prefix = self.dir_with_ward_subdirs.joinpath("{}_District_profile".format(district))
+        self.report = mt.RunReport(profile_stages=params['profile_stages'], profile_file_prefix=profile_file_prefix)
+        self.journal = None
+        if district and params['run_journal']:
+            self.journal = jr.RunJournal(self.dir_with_ward_subdirs)
 
     def create_ouput_files_raw_csv_processing(self):
         """
@@ -42,6 +73,39 @@ class DataProcessor:
 
             return {"output_dwellings": output_dwellings, "output_pois": output_poi}
 
+    def near_duplicates_report_files(self):
+        """
+        Returns CSV files listing DF and POI points dropped as near duplicates
+        :return:
+        """
+        dist_dir = self.ea_demarcation_dir.joinpath(self.province, self.district)
+        return {suffix: dist_dir.joinpath("{}_District_near_duplicates_{}.csv".format(self.district, suffix))
+                for suffix in ["df", "poi"]}
+
+    def bad_lines_file(self):
+        """
+        Returns CSV file listing malformed rows of the raw CSV file (see csv_reader.Quarantine)
+        :return:
+        """
+        dist_dir = self.ea_demarcation_dir.joinpath(self.province, self.district)
+        return dist_dir.joinpath("{}_District_bad_lines.csv".format(self.district))
+
+    def run_report_files(self):
+        """
+        Returns JSON and CSV run report files (see metrics.RunReport)
+        :return:
+        """
+        dist_dir = self.ea_demarcation_dir.joinpath(self.province, self.district)
+        return {ext: dist_dir.joinpath("{}_District_run_report.{}".format(self.district, ext))
+                for ext in ["json", "csv"]}
+
+    def rollup_store_dir(self):
+        """
+        Returns directory of the national roll-up store (see rollup.py)
+        :return:
+        """
+        return self.ea_demarcation_dir.joinpath("national_rollup")
+
     def prepare_io_files_for_ea_level_structures_summary(self, ward_name):
         prov = self.province
         if self.district:
@@ -52,88 +116,631 @@ class DataProcessor:
             bld = os.path.abspath(dist_dir.joinpath(ward_name, "SIMULATED_HH_FAKE.shp"))
             return {"df_shp": df, "poi_shp": poi, "buildings": bld}
 
+    def columns_to_load(self):
+        """
+        Returns the raw CSV columns needed for processing: union of DF and POI
+        columns plus the fallback coordinates columns
+        :return:
+        """
+        cols = self.params['cols_df'] + self.params['cols_poi'] + self.params['fallback_coords_cols']
+        return list(dict.fromkeys(cols))
+
+    def sanitize_raw_listing(self, df, output_dwellings, output_pois, append_output=False,
+                             seen_coordinates=None, stats=None, kept_points=None):
+        """
+        Helper to run "sanitize_and_separate_df_pois" with processing parameters,
+        columns are moved out of df which is left empty
+        :return:
+        """
+        return ut.sanitize_and_separate_df_pois(df=df, output_file_dwelling=output_dwellings,
+                                                output_file_pois=output_pois,
+                                                struct_type_col=self.params['struct_type_col'],
+                                                null_feat_cat_replacement="missing",
+                                                cols_to_keep_df=self.params['cols_df'],
+                                                cols_to_keep_poi=self.params['cols_poi'],
+                                                new_col_names_df=self.params[
+                                                    'new_names_df'],
+                                                new_col_names_poi=self.params[
+                                                    'new_names_poi'],
+                                                residential_struct_category=self.params[
+                                                    'res_struct_val'],
+                                                append_output=append_output,
+                                                seen_coordinates=seen_coordinates,
+                                                dedup_radius_m=self.params['dedup_radius_m'],
+                                                dedup_report_files=self.near_duplicates_report_files(),
+                                                stats=stats, schema=self.params['schema'], release_input=True,
+                                                kept_points=kept_points)
+
+    def ward_schema(self):
+        """
+        Returns the schema (see prepare_processing_parameters) with the column names of ward files
+        :return:
+        """
+        names = {**self.params['new_names_df'], **self.params['new_names_poi']}
+        return {names.get(c, c): t for c, t in self.params['schema'].items()}
+
+    def split_by_ward(self, df_dwellings, df_pois, already_written=None, arrow_writers=None, writer=None):
+        """
+        Saves processed DFs and POIs into ward level CSV or Arrow files
+        :param df_dwellings: processed DFs
+        :param df_pois: processed POIs
+        :param already_written: ward CSV files to append to (e.g., when processing in chunks)
+        :param arrow_writers: see ward_file_writers
+        :param writer: see background_writer, ward files may not be saved yet when this returns
+        :return:
+        """
+        for df, suffix in [(df_dwellings, "df"), (df_pois, "poi")]:
+            ut.partition_by_ward(df=df, ward_id_col=self.params['ward_id_col'],
+                                 output_folder=self.dir_with_ward_subdirs, suffix=suffix,
+                                 max_workers=self.params['ward_csv_writers'],
+                                 already_written=already_written, arrow_writers=arrow_writers, writer=writer)
+
+    def remove_ward_files(self):
+        """
+        Removes DF and POIs ward files of an earlier run, a ward missing from the raw CSV file
+        would otherwise keep the listings it had then
+        :return:
+        """
+        if not self.dir_with_ward_subdirs.exists():
+            return
+        for ward_dir in pl.ward_subdirs(self.dir_with_ward_subdirs):
+            for suffix in ["df", "poi"]:
+                for exchange_format in ex.EXCHANGE_FORMATS:
+                    ex.ward_file(ward_dir, suffix, exchange_format).unlink(missing_ok=True)
+
+    def background_writer(self):
+        """
+        Returns the writer ward files are queued to while the raw CSV file is processed
+        (see writer.BackgroundWriter), it raises once closed if any ward file failed to save
+        :return:
+        """
+        return wr.BackgroundWriter(threads=self.params['ward_csv_writers'],
+                                   queue_size=self.params['write_queue_size'])
+
+    def ward_file_writers(self):
+        """
+        Returns a context manager with the Arrow writers ward files are saved through
+        (see exchange.ArrowWardWriters), or None when ward files are CSV files
+        :return:
+        """
+        if self.params['ward_exchange_format'] == 'arrow':
+            return ex.ArrowWardWriters()
+        return nullcontext()
+
     def process_data(self):
         """
-        Run a processing
+        Run a processing, each stage is timed and a run report is saved (see run_report_files)
         :return:
         """
+        try:
+            ward_dirs, manifest = self.prepare_wards()
+
+            # ===========================================
+            # CREATE SHP FILES
+            # ===========================================
+            results_shp = self.run_ward_stage("create_ward_layers", self.create_ward_layers, ward_dirs)
+
+            # =========================================================
+            # APPEND HH LISTING BASED POPULATION COUNT, STRUCTURE COUNT
+            # AND BUILDING COUNTS FROM SATELLITE IMAGERY
+            # ==========================================================
+            results_ea = self.run_ward_stage("append_building_attributes_to_ward_level_ea_shp",
+                                             self.append_building_attributes_to_ward_level_ea_shp, ward_dirs)
+
+            self.finish_wards(ward_dirs, manifest, results_shp, results_ea)
+        finally:
+            if self.params['run_report']:
+                self.save_run_report()
+
+    def prepare_wards(self):
+        """
+        Runs the district level stages: processes the raw CSV file into ward files
+        and finds wards to process. A run which didn't finish is resumed (see start_journal)
+        :return: ward directories to process and the manifest (see find_wards_to_process)
+        """
+        self.start_journal()
+
         # ===========================================
-        # CREATE PANDAS DATAFRAME FROM RAW CSV FILE
+        # PROCESS RAW CSV FILE AND SPLIT BY WARD
         # ===========================================
-        df_raw = ut.create_df(self.raw_csv_filename)
+        with self.report.stage("process_raw_listing", district=self.district) as record:
+            record.update(self.run_journaled("process_raw_listing", self.process_raw_listing))
 
         # ===========================================
-        # GENERATE PROCESSED CSV
+        # FIND WARDS WITH NEW INPUTS
         # ===========================================
-        output_dwellings = self.create_ouput_files_raw_csv_processing()['output_dwellings']
-        output_pois = self.create_ouput_files_raw_csv_processing()['output_pois']
-
-        ut.sanitize_and_separate_df_pois(df=df_raw, output_file_dwelling=output_dwellings,
-                                         output_file_pois=output_pois,
-                                         struct_type_col=self.params['struct_type_col'],
-                                         null_feat_cat_replacement="missing",
-                                         cols_to_keep_df=self.params['cols_df'],
-                                         cols_to_keep_poi=self.params['cols_poi'],
-                                         new_col_names_df=self.params[
-                                             'new_names_df'],
-                                         new_col_names_poi=self.params[
-                                             'new_names_poi'],
-                                         residential_struct_category=self.params[
-                                             'res_struct_val'])
+        with self.report.stage("find_wards_to_process", district=self.district) as record:
+            ward_dirs, manifest = self.run_journaled("find_wards_to_process", self.find_wards_to_process)
+            record["wards"] = len(ward_dirs)
+
+        return ward_dirs, manifest
+
+    def finish_wards(self, ward_dirs, manifest, results_shp, results_ea, build_rollups=True):
+        """
+        Runs the stages after ward level stages: updates the roll-up store and records wards processed
+        :param ward_dirs: ward directories processed
+        :param manifest: see find_wards_to_process
+        :param results_shp: results of the ward layers stage (see parallel.run_ward_job)
+        :param results_ea: results of the EA attributes stage
+        :param build_rollups: recompute roll-ups after updating the store, see update_rollup_store
+        :return:
+        """
         # ===========================================
-        # SPLIT CSV BY WARD
+        # UPDATE NATIONAL ROLL-UP STORE
         # ===========================================
-        if self.district:
-            prov = self.province
-            dist = self.district
-            self.dir_with_ward_subdirs = self.ea_demarcation_dir.joinpath(prov, dist)
-
-        ward_id_col = self.params['ward_id_col']
-        ut.split_csv_into_wards(csv_file=output_dwellings, ward_id_col=ward_id_col,
-                                output_folder=self.dir_with_ward_subdirs,
-                                suffix="df")
-        ut.split_csv_into_wards(csv_file=output_pois, ward_id_col=ward_id_col,
-                                output_folder=self.dir_with_ward_subdirs,
-                                suffix="poi")
+        if self.params['rollup_store']:
+            with self.report.stage("update_rollup_store", district=self.district) as record:
+                record.update(self.update_rollup_store(results_ea, build_rollups=build_rollups))
 
         # ===========================================
-        # CREATE SHP FILES
+        # RECORD WARDS PROCESSED
         # ===========================================
-        ut.create_shp_for_each_ward(self.dir_with_ward_subdirs, crs=self.params["crs"],
-                                    lon_col=self.params["lon"], lat_col=self.params["lat"])
+        with self.report.stage("record_wards_processed", district=self.district):
+            self.record_wards_processed(manifest, ward_dirs, results_shp + results_ea)
 
-        # =========================================================
-        # APPEND HH LISTING BASED POPULATION COUNT, STRUCTURE COUNT
-        # AND BUILDING COUNTS FROM SATELLITE IMAGERY
-        # ==========================================================
-        self.append_building_attributes_to_ward_level_ea_shp()
+        if self.journal is not None:
+            self.journal.finish()
 
-    def append_building_attributes_to_ward_level_ea_shp(self):
+    def run_fingerprint(self):
         """
-        Helper function to loop through all wards and append building attributes to EA shapefile
+        Returns what a run is resumed for: the raw CSV file as it was and the processing parameters
+        :return:
+        """
+        raw_csv = os.stat(self.raw_csv_filename)
+        return {"raw_csv": str(self.raw_csv_filename), "size": raw_csv.st_size, "mtime_ns": raw_csv.st_mtime_ns,
+                "params": mf.params_hash(self.params), "ward_exchange_format": self.params['ward_exchange_format']}
+
+    def start_journal(self):
+        """
+        Resumes the last run of the district if it didn't finish and has the same fingerprint
+        (see run_fingerprint), otherwise starts a new one (see journal.RunJournal)
+        :return:
+        """
+        if self.journal is not None and self.journal.start(self.run_fingerprint()):
+            print("Resuming unfinished run of {} district".format(self.district))
+
+    def run_journaled(self, stage, func):
+        """
+        Runs a district level stage and records its result in the journal, the recorded result
+        is returned instead when the stage completed in the run being resumed
+        :param stage: stage name
+        :param func: function without arguments returning the stage result, which isn't None
+        :return: stage result
+        """
+        if self.journal is None:
+            return func()
+        result = self.journal.completed(stage)
+        if result is None:
+            result = func()
+            self.journal.record(stage, result)
+
+        return result
+
+    def completed_ward_results(self, stage):
+        """
+        Returns results of wards which completed a ward level stage in the run being resumed, by ward name
+        :return:
+        """
+        if self.journal is None:
+            return {}
+        return self.journal.completed_wards(stage)
+
+    def run_ward_stage(self, stage, func, ward_dirs):
+        """
+        Runs a ward level stage and adds a record for the stage and each ward to the run report
+        :param stage: stage name
+        :param func: DataProcessor method taking ward_dirs, profile_file_prefix and journal, wards
+         which completed the stage in the run being resumed are skipped
+        :param ward_dirs: ward directories to process
+        :return: a result per ward (see parallel.run_ward_job)
+        """
+        with self.report.stage(stage, profile=False, district=self.district) as record:
+            done = self.completed_ward_results(stage)
+            to_run = [w for w in ward_dirs if w.parts[-1] not in done]
+            if done:
+                print("{}: {} wards already done, {} to go".format(stage, len(ward_dirs) - len(to_run), len(to_run)))
+            results = func(ward_dirs=to_run, profile_file_prefix=self.report.profile_prefix(stage),
+                           journal=self.journal)
+            done.update((r["ward"], r) for r in results)
+            results = [done[w.parts[-1]] for w in ward_dirs]
+            record["wards"] = len(results)
+            record["failed_wards"] = sum(not r["success"] for r in results)
+        self.report.add_ward_results(stage, results, district=self.district)
+
+        return results
+
+    def save_run_report(self):
+        """
+        Saves run report and prints the slowest wards
+        :return:
+        """
+        files = self.run_report_files()
+        self.report.save(files["json"], files["csv"])
+        slowest = self.report.slowest_wards()
+        if not slowest.empty:
+            print("Slowest wards:")
+            print(slowest[["stage", "ward", "wall_seconds", "peak_rss_mb"]].to_string(index=False))
+
+    def process_raw_listing(self):
+        """
+        Reads raw CSV file (whole or in chunks), separates DFs and POIs and saves ward level CSV or Arrow files
+        :return: dict of row counts (see utils.sanitize_and_separate_df_pois)
+        """
+        stats = {}
+        # processed district level CSVs are only saved for debugging
+        output_dwellings = None
+        output_pois = None
+        if self.params['save_tmp_csv']:
+            output_dwellings = self.create_ouput_files_raw_csv_processing()['output_dwellings']
+            output_pois = self.create_ouput_files_raw_csv_processing()['output_pois']
+
+        chunk_size = self.raw_listing_chunk_size()
+        self.remove_ward_files()
+        # Arrow ward files are complete once their writers are closed, which is after
+        # the background writer has saved everything queued
+        with self.ward_file_writers() as arrow_writers, self.background_writer() as writer:
+            if chunk_size:
+                # ===========================================
+                # STREAM RAW CSV FILE IN CHUNKS, PROCESS
+                # AND SPLIT EACH CHUNK BY WARD
+                # ===========================================
+                seen_coordinates = {"df": ut.CoordinateSet(), "poi": ut.CoordinateSet()}
+                kept_points = None
+                if self.params['dedup_radius_m']:
+                    kept_points = {f: ut.KeptPoints(self.params['dedup_radius_m']) for f in ["df", "poi"]}
+                ward_csvs_written = set()
+                chunks = ut.create_df_in_chunks(self.raw_csv_filename, usecols=self.columns_to_load(),
+                                                dtypes=ut.read_dtypes(self.params['schema']), chunksize=chunk_size,
+                                                quarantine_file=self.bad_lines_file(), stats=stats)
+                for i, chunk in enumerate(chunks):
+                    df_dwellings, df_pois = self.sanitize_raw_listing(df=chunk, output_dwellings=output_dwellings,
+                                                                      output_pois=output_pois, append_output=i > 0,
+                                                                      seen_coordinates=seen_coordinates,
+                                                                      stats=stats, kept_points=kept_points)
+                    self.split_by_ward(df_dwellings=df_dwellings, df_pois=df_pois,
+                                       already_written=ward_csvs_written, arrow_writers=arrow_writers,
+                                       writer=writer)
+                    # rows queued to be saved are copies, this chunk's rows are freed before the next is read
+                    del chunk, df_dwellings, df_pois
+            else:
+                # ===========================================
+                # CREATE PANDAS DATAFRAME FROM RAW CSV FILE
+                # ===========================================
+                df_raw = ut.create_df(self.raw_csv_filename, usecols=self.columns_to_load(),
+                                      dtypes=ut.read_dtypes(self.params['schema']),
+                                      quarantine_file=self.bad_lines_file(), stats=stats)
+
+                # ===========================================
+                # PROCESS AND SPLIT BY WARD
+                # ===========================================
+                df_dwellings, df_pois = self.sanitize_raw_listing(df=df_raw, output_dwellings=output_dwellings,
+                                                                  output_pois=output_pois, stats=stats)
+                del df_raw
+                self.split_by_ward(df_dwellings=df_dwellings, df_pois=df_pois, arrow_writers=arrow_writers,
+                                   writer=writer)
+
+        return stats
+
+    def raw_listing_chunk_size(self):
+        """
+        Returns number of rows per chunk the raw CSV file is processed in: chunk_size if set, otherwise
+        the number of rows which fit in memory_budget_mb (see RAW_LISTING_PEAK_FACTOR and RAW_LISTING_BASE_MB),
+        at least a tenth of the budget goes to rows. Rows beyond the
+        budget are spilled to ward files, a chunk is saved before the next one is read
+        :return: None to read the whole file at once
+        """
+        if self.params['chunk_size'] or not self.params['memory_budget_mb']:
+            return self.params['chunk_size']
+        row_bytes = cr.row_memory(self.raw_csv_filename, usecols=self.columns_to_load(),
+                                  dtypes=ut.read_dtypes(self.params['schema']))
+        if not row_bytes:
+            return None
+        # coordinates seen and points kept by near duplicate detection in earlier chunks are
+        # kept until the end (see utils.CoordinateSet and utils.KeptPoints)
+        budget = self.params['memory_budget_mb'] * 1024 ** 2
+        seen_bytes = cr.estimate_rows(self.raw_csv_filename) * (
+            ut.CoordinateSet.BYTES_PER_KEY + (ut.KeptPoints.BYTES_PER_POINT if self.params['dedup_radius_m'] else 0))
+        if seen_bytes > budget / 2:
+            print("Coordinates seen take about {:.0f} MB of the {} MB memory budget".format(
+                seen_bytes / 1024 ** 2, self.params['memory_budget_mb']))
+        rows_budget = max(budget - seen_bytes - RAW_LISTING_BASE_MB * 1024 ** 2, budget / 10)
+        chunk_size = max(int(rows_budget / (row_bytes * RAW_LISTING_PEAK_FACTOR)), 1)
+        print("Processing raw CSV file in chunks of {} rows to stay within {} MB".format(
+            chunk_size, self.params['memory_budget_mb']))
+
+        return chunk_size
+
+    def find_wards_to_process(self):
+        """
+        Returns ward directories to process (only those with new inputs when incremental)
+        and the manifest (None when not incremental)
+        :return:
+        """
+        ward_dirs = pl.ward_subdirs(self.dir_with_ward_subdirs)
+        manifest = None
+        if self.params['incremental']:
+            manifest = mf.load_manifest(self.dir_with_ward_subdirs)
+            ward_dirs = self.wards_to_process(manifest, ward_dirs)
+
+        return ward_dirs, manifest
+
+    def process_wards(self, ward_dirs):
+        """
+        Runs both ward level stages for each ward in this process, one ward after another,
+        used by the batch scheduler (see scheduler.py) which runs wards of all districts in one pool.
+        Wards which completed a stage in the run being resumed are skipped
+        :param ward_dirs: ward directories
+        :return: results of the ward layers stage and of the EA attributes stage (see parallel.run_ward_job)
+        """
+        results_shp, results_ea = [], []
+        stages = [("create_ward_layers", ut.create_shp_for_ward, self.ward_layer_kwargs(), results_shp),
+                  ("append_building_attributes_to_ward_level_ea_shp", self.append_building_attributes_to_ward_ea,
+                   {}, results_ea)]
+        for w in ward_dirs:
+            for stage, func, kwargs, results in stages:
+                done = self.completed_ward_results(stage)
+                result = done.get(w.parts[-1])
+                if result is None:
+                    result = pl.run_ward_job(func, w, kwargs, self.report.profile_prefix(stage),
+                                             journal=self.journal, stage=stage)
+                results.append(result)
+
+        return results_shp, results_ea
+
+    def ward_layer_kwargs(self):
+        """
+        Returns keyword arguments of utils.create_shp_for_ward
+        :return:
+        """
+        return {"crs": self.params["crs"], "lon_col": self.params["lon"], "lat_col": self.params["lat"],
+                "storage_format": self.params["storage_format"], "schema": self.ward_schema(),
+                "exchange_format": self.params["ward_exchange_format"], "columns": self.ward_columns()}
+
+    def ward_columns(self):
+        """
+        Returns the columns of DF and POIs ward files
+        :return:
+        """
+        return {suffix: [self.params[names].get(c, c) for c in self.params[cols]]
+                for suffix, cols, names in [("df", "cols_df", "new_names_df"), ("poi", "cols_poi", "new_names_poi")]}
+
+    def create_ward_layers(self, ward_dirs=None, profile_file_prefix=None, journal=None):
+        """
+        Creates ward level DF and POIs layers from ward files
+        :param ward_dirs: only process these ward directories, defaults to all wards
+        :param profile_file_prefix: save a cProfile dump per ward, see parallel.run_ward_job
+        :param journal: record each ward done in this journal, see parallel.run_ward_job
+        :return: a result per ward (see parallel.run_ward_job)
+        """
+        results = ut.create_shp_for_each_ward(self.dir_with_ward_subdirs, max_workers=self.ward_workers(),
+                                              ward_dirs=ward_dirs, profile_file_prefix=profile_file_prefix,
+                                              journal=journal, journal_stage="create_ward_layers",
+                                              write_queue_size=self.ward_write_queue_size(),
+                                              **self.ward_layer_kwargs())
+        self.report_ward_layers(results)
+
+        return results
+
+    @staticmethod
+    def report_ward_layers(results):
+        """
+        Prints wards which failed creating layers and the number of layers written
+        :param results: results of the ward layers stage (see parallel.run_ward_job)
+        :return:
+        """
+        pl.report_failures(results, stage="Creating ward shapefiles")
+        layers_done = [r["value"] for r in results if r["success"]]
+        print("Ward layers: {} written, {} skipped as up to date".format(
+            sum(len(d["written"]) for d in layers_done), sum(len(d["skipped"]) for d in layers_done)))
+
+    def record_wards_processed(self, manifest, ward_dirs, results):
+        """
+        Records inputs of wards processed successfully in the manifest
+        :param manifest: see manifest.load_manifest, nothing is recorded if None
+        :param ward_dirs: ward directories processed
+        :param results: results of ward level stages (see parallel.run_ward_job)
         :return:
         """
-        for w in self.dir_with_ward_subdirs.iterdir():
+        if manifest is None:
+            return
+
+        failed = {r["ward"] for r in results if not r["success"]}
+        for w in ward_dirs:
             ward_name = w.parts[-1]
-            if w.is_dir():
-                try:
-                    df = os.path.abspath(w.joinpath("{}_df.shp".format(ward_name)))
-                    poi = os.path.abspath(w.joinpath("{}_poi.shp".format(ward_name)))
-                    buildings_filename = self.params['ward_level_buildings_filename']
-                    bld = os.path.abspath(w.joinpath("{}.shp".format(buildings_filename)))
-                    ea_filename = self.params['ward_level_ea_filename']
-                    ea_shp = os.path.abspath(w.joinpath("{}.shp".format(ea_filename)))
-
-                    ut.append_all_building_attributes_to_ea(ea_shp_file=ea_shp,
-                                                            building_footprints=bld,
-                                                            hhlisting_dwellings=df,
-                                                            hhlisting_pois=poi,
-                                                            ea_aggregation_id=self.params[
-                                                                'ea_aggregation_id'],
-                                                            output_ea_shpfile=ea_shp, crs_info=self.params['crs'])
-                except Exception:
-                    print("Failed to append attributes to ward shapefile {}".format(w.parts[-1]))
-                    continue
+            if ward_name not in failed:
+                hashes = mf.ward_input_hashes(self.ward_input_files(w), self.params)
+                mf.record_ward(manifest, ward_name, hashes)
+        mf.save_manifest(self.dir_with_ward_subdirs, manifest)
+
+    def ward_input_files(self, ward_dir):
+        """
+        Returns full paths of a ward's inputs
+        :param ward_dir: ward directory
+        :return:
+        """
+        exchange_format = self.params['ward_exchange_format']
+        return {"df": ex.ward_file(ward_dir, "df", exchange_format),
+                "poi": ex.ward_file(ward_dir, "poi", exchange_format),
+                "ea": ward_dir.joinpath("{}.shp".format(self.params['ward_level_ea_filename'])),
+                "buildings": ward_dir.joinpath("{}.shp".format(self.params['ward_level_buildings_filename']))}
+
+    def ward_outputs_exist(self, ward_dir, stored_wards=None):
+        """
+        Checks that a ward's DF, POIs and EA attributes layers have been saved
+        :param stored_wards: wards in the roll-up store, not checked if None
+        """
+        ward_name = ward_dir.parts[-1]
+        if stored_wards is not None and ward_name not in stored_wards:
+            return False
+        layers = ["{}_df".format(ward_name), "{}_poi".format(ward_name), self.params['ward_level_ea_output_filename']]
+        return all(st.layer_exists(ward_dir, layer, self.params['storage_format']) for layer in layers)
+
+    def wards_to_process(self, manifest, ward_dirs):
+        """
+        Returns wards whose inputs (DF and POIs rows, EA and building layers, processing parameters)
+        changed since they were last processed or whose outputs are missing
+        :param manifest: see manifest.load_manifest
+        :param ward_dirs: ward directories
+        :return:
+        """
+        stored_wards = None
+        if self.params['rollup_store']:
+            eas = rl.load_district_eas(self.rollup_store_dir(), self.province, self.district)
+            stored_wards = set() if eas is None else set(eas["ward"])
+
+        to_process = []
+        for w in ward_dirs:
+            hashes = mf.ward_input_hashes(self.ward_input_files(w), self.params)
+            if mf.ward_is_up_to_date(manifest, w.parts[-1], hashes) and self.ward_outputs_exist(w, stored_wards):
+                continue
+            to_process.append(w)
+        print("{} of {} wards have new inputs".format(len(to_process), len(ward_dirs)))
+
+        return to_process
+
+    def ward_workers(self):
+        """
+        Returns number of processes for ward level stages, a GeoPackage is
+        a single file per district which can't be written from several processes
+        :return:
+        """
+        if self.params['storage_format'] == 'gpkg':
+            return 1
+        return self.params['ward_workers']
+
+    def ward_write_queue_size(self):
+        """
+        Returns size of the queue of ward layers saved in the background while the next ward
+        is processed (see parallel.run_for_each_ward), a ward's layers are read from the
+        GeoPackage the previous ward is being saved to so it is saved right away
+        :return:
+        """
+        if self.params['storage_format'] == 'gpkg':
+            return 0
+        return self.params['write_queue_size']
+
+    def append_building_attributes_to_ward_level_ea_shp(self, ward_dirs=None, profile_file_prefix=None,
+                                                         journal=None):
+        """
+        Helper function to loop through all wards and append building attributes to EA shapefile
+        :param ward_dirs: only process these ward directories, defaults to all wards
+        :param profile_file_prefix: save a cProfile dump per ward, see parallel.run_ward_job
+        :param journal: record each ward done in this journal, see parallel.run_ward_job
+        :return: a result per ward (see parallel.run_ward_job)
+        """
+        if ward_dirs is None:
+            ward_dirs = pl.ward_subdirs(self.dir_with_ward_subdirs)
+        results = pl.run_for_each_ward(self.append_building_attributes_to_ward_ea, ward_dirs,
+                                       max_workers=self.ward_workers(),
+                                       profile_file_prefix=profile_file_prefix, journal=journal,
+                                       stage="append_building_attributes_to_ward_level_ea_shp",
+                                       write_queue_size=self.ward_write_queue_size())
+        pl.report_failures(results, stage="Appending attributes to ward shapefile")
+
+        return results
+
+    def append_building_attributes_to_ward_ea(self, ward_dir, writer=None):
+        """
+        Appends building attributes to EA layer for a single ward, only the
+        columns needed for aggregation are loaded from the DF, POIs and buildings layers.
+        The EA layer is left as it is, EAs with attributes are saved as a separate layer
+        :param ward_dir: ward directory
+        :param writer: writer.BackgroundWriter to queue the EA attributes layer to under the ward
+         directory, None saves it before returning
+        :return: Saves EA attributes layer using the storage format and returns counts of points
+         joined to EAs (see utils.aggregate_points_by_ea) and the EA attributes for the
+         roll-up store ("ea_attributes")
+        """
+        stats = {}
+        ward_name = ward_dir.parts[-1]
+        storage_format = self.params['storage_format']
+
+        points = {}
+        files = self.ward_input_files(ward_dir)
+        for suffix, columns in [("df", ['HHPop']), ("poi", [])]:
+            if self.params['ward_exchange_format'] == 'arrow' and files[suffix].exists():
+                # coordinates are read straight from the ward Arrow files, no point geometries are built
+                points[suffix] = ex.read_points(files[suffix], lon=self.params['lon'], lat=self.params['lat'],
+                                                crs={'init': 'epsg:4326'}, columns=columns)
+            else:
+                # a ward without DFs or POIs only has an empty layer for them (see utils.create_shp_for_ward)
+                points[suffix] = st.read_layer(ward_dir, "{}_{}".format(ward_name, suffix), storage_format,
+                                               columns=columns)
+        hh, poi = points["df"], points["poi"]
+        buildings_filename = self.params['ward_level_buildings_filename']
+        bld_file = ward_dir.joinpath("{}.shp".format(buildings_filename))
+        if self.params['buildings_batch_size']:
+            bld = st.iter_file_batches(bld_file, columns=['n_HH'], batch_size=self.params['buildings_batch_size'])
+        else:
+            bld = st.read_file(bld_file, columns=['n_HH'])
+        ea_filename = self.params['ward_level_ea_filename']
+        ea_file = ward_dir.joinpath("{}.shp".format(ea_filename))
+        ea = st.read_file(ea_file)
+
+        ea_index = None
+        raster_resolution = self.params['ea_raster_resolution']
+        # the raster falls back to the index in boundary cells so it needs the index too
+        if self.params['ea_index_cache'] or raster_resolution:
+            cache_file = ward_dir.joinpath("{}_index.npz".format(ea_filename))
+            ea_index = eai.load_or_build_ea_index(cache_file, ea=ea,
+                                                  ea_aggregation_id=self.params['ea_aggregation_id'],
+                                                  crs_info=self.params['crs'], ea_file=ea_file)
+        if raster_resolution:
+            ea_index = eai.load_or_build_ea_raster(ward_dir.joinpath("{}_raster".format(ea_filename)),
+                                                   ea_index=ea_index, resolution=raster_resolution)
+
+        ea_out = ut.summarize_building_attributes_by_ea(ea=ea, bldings=bld, hh=hh, poi=poi,
+                                                        ea_aggregation_id=self.params['ea_aggregation_id'],
+                                                        crs_info=self.params['crs'], ea_index=ea_index,
+                                                        stats=stats)
+        ea_layer = self.params['ward_level_ea_output_filename']
+        if writer is not None:
+            writer.submit(ward_dir, st.write_layer, ea_out, ward_dir=ward_dir, layer=ea_layer,
+                          storage_format=storage_format)
+        else:
+            st.write_layer(ea_out, ward_dir=ward_dir, layer=ea_layer, storage_format=storage_format)
+
+        ea_attributes = pd.DataFrame(ea_out[[self.params['ea_aggregation_id']] + ut.EA_ATTRIBUTE_COLS])
+        ea_attributes = ea_attributes.rename(columns={self.params['ea_aggregation_id']: "ea"})
+        ea_attributes.insert(0, "ward", ward_name)
+        ea_attributes.insert(0, "constituency", self.ward_constituency(ward_dir))
+
+        return {**stats, "ea_attributes": ea_attributes}
+
+    def ward_constituency(self, ward_dir):
+        """
+        Returns constituency of a ward from its DF or POIs CSV file, None if neither has any rows
+        :param ward_dir: ward directory
+        :return:
+        """
+        files = self.ward_input_files(ward_dir)
+        for f in [files["df"], files["poi"]]:
+            if not f.exists():
+                continue
+            if self.params['ward_exchange_format'] == 'arrow':
+                cons = ex.read_table(f, columns=['CONS']).column('CONS').to_pandas()
+            else:
+                cons = pd.read_csv(f, usecols=['CONS'], nrows=1, dtype=str)['CONS']
+            if not cons.empty:
+                return cons.iloc[0]
+
+        return None
+
+    def update_rollup_store(self, results, build_rollups=True):
+        """
+        Saves EA attributes of the wards processed to the national roll-up store and
+        recomputes its roll-ups
+        :param results: results of the EA attributes stage (see parallel.run_ward_job)
+        :param build_rollups: recompute roll-ups, a batch of districts does it once at the end
+        :return: dict with number of EAs in the district
+        """
+        store_dir = self.rollup_store_dir()
+        ward_eas = [r["value"]["ea_attributes"] for r in results if r["success"]]
+        eas = rl.update_district_eas(store_dir, self.province, self.district, ward_eas)
+        if build_rollups:
+            rl.build_rollups(store_dir)
+
+        return {"eas": 0 if eas is None else len(eas)}
 
 
 def prepare_processing_parameters():
@@ -191,13 +798,119 @@ def prepare_processing_parameters():
                          'Health_Facility_Hospital_Health_Center': 'HealthFacTyp',
                          'Ownership_of_Institution': 'OwnershipInst',
                          'Status_of_the_Institution': 'StatusInst'}
+    # used to replace missing GPS coordinates
+    fallback_coords_cols = ['GeoLocation_Latitude', 'GeoLocation_Longitude']
+
     cols_params = {"cols_df": columns_to_keep_df, "cols_poi": columns_to_keep_poi,
-                   "new_names_df": new_col_names_df, "new_names_poi": new_col_names_poi}
+                   "new_names_df": new_col_names_df, "new_names_poi": new_col_names_poi,
+                   "fallback_coords_cols": fallback_coords_cols}
+
+    # Raw CSV reading
+    # set chunk_size (number of rows) to stream very large raw CSV files in chunks
+    # rather than loading them whole, None reads the whole file at once
+    chunk_size = None
+    # memory (MB) the raw listing stage may use, when chunk_size is None the raw CSV file is
+    # processed in chunks which fit (see DataProcessor.raw_listing_chunk_size), None doesn't limit it
+    memory_budget_mb = None
+    reading_params = {"chunk_size": chunk_size, "memory_budget_mb": memory_budget_mb}
+
+    # Schema
+    # compact dtypes of raw columns, text and categoricals are declared at read time and
+    # numbers converted once coordinates are repaired (see utils.apply_schema), dtypes
+    # are kept in ward files and layers (GeoParquet keeps categoricals too)
+    # admin codes, structure types and other repeated labels
+    categorical_cols = ['PROV', 'DIST', 'CONS', 'WARD', 'REGION', 'SEA', 'LOCALITY',
+                        'Structure_type_categorisation', 'Multipurpose_Residential_Building',
+                        'Multipurpose_Religious_Building', 'Multipurpose_Institutional_Building',
+                        'Multipurpose_Commercial_Building', 'Religious_Building', 'Institutional_Building',
+                        'Educational_Building', 'Commercial_Building', 'Health_Facility_Hospital_Health_Center',
+                        'Ownership_of_Institution', 'Status_of_the_Institution']
+    text_cols = ['GPSLocation__Timestamp', 'Structure_Name', 'First_Head_Name']
+    # smallest integer types which hold any plausible count, nullable since counts
+    # may be missing, columns with values which don't fit are left as read
+    count_dtypes = {'Males_in_structure': 'UInt16', 'Females_in_structure': 'UInt16',
+                    'Number_of_Housing_Units': 'UInt16', 'Total_Households': 'UInt16',
+                    'Males_in_Household': 'UInt8', 'Females_in_Household': 'UInt8',
+                    'Household_Population': 'UInt16'}
+    # decimals recorded by the tablets, float32 is only used if it keeps them
+    coords_decimals = 7
+    altitude_decimals = 1
+    coords_dtype = ut.float_dtype_for_precision(180, coords_decimals)
+    float_dtypes = {c: coords_dtype for c in ['GPSLocation__Latitude', 'GPSLocation__Longitude']
+                    + fallback_coords_cols}
+    float_dtypes['GPSLocation__Altitude'] = ut.float_dtype_for_precision(10000, altitude_decimals)
+    schema = {**{c: 'category' for c in categorical_cols}, **{c: str for c in text_cols}, **count_dtypes,
+              **float_dtypes}
+
+    # Deduplication
+    # points re-captured within this distance (metres) of an earlier point kept are dropped
+    # and listed in <district>_District_near_duplicates_df/poi.csv, None only drops
+    # points with identical coordinates
+    dedup_radius_m = None
+
+    # Outputs
+    # save district level processed DF and POIs CSV files (TMP_*.csv) for debugging
+    save_tmp_csv = False
+    # number of threads saving ward level files
+    ward_csv_writers = 4
+    # ward files and layers waiting to be saved in the background while the next chunk or
+    # ward is processed (per writing thread, see writer.py), bounds the memory they hold,
+    # 0 saves each one before carrying on
+    write_queue_size = 4
+    # format of ward level DF and POIs files handed from the raw listing stage to the
+    # ward stages: 'arrow' (memory-mapped Arrow IPC files, no text parsing) or 'csv', see exchange.py
+    ward_exchange_format = 'arrow'
+    # format for ward level DF, POIs and EA layers: shapefile, geoparquet or gpkg
+    # (one GeoPackage per district with a layer per ward), see storage.py
+    storage_format = 'shapefile'
+    output_params = {"save_tmp_csv": save_tmp_csv, "ward_csv_writers": ward_csv_writers,
+                     "write_queue_size": write_queue_size,
+                     "ward_exchange_format": ward_exchange_format, "storage_format": storage_format}
+
+    # number of processes for ward level stages (shapefiles and EA attributes)
+    ward_workers = os.cpu_count() or 1
+    # cache EA polygons spatial index in each ward directory (<EA>_index.npz),
+    # rebuilt only when the EA geometries change
+    ea_index_cache = True
+    # cell size (CRS units) of a cached EA ID raster per ward (<EA>_raster.npy) which
+    # assigns most points with an array lookup, e.g. 0.00005 degrees (about 5 m) for EAs
+    # a few hundred metres across, None only uses the index (as does a raster over ea_index.MAX_CELLS cells)
+    ea_raster_resolution = None
+    # only rebuild wards whose inputs changed since the last run (see manifest.py)
+    incremental = True
+    # stream building footprints in batches of this many points rather than loading
+    # them whole (for layers which don't fit in memory), None loads the whole layer
+    buildings_batch_size = None
+
+    # save EA attributes and their roll-ups by ward, constituency, district and province
+    # to <ea_demarcation_dir>/national_rollup (see rollup.py)
+    rollup_store = True
+
+    # keep a journal of stages and wards done in <district dir>/.journal so that a run
+    # which crashed or was stopped resumes where it stopped (see journal.py)
+    run_journal = True
+
+    # Fieldwork progress
+    # records captured up to this many hours before the latest one taken in by the last progress
+    # update are looked at again since tablets sync at different times (see progress.py)
+    progress_lookback_hours = 72
+
+    # Run reports
+    # save time, memory, I/O and row counts per stage and ward as
+    # <district>_District_run_report.json/csv
+    run_report = True
+    # stages to run under cProfile (e.g., ['create_ward_layers']), dumps are saved as
+    # <district>_District_profile_<stage>[_<ward>].prof, per ward for ward level stages
+    profile_stages = []
+    report_params = {"run_report": run_report, "profile_stages": profile_stages}
+
     # Filenames
     ward_level_ea_shp = 'EA'
+    # EAs with building attributes appended, saved using the storage format, the EA layer itself isn't changed
+    ward_level_ea_output = 'EA_attributes'
     ward_level_buildings_footprints_filename = 'SIMULATED_HH_FAKE'
     filenames = {'ward_level_buildings_filename': ward_level_buildings_footprints_filename,
-                 'ward_level_ea_filename': ward_level_ea_shp}
+                 'ward_level_ea_filename': ward_level_ea_shp, 'ward_level_ea_output_filename': ward_level_ea_output}
 
     # Misc Params
     # used when aggregating building counts and populaiton at EA level
@@ -211,7 +924,12 @@ def prepare_processing_parameters():
     misc = {'ea_aggregation_id': ea_agg_col, "lon": lon, "lat": lat, 'ward_id_col': ward_id_col_in_ea_shp,
             'res_struct_val': residential_struct_category_val, "struct_type_col": struct_type_col, "crs": crs}
 
-    return {**misc, **filenames, **cols_params}
+    return {**misc, **filenames, **cols_params, **reading_params, "schema": schema,
+            "dedup_radius_m": dedup_radius_m, **output_params, "ward_workers": ward_workers,
+            "ea_index_cache": ea_index_cache, "ea_raster_resolution": ea_raster_resolution,
+            "incremental": incremental,
+            "buildings_batch_size": buildings_batch_size, "rollup_store": rollup_store,
+            "run_journal": run_journal, "progress_lookback_hours": progress_lookback_hours, **report_params}
 
 
 def main():
@@ -227,7 +945,7 @@ def main():
     # ====================================================================
     # PREPARE INPUT PATH (RAW CSVS) AND OUTPUT PATH (EA_DEMARCATION)
     # ====================================================================
-    # please edit the path accordingly
+    # please edit the path accordingly, to process all districts in one run see scheduler.py
     working_dir = Path.cwd().parents[1]
     raw_csv_dir = working_dir.joinpath("data", "lusakaProvince", "listingRawFiles")
     csv_filename = raw_csv_dir.joinpath("Lusaka_District.csv")
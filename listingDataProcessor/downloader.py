@@ -1,3 +1,363 @@
 """
 This module contains scripts for automatically downloading data fromm Survey solutions
-"""
\ No newline at end of file
+"""
+import base64
+import hashlib
+import json
+import os
+import time
+import traceback
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# saved while an export is being downloaded so that a restarted run resumes it
+EXPORT_JOB_FILENAME = "export_job.json"
+
+
+def create_session(user, password, pool_size):
+    """
+    Returns a requests session with pooled connections and retries on
+    transient errors, shared by all download threads
+    :param user, password: Survey Solutions API user credentials
+    :param pool_size: number of pooled connections, same as number of download threads
+    :return:
+    """
+    session = requests.Session()
+    session.auth = (user, password)
+    retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def file_sha256(path):
+    """
+    Returns SHA256 checksum of a file
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def reported_sha256(headers):
+    """
+    Returns SHA256 checksum of the whole file reported by the server (Repr-Digest or Digest
+    header, which describe the whole file even for a Range request), None if it reports none
+    """
+    for header in ["Repr-Digest", "Digest"]:
+        for digest in headers.get(header, "").split(","):
+            algorithm, _, value = digest.strip().partition("=")
+            if algorithm.lower() == "sha-256" and value:
+                return base64.b64decode(value.strip(":")).hex()
+
+    return None
+
+
+def stream_to_file(session, url, output_file, timeout=60, chunk_size=1 << 20):
+    """
+    Streams a download to disk, bytes are written to <output_file>.part and
+    an interrupted download is resumed from where it stopped (HTTP Range request).
+    Name output_file after what is downloaded (e.g., the export job) so that a partly
+    downloaded file is never resumed from another one
+    :param session: requests session
+    :param url: URL of file
+    :param output_file: full path of downloaded file
+    :param timeout: seconds to wait for server
+    :param chunk_size: bytes written at a time
+    :return: SHA256 checksum of downloaded file, also saved as <output_file>.sha256. It is checked
+     against the checksum reported by the server if there is one (see reported_sha256)
+    """
+    part_file = "{}.part".format(output_file)
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+
+    expected_checksum = None
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if offset and r.status_code == 416:
+            # nothing left to download
+            pass
+        else:
+            r.raise_for_status()
+            if r.status_code != 206:
+                # server ignored the Range header, start over
+                offset = 0
+            expected_checksum = reported_sha256(r.headers)
+            expected_size = None
+            if "Content-Length" in r.headers:
+                expected_size = offset + int(r.headers["Content-Length"])
+
+            with open(part_file, "ab" if offset else "wb") as f:
+                for block in r.iter_content(chunk_size=chunk_size):
+                    f.write(block)
+
+            if expected_size is not None and os.path.getsize(part_file) != expected_size:
+                raise IOError("Incomplete download of {}: {} of {} bytes".format(
+                    url, os.path.getsize(part_file), expected_size))
+
+    checksum = file_sha256(part_file)
+    if expected_checksum is not None and checksum != expected_checksum:
+        # resuming a corrupt file would never match, the next try starts over
+        os.remove(part_file)
+        raise IOError("Checksum of {} doesn't match the server's: {} instead of {}".format(
+            url, checksum, expected_checksum))
+
+    os.replace(part_file, output_file)
+    with open("{}.sha256".format(output_file), "w") as f:
+        f.write(checksum)
+
+    return checksum
+
+
+def is_downloaded(output_file):
+    """
+    Checks whether a file was completely downloaded and is unchanged since (matches its checksum)
+    """
+    checksum_file = "{}.sha256".format(output_file)
+    if not (os.path.exists(output_file) and os.path.exists(checksum_file)):
+        return False
+    with open(checksum_file) as f:
+        return f.read().strip() == file_sha256(output_file)
+
+
+def remove_download(output_file):
+    """
+    Removes a downloaded file with its checksum and partly downloaded file
+    """
+    for f in [output_file, "{}.sha256".format(output_file), "{}.part".format(output_file)]:
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def tab_to_csv(tab_file, csv_file, chunksize=100000):
+    """
+    Survey Solutions tabular exports are tab separated, converts them
+    to the CSV files expected by DataProcessor in chunks
+    """
+    reader = pd.read_csv(tab_file, sep="\t", chunksize=chunksize, dtype=str, keep_default_na=False)
+    for i, chunk in enumerate(reader):
+        chunk.to_csv(csv_file, index=False, mode="a" if i else "w", header=not i)
+
+
+class ExportDownloader:
+    """
+    Requests Survey Solutions exports for several questionnaires (e.g., one per district)
+    concurrently and downloads them to raw_csv_dir
+    """
+
+    def __init__(self, base_url, workspace, user, password, raw_csv_dir, max_workers=4,
+                 poll_interval=10, export_timeout=3600, export_type="Tabular", interview_status="All"):
+        """
+
+        :param base_url: Survey Solutions server URL (e.g., https://mycensus.mysurvey.solutions)
+        :param workspace: Survey Solutions workspace (e.g., primary)
+        :param user: API user
+        :param password: API user password
+        :param raw_csv_dir: Directory to save raw CSVs to
+        :param max_workers: number of exports requested and downloaded concurrently
+        :param poll_interval: seconds between checks of export progress
+        :param export_timeout: seconds to wait for an export to be generated
+        :param export_type: Survey Solutions export type
+        :param interview_status: Survey Solutions interview status to export
+        """
+        self.base_url = base_url.rstrip("/")
+        self.workspace = workspace
+        self.raw_csv_dir = Path(raw_csv_dir)
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.export_timeout = export_timeout
+        self.export_type = export_type
+        self.interview_status = interview_status
+        self.session = create_session(user, password, pool_size=max_workers)
+
+    def export_url(self, *parts):
+        """
+        Returns URL of export API endpoint
+        """
+        return "/".join([self.base_url, self.workspace, "api", "v2", "export"] + [str(p) for p in parts])
+
+    def start_export(self, questionnaire_id):
+        """
+        Requests a new export, returns its job ID
+        :param questionnaire_id: questionnaire identity (<guid>$<version>)
+        """
+        body = {"ExportType": self.export_type, "QuestionnaireId": questionnaire_id,
+                "InterviewStatus": self.interview_status}
+        r = self.session.post(self.export_url(), json=body, timeout=60)
+        r.raise_for_status()
+
+        return r.json()["JobId"]
+
+    def wait_for_export(self, job_id):
+        """
+        Polls an export job until its file is ready
+        """
+        start = time.time()
+        while True:
+            r = self.session.get(self.export_url(job_id), timeout=60)
+            r.raise_for_status()
+            status = r.json()
+            if status.get("ExportStatus") == "Completed" and status.get("HasExportFile"):
+                return
+            if status.get("ExportStatus") in ["Fail", "Canceled"]:
+                raise RuntimeError("Export job {} failed with status {}".format(job_id, status.get("ExportStatus")))
+            if time.time() - start > self.export_timeout:
+                raise TimeoutError("Export job {} not ready after {} seconds".format(job_id, self.export_timeout))
+            time.sleep(self.poll_interval)
+
+    def district_dir(self, job):
+        return self.raw_csv_dir.joinpath(job["province"], job["district"])
+
+    def interrupted_job(self, job):
+        """
+        Returns job ID of the export a previous run requested for a district but didn't finish
+        unpacking, None if there is none
+        """
+        job_file = self.district_dir(job).joinpath(EXPORT_JOB_FILENAME)
+        if not job_file.exists():
+            return None
+        with open(job_file) as f:
+            saved = json.load(f)
+        if saved.get("questionnaire_id") != job["questionnaire_id"]:
+            return None
+
+        return saved["job_id"]
+
+    def download(self, job):
+        """
+        Requests a new export for one district, downloads and unpacks it. The export job ID is
+        saved until the export is unpacked so that a restarted run resumes the same export rather
+        than requesting another one. The archive is named after the job, downloads of other
+        jobs left by interrupted runs are removed rather than resumed
+        :param job: dict with province, district, questionnaire_id and optionally main_file
+         (name of main data file in export archive, defaults to the largest file)
+        :return: full path of raw CSV file for the district
+        """
+        out_dir = self.district_dir(job)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        csv_file = self.raw_csv_dir.joinpath("{}_District.csv".format(job["district"].title()))
+        job_file = out_dir.joinpath(EXPORT_JOB_FILENAME)
+
+        job_id = self.interrupted_job(job)
+        if job_id is None:
+            job_id = self.start_export(job["questionnaire_id"])
+            with open(job_file, "w") as f:
+                json.dump({"questionnaire_id": job["questionnaire_id"], "job_id": job_id}, f)
+        archive = out_dir.joinpath("{}_export_{}.zip".format(job["district"], job_id))
+        for f in out_dir.glob("{}_export*.zip*".format(job["district"])):
+            if not f.name.startswith(archive.name):
+                f.unlink()
+
+        if not is_downloaded(archive):
+            self.wait_for_export(job_id)
+            stream_to_file(self.session, self.export_url(job_id, "file"), archive)
+
+        # =============================
+        # Unpack and find main data file
+        # =============================
+        with zipfile.ZipFile(archive) as z:
+            bad_member = z.testzip()
+            if bad_member is not None:
+                remove_download(archive)
+                raise IOError("Corrupt file {} in export archive {}".format(bad_member, archive))
+            z.extractall(out_dir)
+            members = [m for m in z.infolist() if not m.is_dir()]
+        if job.get("main_file"):
+            main_file = out_dir.joinpath(job["main_file"])
+        else:
+            main_file = out_dir.joinpath(max(members, key=lambda m: m.file_size).filename)
+
+        if main_file.suffix == ".tab":
+            tab_to_csv(main_file, csv_file)
+        else:
+            os.replace(main_file, csv_file)
+
+        remove_download(archive)
+        job_file.unlink()
+
+        return csv_file
+
+    def download_job(self, job):
+        """
+        Runs download for one district and records the outcome rather than raising
+        :return: dict with province, district, csv_file, success, error, traceback and seconds
+        """
+        start = time.perf_counter()
+        result = {"province": job["province"], "district": job["district"], "csv_file": None,
+                  "success": True, "error": None, "traceback": None}
+        try:
+            result["csv_file"] = self.download(job)
+        except Exception as e:
+            result["success"] = False
+            result["error"] = repr(e)
+            result["traceback"] = traceback.format_exc()
+        result["seconds"] = time.perf_counter() - start
+
+        return result
+
+    def download_all(self, jobs):
+        """
+        Downloads exports for several districts concurrently
+        :param jobs: list of dicts (see download)
+        :return: a result per job (see download_job)
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.download_job, jobs))
+
+
+def process_downloads(results, ea_demarcation_dir, params):
+    """
+    Runs DataProcessor for each district which was downloaded successfully
+    :param results: download results (see ExportDownloader.download_all)
+    :param ea_demarcation_dir: directory with all EA demarcation
+    :param params: processing parameters (see data_processor.prepare_processing_parameters)
+    :return:
+    """
+    from data_processor import DataProcessor
+
+    for r in results:
+        if not r["success"]:
+            print("Download failed for {} district: {}\n{}".format(r["district"], r["error"], r["traceback"]))
+            continue
+        dp = DataProcessor(raw_csv_dir=r["csv_file"].parent, csv_filename=r["csv_file"],
+                           ea_demarcation_dir=ea_demarcation_dir, province=r["province"],
+                           district=r["district"], params=params)
+        dp.process_data()
+
+
+def main():
+    """
+    Download raw CSVs and run data processor
+    :return:
+    """
+    from data_processor import prepare_processing_parameters
+
+    # ====================================================================
+    # PLEASE EDIT SERVER DETAILS, PATHS AND QUESTIONNAIRES ACCORDINGLY
+    # ====================================================================
+    working_dir = Path.cwd().parents[1]
+    raw_csv_dir = working_dir.joinpath("data", "lusakaProvince", "listingRawFiles")
+    ea_demarcation_dir = working_dir.joinpath("data", "DEMARCATION_DATA")
+    jobs = [{"province": "LUSAKA", "district": "LUSAKA", "questionnaire_id": "<guid>$1"}]
+
+    downloader = ExportDownloader(base_url=os.environ["SURVEY_SOLUTIONS_URL"], workspace="primary",
+                                  user=os.environ["SURVEY_SOLUTIONS_USER"],
+                                  password=os.environ["SURVEY_SOLUTIONS_PASSWORD"],
+                                  raw_csv_dir=raw_csv_dir)
+    results = downloader.download_all(jobs)
+    process_downloads(results, ea_demarcation_dir=ea_demarcation_dir, params=prepare_processing_parameters())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,450 @@
+"""
+Spatial index over EA polygons and optional EA ID raster which are cached on disk
+next to the EA layer so that repeated point to EA assignment doesn't rebuild them
+"""
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+import shapely
+
+import storage as st
+
+# bump when the cache file layout changes so that old caches are rebuilt
+CACHE_VERSION = 1
+
+# upper bound on number of grid cells, the index cell size is increased to stay below it
+# and an EA raster with more cells isn't built (see ea_raster_or_index)
+MAX_CELLS = 4000000
+
+
+def ea_layer_hash(ea, ea_aggregation_id, crs_info):
+    """
+    Content hash of the EA layer geometries and IDs, attributes appended to the
+    EA layer (e.g., structure counts) don't change the hash
+    :param ea: EA GeoDataFrame
+    :param ea_aggregation_id: EA ID column
+    :param crs_info: CRS the index is built in
+    :return: hex digest
+    """
+    h = hashlib.sha1()
+    h.update("{}|{}|{}".format(CACHE_VERSION, ea.crs, crs_info).encode())
+    h.update(pd.util.hash_pandas_object(ea[ea_aggregation_id].astype(str), index=False).to_numpy().tobytes())
+    h.update(b"".join(shapely.to_wkb(np.asarray(ea.geometry.values))))
+
+    return h.hexdigest()
+
+
+def ea_file_signature(ea_file, ea_aggregation_id, crs_info):
+    """
+    Returns size and modification time of an EA layer file (with its sidecar files for a shapefile)
+    and how the index is built from it, a cached index with the same signature is loaded without
+    hashing the layer (see load_or_build_ea_index)
+    :param ea_file: full path of EA layer
+    :return: JSON string, None if the file doesn't exist
+    """
+    stem, ext = os.path.splitext(str(ea_file))
+    files = [stem + e for e in st.SHAPEFILE_EXTENSIONS] if ext.lower() == ".shp" else [str(ea_file)]
+    stats = [(os.path.basename(f), os.stat(f)) for f in files if os.path.exists(f)]
+    if not stats:
+        return None
+
+    return json.dumps({"version": CACHE_VERSION, "id": ea_aggregation_id, "crs": str(crs_info),
+                       "files": [[name, s.st_size, s.st_mtime_ns] for name, s in stats]})
+
+
+class EAIndex:
+    """
+    Uniform grid index over EA polygons: each grid cell lists the EAs whose
+    bounding box overlaps it. Points are looked up by cell with array indexing
+    and only the candidate EAs are tested exactly
+    """
+
+    def __init__(self, layer_hash, geometries, bounds, origin, cell_size, shape, cell_ptr, cell_eas,
+                 file_signature=None):
+        """
+        :param layer_hash: see ea_layer_hash
+        :param geometries: array of EA polygons in EA layer order
+        :param bounds: (n, 4) array of EA bounding boxes
+        :param origin: (xmin, ymin) of the grid
+        :param cell_size: grid cell size in CRS units
+        :param shape: (nx, ny) number of grid cells
+        :param cell_ptr, cell_eas: EA positions for cell i are cell_eas[cell_ptr[i]:cell_ptr[i + 1]]
+        :param file_signature: see ea_file_signature, None if the EA layer file isn't known
+        """
+        self.layer_hash = layer_hash
+        self.file_signature = file_signature
+        self.geometries = geometries
+        self.bounds = bounds
+        self.origin = origin
+        self.cell_size = cell_size
+        self.shape = shape
+        self.cell_ptr = cell_ptr
+        self.cell_eas = cell_eas
+        shapely.prepare(self.geometries)
+
+    @classmethod
+    def build(cls, ea, layer_hash, cell_size=None):
+        """
+        Builds the index from EA GeoDataFrame (already in processing CRS)
+        :param cell_size: grid cell size, defaults to median EA bounding box size
+        """
+        geometries = np.asarray(ea.geometry.values)
+        bounds = shapely.bounds(geometries)
+        xmin, ymin = np.nanmin(bounds[:, 0]), np.nanmin(bounds[:, 1])
+        xmax, ymax = np.nanmax(bounds[:, 2]), np.nanmax(bounds[:, 3])
+
+        if cell_size is None:
+            sizes = np.fmax(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1])
+            sizes = sizes[sizes > 0]
+            cell_size = float(np.median(sizes)) if sizes.size else 1.0
+        while ((xmax - xmin) // cell_size + 1) * ((ymax - ymin) // cell_size + 1) > MAX_CELLS:
+            cell_size *= 2
+        nx = int((xmax - xmin) // cell_size) + 1
+        ny = int((ymax - ymin) // cell_size) + 1
+
+        # cells overlapped by each EA bounding box
+        cells = []
+        positions = []
+        for i, (x0, y0, x1, y1) in enumerate(bounds):
+            if np.isnan(x0):
+                continue  # empty geometry
+            ix = np.arange(int((x0 - xmin) // cell_size), int((x1 - xmin) // cell_size) + 1)
+            iy = np.arange(int((y0 - ymin) // cell_size), int((y1 - ymin) // cell_size) + 1)
+            c = (iy[:, None] * nx + ix[None, :]).ravel()
+            cells.append(c)
+            positions.append(np.full(c.size, i))
+        cells = np.concatenate(cells) if cells else np.array([], dtype=np.int64)
+        positions = np.concatenate(positions) if positions else np.array([], dtype=np.int64)
+
+        order = np.argsort(cells, kind="stable")
+        cell_eas = positions[order]
+        cell_ptr = np.zeros(nx * ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=nx * ny), out=cell_ptr[1:])
+
+        return cls(layer_hash=layer_hash, geometries=geometries, bounds=bounds, origin=(xmin, ymin),
+                   cell_size=cell_size, shape=(nx, ny), cell_ptr=cell_ptr, cell_eas=cell_eas)
+
+    def candidates(self, x, y):
+        """
+        Returns (points positions, EA positions) pairs for points within EA bounding boxes
+        """
+        nx, ny = self.shape
+        ix = np.floor((x - self.origin[0]) / self.cell_size)
+        iy = np.floor((y - self.origin[1]) / self.cell_size)
+        valid = np.isfinite(ix) & np.isfinite(iy) & (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+
+        pts = np.flatnonzero(valid)
+        cells = iy[pts].astype(np.int64) * nx + ix[pts].astype(np.int64)
+        starts = self.cell_ptr[cells]
+        counts = self.cell_ptr[cells + 1] - starts
+
+        pts_idx = np.repeat(pts, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        ea_idx = self.cell_eas[np.repeat(starts, counts) + offsets]
+
+        b = self.bounds[ea_idx]
+        px, py = x[pts_idx], y[pts_idx]
+        in_box = (px >= b[:, 0]) & (px <= b[:, 2]) & (py >= b[:, 1]) & (py <= b[:, 3])
+
+        return pts_idx[in_box], ea_idx[in_box]
+
+    def query_points(self, x, y):
+        """
+        Assigns points to EAs, same as a point-in-polygon spatial join with
+        "within" predicate (points on EA boundaries aren't assigned)
+        :param x, y: arrays of point coordinates in the index CRS
+        :return: (points positions, EA positions) arrays
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        pts_idx, ea_idx = self.candidates(x, y)
+        inside = shapely.contains_xy(self.geometries[ea_idx], x[pts_idx], y[pts_idx])
+
+        return pts_idx[inside], ea_idx[inside]
+
+    def save(self, cache_file):
+        """
+        Saves the index, written to a temp file first so that a failed save
+        never leaves a corrupt cache
+        """
+        wkbs = shapely.to_wkb(self.geometries)
+        offsets = np.zeros(len(wkbs) + 1, dtype=np.int64)
+        np.cumsum([len(w) for w in wkbs], out=offsets[1:])
+
+        tmp_file = "{}.tmp".format(cache_file)
+        with open(tmp_file, "wb") as f:
+            np.savez(f, layer_hash=np.array(self.layer_hash), wkb=np.frombuffer(b"".join(wkbs), dtype=np.uint8),
+                     wkb_offsets=offsets, bounds=self.bounds, origin=np.array(self.origin),
+                     cell_size=np.array(self.cell_size), shape=np.array(self.shape),
+                     cell_ptr=self.cell_ptr, cell_eas=self.cell_eas,
+                     file_signature=np.array(self.file_signature or ""))
+        os.replace(tmp_file, cache_file)
+
+    @classmethod
+    def load(cls, cache_file, geometries=None):
+        """
+        Loads a saved index
+        :param geometries: EA polygons the index was built from (in the index CRS), the
+         saved ones are only deserialized if None
+        """
+        with np.load(cache_file) as data:
+            if geometries is None:
+                buf = data["wkb"].tobytes()
+                offsets = data["wkb_offsets"]
+                geometries = shapely.from_wkb([buf[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)])
+            file_signature = str(data["file_signature"]) if "file_signature" in data.files else ""
+            return cls(layer_hash=str(data["layer_hash"]), geometries=geometries,
+                       bounds=data["bounds"], origin=tuple(data["origin"]), cell_size=float(data["cell_size"]),
+                       shape=tuple(int(v) for v in data["shape"]), cell_ptr=data["cell_ptr"],
+                       cell_eas=data["cell_eas"], file_signature=file_signature or None)
+
+
+class EARaster:
+    """
+    EA ID raster over the EA index extent: cells fully inside one EA store its position so
+    points in them are assigned with an array lookup, only points in cells crossed by an EA
+    boundary are tested exactly (see EAIndex.query_points). The grid can be memory-mapped
+    """
+    # grid values of cells outside all EAs and of cells needing exact tests
+    OUTSIDE = -1
+    BOUNDARY = -2
+
+    def __init__(self, ea_index, grid, origin, resolution):
+        """
+        :param ea_index: EAIndex used for exact tests in boundary cells
+        :param grid: (ny, nx) int32 array of EA position, OUTSIDE or BOUNDARY per cell
+        :param origin: (xmin, ymin) of the grid
+        :param resolution: cell size in CRS units
+        """
+        self.ea_index = ea_index
+        self.grid = grid
+        self.origin = origin
+        self.resolution = resolution
+
+    @classmethod
+    def build(cls, ea_index, resolution):
+        """
+        Rasterizes the EAs of an index: the boundary of each EA is densified so that its segments
+        are shorter than a cell and the cells they cross are marked as boundary cells, the other
+        cells in the EA bounding box are inside the EA if their centre is. Cells claimed by several
+        EAs are also treated as boundary cells
+        :param ea_index: EAIndex
+        :param resolution: cell size in CRS units
+        """
+        ny, nx = cls.grid_shape(ea_index, resolution)
+        if nx * ny > MAX_CELLS:
+            raise ValueError("EA raster at resolution {} would have {} cells, more than {}".format(
+                resolution, nx * ny, MAX_CELLS))
+        bounds = ea_index.bounds
+        xmin, ymin = np.nanmin(bounds[:, 0]), np.nanmin(bounds[:, 1])
+        grid = np.full((ny, nx), cls.OUTSIDE, dtype=np.int32)
+        boundary = np.zeros((ny, nx), dtype=bool)
+        margin = resolution * 1e-6
+
+        for i, geometry in enumerate(ea_index.geometries):
+            x0, y0, x1, y1 = bounds[i]
+            if np.isnan(x0):
+                continue  # empty geometry
+            ix0, iy0 = int((x0 - xmin) // resolution), int((y0 - ymin) // resolution)
+            ix1, iy1 = int((x1 - xmin) // resolution), int((y1 - ymin) // resolution)
+
+            # cells inside the EA by their centre
+            cx = xmin + (np.arange(ix0, ix1 + 1) + 0.5) * resolution
+            cy = ymin + (np.arange(iy0, iy1 + 1) + 0.5) * resolution
+            inside = shapely.contains_xy(geometry, *np.meshgrid(cx, cy))
+            block = grid[iy0:iy1 + 1, ix0:ix1 + 1]
+            boundary[iy0:iy1 + 1, ix0:ix1 + 1] |= inside & (block != cls.OUTSIDE)
+            block[inside] = i
+
+            # cells crossed by the EA boundary: segments are shorter than a cell so each one
+            # only crosses the cells at the corners of its bounding box, padded by a margin
+            # so that rounding when looking up points never lands next to a boundary
+            vertices = shapely.get_coordinates(shapely.segmentize(shapely.boundary(geometry), resolution / 2))
+            seg_min = np.minimum(vertices[:-1], vertices[1:]) - margin
+            seg_max = np.maximum(vertices[:-1], vertices[1:]) + margin
+            for sx in (seg_min[:, 0], seg_max[:, 0]):
+                for sy in (seg_min[:, 1], seg_max[:, 1]):
+                    bx = np.clip((sx - xmin) // resolution, 0, nx - 1).astype(np.int64)
+                    by = np.clip((sy - ymin) // resolution, 0, ny - 1).astype(np.int64)
+                    boundary[by, bx] = True
+
+        grid[boundary] = cls.BOUNDARY
+
+        return cls(ea_index=ea_index, grid=grid, origin=(xmin, ymin), resolution=resolution)
+
+    @staticmethod
+    def grid_shape(ea_index, resolution):
+        """
+        Returns (ny, nx) number of cells of the raster of an index at resolution
+        """
+        bounds = ea_index.bounds
+        nx = int((np.nanmax(bounds[:, 2]) - np.nanmin(bounds[:, 0])) // resolution) + 1
+        ny = int((np.nanmax(bounds[:, 3]) - np.nanmin(bounds[:, 1])) // resolution) + 1
+
+        return ny, nx
+
+    @property
+    def layer_hash(self):
+        return self.ea_index.layer_hash
+
+    def boundary_share(self):
+        """
+        Returns share of cells which need exact tests
+        """
+        return float(np.mean(self.grid == self.BOUNDARY))
+
+    def query_points(self, x, y):
+        """
+        Assigns points to EAs, same result as EAIndex.query_points
+        :param x, y: arrays of point coordinates in the index CRS
+        :return: (points positions, EA positions) arrays sorted by point
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        ny, nx = self.grid.shape
+        ix = np.floor((x - self.origin[0]) / self.resolution)
+        iy = np.floor((y - self.origin[1]) / self.resolution)
+        valid = np.isfinite(ix) & np.isfinite(iy) & (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+
+        pts = np.flatnonzero(valid)
+        cells = self.grid[iy[pts].astype(np.int64), ix[pts].astype(np.int64)]
+        resolved = cells >= 0
+        exact = pts[cells == self.BOUNDARY]
+        exact_pts, exact_eas = self.ea_index.query_points(x[exact], y[exact])
+
+        pts_idx = np.concatenate([pts[resolved], exact[exact_pts]])
+        ea_idx = np.concatenate([cells[resolved].astype(np.int64), exact_eas])
+        # both parts are sorted by point already, a stable sort merges them
+        order = np.argsort(pts_idx, kind="stable")
+
+        return pts_idx[order], ea_idx[order]
+
+    def save(self, cache_prefix):
+        """
+        Saves the grid as <cache_prefix>.npy (memory-mappable) and its metadata as
+        <cache_prefix>.json, which is written last so that it only exists for a complete grid
+        """
+        grid_file, meta_file = raster_cache_files(cache_prefix)
+        tmp_file = "{}.tmp".format(grid_file)
+        with open(tmp_file, "wb") as f:
+            np.save(f, self.grid)
+        os.replace(tmp_file, grid_file)
+
+        meta = {"version": CACHE_VERSION, "layer_hash": self.layer_hash, "origin": list(self.origin),
+                "resolution": self.resolution, "shape": list(self.grid.shape)}
+        with open("{}.tmp".format(meta_file), "w") as f:
+            json.dump(meta, f)
+        os.replace("{}.tmp".format(meta_file), meta_file)
+
+    @classmethod
+    def load(cls, cache_prefix, ea_index, mmap=True):
+        """
+        Loads a saved grid, memory-mapped so that only the cells looked up are read
+        """
+        grid_file, meta_file = raster_cache_files(cache_prefix)
+        with open(meta_file) as f:
+            meta = json.load(f)
+        grid = np.load(grid_file, mmap_mode="r" if mmap else None)
+
+        return cls(ea_index=ea_index, grid=grid, origin=tuple(meta["origin"]), resolution=meta["resolution"])
+
+
+def raster_cache_files(cache_prefix):
+    """
+    Returns grid and metadata files of a cached EARaster
+    """
+    return "{}.npy".format(cache_prefix), "{}.json".format(cache_prefix)
+
+
+def ea_raster_or_index(ea_index, resolution):
+    """
+    Builds the EA raster of an index, or returns the index itself (points are then all
+    tested exactly) if the raster would have more than MAX_CELLS cells, e.g., a fine
+    resolution over a country
+    :param ea_index: EAIndex
+    :param resolution: cell size in CRS units
+    :return: EARaster or ea_index
+    """
+    ny, nx = EARaster.grid_shape(ea_index, resolution)
+    if nx * ny > MAX_CELLS:
+        print("EA raster at resolution {} would have {} cells, more than {}, assigning points with the "
+              "EA index only".format(resolution, nx * ny, MAX_CELLS))
+        return ea_index
+
+    return EARaster.build(ea_index, resolution)
+
+
+def load_or_build_ea_raster(cache_prefix, ea_index, resolution):
+    """
+    Loads the EA raster if it was built from the same EA layer at the same resolution,
+    otherwise it is rebuilt and saved (see ea_raster_or_index)
+    :param cache_prefix: full path of cached raster without extension (e.g., ward_dir/EA_raster)
+    :param ea_index: EAIndex of the EA layer
+    :param resolution: cell size in CRS units
+    :return: EARaster, or ea_index if the raster would be too large
+    """
+    grid_file, meta_file = raster_cache_files(cache_prefix)
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if (meta["version"] == CACHE_VERSION and meta["layer_hash"] == ea_index.layer_hash
+                and meta["resolution"] == resolution and os.path.exists(grid_file)):
+            return EARaster.load(cache_prefix, ea_index)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    raster = ea_raster_or_index(ea_index, resolution)
+    if isinstance(raster, EARaster):
+        raster.save(cache_prefix)
+
+    return raster
+
+
+def cached_value(cache_file, name):
+    """
+    Returns a value saved with an index (e.g., layer_hash) or None if there is no valid cache
+    """
+    try:
+        with np.load(cache_file) as data:
+            return str(data[name])
+    except Exception:
+        return None
+
+
+def load_or_build_ea_index(cache_file, ea, ea_aggregation_id, crs_info, ea_file=None):
+    """
+    Loads the EA index from cache_file if it was built from the same EA
+    layer, otherwise the stale cache is evicted and the index rebuilt. With ea_file, a cache
+    saved from the file with the same size and modification time is loaded without hashing the
+    layer (see ea_file_signature), a cache of a file only touched or copied is still loaded once
+    the layer hash matches and then saved with the new signature
+    :param cache_file: full path of cached index (e.g., ward_dir/EA_index.npz)
+    :param ea: EA GeoDataFrame
+    :param ea_aggregation_id: EA ID column
+    :param crs_info: CRS used in processing
+    :param ea_file: full path of the EA layer file ea was read from
+    :return: EAIndex with EAs in the same order as ea
+    """
+    # the polygons are already in memory when ea is in the index CRS
+    geometries = np.asarray(ea.geometry.values) if ea.crs == crs_info else None
+    signature = ea_file_signature(ea_file, ea_aggregation_id, crs_info) if ea_file else None
+    if signature and os.path.exists(cache_file) and cached_value(cache_file, "file_signature") == signature:
+        return EAIndex.load(cache_file, geometries=geometries)
+
+    layer_hash = ea_layer_hash(ea, ea_aggregation_id, crs_info)
+    if os.path.exists(cache_file) and cached_value(cache_file, "layer_hash") == layer_hash:
+        index = EAIndex.load(cache_file, geometries=geometries)
+        if signature:
+            index.file_signature = signature
+            index.save(cache_file)
+        return index
+
+    if ea.crs != crs_info:
+        ea = ea.to_crs(crs_info)
+    index = EAIndex.build(ea, layer_hash=layer_hash)
+    index.file_signature = signature
+    index.save(cache_file)
+
+    return index
@@ -0,0 +1,211 @@
+"""
+Ward level hand-off between stages. Processed DFs and POIs are split into a file per
+ward which the ward layers and EA attributes stages read back. The files are either:
+    - csv: <ward>_df.csv and <ward>_poi.csv text files
+    - arrow: <ward>_df.arrow and <ward>_poi.arrow Arrow IPC files, which are memory-mapped
+      when read so that columns aren't parsed or copied, and coordinates are used as float
+      arrays with point geometries only built when a stage needs them (see PointTable)
+"""
+import numpy as np
+import pyproj
+import geopandas as gpd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    # only needed for the arrow exchange format
+    pa = None
+
+EXCHANGE_FORMATS = {"csv": ".csv", "arrow": ".arrow"}
+
+
+def ward_file(ward_dir, suffix, exchange_format="csv"):
+    """
+    Returns the DF or POIs file of a ward
+    :param ward_dir: ward directory
+    :param suffix: either df or poi
+    :param exchange_format: one of EXCHANGE_FORMATS
+    :return:
+    """
+    if exchange_format not in EXCHANGE_FORMATS:
+        raise ValueError("Unknown exchange format {}, use one of {}".format(exchange_format,
+                                                                           list(EXCHANGE_FORMATS)))
+    ward_name = ward_dir.parts[-1]
+
+    return ward_dir.joinpath("{}_{}{}".format(ward_name, suffix, EXCHANGE_FORMATS[exchange_format]))
+
+
+def to_arrow(df):
+    """
+    Converts a data frame to an Arrow table which can be written in batches to one file:
+    categoricals are saved as their values (each batch would have its own dictionary)
+    and all missing columns as text
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False).replace_schema_metadata(None)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(field.type.value_type))
+        elif pa.types.is_null(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.string()))
+
+    return table
+
+
+def conform(table, schema):
+    """
+    Returns an Arrow table with the columns of schema in the same order and cast to its types,
+    columns the table doesn't have are missing values
+    """
+    columns = [table.column(field.name) if field.name in table.column_names else pa.nulls(len(table), field.type)
+               for field in schema]
+
+    return pa.Table.from_arrays(columns, names=schema.names).cast(schema)
+
+
+class ArrowWardWriters:
+    """
+    Keeps an Arrow IPC file writer open per ward file so that processed rows can be
+    added chunk by chunk (see utils.partition_by_ward), files are complete once closed
+    """
+
+    def __init__(self):
+        if pa is None:
+            raise ImportError("pyarrow is needed for the arrow exchange format")
+        self.writers = {}
+        self.schemas = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, path, df):
+        """
+        Adds rows of a data frame to a ward file, column types of later rows are
+        widened if they don't match those already written (e.g., counts which didn't
+        fit the schema dtype in one chunk), columns missing from either are missing values
+        """
+        table = to_arrow(df)
+        writer = self.writers.get(path)
+        if writer is None:
+            writer = self.open(path, table.schema)
+        elif not table.schema.equals(self.schemas[path]):
+            if not set(table.column_names) <= set(self.schemas[path].names):
+                writer = self.widen(path, table.schema)
+            try:
+                table = conform(table, self.schemas[path])
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                writer = self.widen(path, table.schema)
+                table = conform(table, self.schemas[path])
+        writer.write_table(table)
+
+    def open(self, path, schema):
+        writer = pa.ipc.new_file(str(path), schema)
+        self.writers[path] = writer
+        self.schemas[path] = schema
+
+        return writer
+
+    def widen(self, path, schema):
+        """
+        Rewrites rows already saved to a ward file with column types which also fit schema,
+        columns of schema which weren't saved yet are added with missing values
+        """
+        self.writers.pop(path).close()
+        # read into memory rather than memory-mapped since the file is replaced
+        written = read_table(path, memory_map=False)
+        written = conform(written, pa.unify_schemas([written.schema, schema], promote_options="permissive"))
+        writer = self.open(path, written.schema)
+        writer.write_table(written)
+
+        return writer
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        self.schemas = {}
+
+
+def read_table(path, columns=None, memory_map=True):
+    """
+    Reads an Arrow IPC file
+    :param columns: columns to load, None loads all
+    :param memory_map: columns are views of the memory-mapped file rather than copies
+    """
+    source = pa.memory_map(str(path)) if memory_map else pa.OSFile(str(path))
+    table = pa.ipc.open_file(source).read_all()
+
+    return table if columns is None else table.select(list(columns))
+
+
+def read_points(path, lon, lat, crs, columns=None):
+    """
+    Reads a ward Arrow file as points (see PointTable)
+    :param lon, lat: longitude and latitude columns
+    :param crs: CRS of the coordinates
+    :param columns: attribute columns to load, None loads all
+    :return: PointTable
+    """
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + [lon, lat]))
+    table = read_table(path, columns=columns)
+
+    return PointTable(table, column_values(table, lon), column_values(table, lat), crs)
+
+
+def column_values(table, col):
+    """
+    Returns a numeric column of an Arrow table as a float array, missing values as NaN,
+    no copy is made for a float64 column without missing values saved as a single batch
+    """
+    column = table.column(col)
+    if column.num_chunks == 1:
+        column = column.chunk(0)
+    values = column.cast(pa.float64()).to_numpy(zero_copy_only=False)
+
+    return np.asarray(values, dtype=float)
+
+
+class PointTable:
+    """
+    Points as an Arrow table of attributes and x and y coordinate arrays, the point
+    geometries are only built when needed (e.g., to save a layer)
+    """
+
+    def __init__(self, table, x, y, crs):
+        self.table = table
+        self.x = x
+        self.y = y
+        self.crs = pyproj.CRS.from_user_input(crs)
+        self._geometry = None
+
+    def __len__(self):
+        return len(self.x)
+
+    def values(self, col):
+        """
+        Returns a numeric attribute as a float array (see column_values)
+        """
+        return column_values(self.table, col)
+
+    def to_crs(self, crs):
+        """
+        Returns points with coordinates transformed to crs, attributes are shared
+        """
+        crs = pyproj.CRS.from_user_input(crs)
+        if crs == self.crs:
+            return self
+        x, y = pyproj.Transformer.from_crs(self.crs, crs, always_xy=True).transform(self.x, self.y)
+
+        return PointTable(self.table, np.asarray(x), np.asarray(y), crs)
+
+    @property
+    def geometry(self):
+        if self._geometry is None:
+            self._geometry = gpd.GeoSeries(gpd.points_from_xy(self.x, self.y), crs=self.crs)
+        return self._geometry
+
+    def to_geodataframe(self):
+        return gpd.GeoDataFrame(self.table.to_pandas(), geometry=self.geometry)
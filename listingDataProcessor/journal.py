@@ -0,0 +1,117 @@
+"""
+Run journal so that a district run which crashed or was killed resumes from the last
+completed unit (a district level stage or a stage of one ward) rather than starting over.
+Each completed unit is appended to <district dir>/.journal/journal.jsonl and its result is
+saved next to it, a restarted run with the same raw CSV file and parameters loads those
+results instead of running the units again
+"""
+import json
+import os
+import pickle
+import shutil
+import time
+
+JOURNAL_DIRNAME = ".journal"
+
+JOURNAL_FILENAME = "journal.jsonl"
+
+
+class RunJournal:
+    """
+    Journal of a district directory, only paths are kept in memory so that it can be
+    passed to ward jobs running in other processes which record their own units
+    """
+
+    def __init__(self, dir_with_ward_subdirs):
+        self.journal_dir = os.path.join(str(dir_with_ward_subdirs), JOURNAL_DIRNAME)
+        self.journal_file = os.path.join(self.journal_dir, JOURNAL_FILENAME)
+
+    def entries(self):
+        """
+        Returns journal entries, a partly written last line (crash while appending) is ignored
+        """
+        if not os.path.exists(self.journal_file):
+            return []
+        entries = []
+        with open(self.journal_file) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+
+        return entries
+
+    def start(self, fingerprint):
+        """
+        Resumes the last run if it didn't finish and has the same fingerprint, otherwise starts a new run
+        :param fingerprint: identifies the run inputs (e.g., raw CSV file and parameters)
+        :return: True if the last run is resumed
+        """
+        entries = self.entries()
+        if entries and entries[0].get("fingerprint") == fingerprint and entries[-1]["event"] != "finished":
+            self.append({"event": "resumed"})
+            return True
+
+        shutil.rmtree(self.journal_dir, ignore_errors=True)
+        os.makedirs(self.journal_dir)
+        self.append({"event": "started", "fingerprint": fingerprint})
+
+        return False
+
+    def append(self, entry):
+        """
+        Appends an entry, flushed to disk before returning
+        """
+        entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), **entry}
+        with open(self.journal_file, "a") as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def result_file(self, stage, ward=None):
+        name = stage if ward is None else "{}__{}".format(stage, ward)
+        return os.path.join(self.journal_dir, "{}.pkl".format(name))
+
+    def record(self, stage, result, ward=None):
+        """
+        Saves the result of a completed unit and then appends it to the journal
+        :param stage: stage name
+        :param result: value to return for the unit when the run is resumed
+        :param ward: ward name, None for district level stages
+        """
+        path = self.result_file(stage, ward)
+        tmp_file = "{}.tmp".format(path)
+        with open(tmp_file, "wb") as f:
+            pickle.dump(result, f)
+        os.replace(tmp_file, path)
+        self.append({"event": "completed", "stage": stage, "ward": ward})
+
+    def completed(self, stage, ward=None):
+        """
+        Returns the result recorded for a unit or None if it hasn't completed
+        """
+        done = any(e["event"] == "completed" and e["stage"] == stage and e["ward"] == ward for e in self.entries())
+        if not done:
+            return None
+        with open(self.result_file(stage, ward), "rb") as f:
+            return pickle.load(f)
+
+    def completed_wards(self, stage):
+        """
+        Returns results recorded for wards in a ward level stage by ward name
+        """
+        wards = [e["ward"] for e in self.entries() if e["event"] == "completed" and e["stage"] == stage
+                 and e["ward"] is not None]
+        results = {}
+        for w in wards:
+            with open(self.result_file(stage, w), "rb") as f:
+                results[w] = pickle.load(f)
+
+        return results
+
+    def finish(self):
+        """
+        Marks the run as finished, the next run starts over
+        """
+        self.append({"event": "finished"})
@@ -0,0 +1,146 @@
+"""
+Content hash manifest used to only reprocess wards whose inputs changed
+"""
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+import exchange as ex
+
+# bump when processing logic changes so that all wards are rebuilt
+MANIFEST_VERSION = 3
+
+MANIFEST_FILENAME = "processing_manifest.json"
+
+SHAPEFILE_EXTENSIONS = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
+
+# parameters which only change how processing runs and not its outputs. chunk_size and memory_budget_mb
+# aren't: a coordinates column is parsed by pandas in chunks where some values need repairing and by
+# Arrow in others, which may differ in the last digit, so changing either rebuilds all wards
+EXECUTION_PARAMS = ["save_tmp_csv", "ward_csv_writers", "ward_workers", "incremental",
+                    "run_report", "profile_stages", "buildings_batch_size", "ea_raster_resolution",
+                    "rollup_store", "ward_exchange_format", "run_journal",
+                    "write_queue_size", "progress_lookback_hours"]
+
+
+def file_hash(path, h=None):
+    """
+    Hashes file content, a shapefile is hashed together with its sidecar files
+    :param path: full path of file
+    :param h: hashlib object to update, a new one is created if None
+    :return: hex digest or None if file doesn't exist
+    """
+    path = str(path)
+    files = [path]
+    stem, ext = os.path.splitext(path)
+    if ext.lower() == ".shp":
+        files = [stem + e for e in SHAPEFILE_EXTENSIONS]
+
+    h = h or hashlib.sha1()
+    found = False
+    for f in files:
+        if not os.path.exists(f):
+            continue
+        found = True
+        with open(f, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                h.update(block)
+
+    return h.hexdigest() if found else None
+
+
+def table_hash(path, h=None):
+    """
+    Hashes rows of a ward CSV or Arrow file column by column, unlike the file's bytes this doesn't
+    depend on how rows were split into chunks or record batches when the file was written. Numbers
+    are hashed as floats since a column's type is inferred chunk by chunk (see csv_reader.infer_numbers)
+    :param path: full path of file
+    :param h: hashlib object to update, a new one is created if None
+    :return: hex digest or None if file doesn't exist
+    """
+    if not os.path.exists(path):
+        return None
+
+    h = h or hashlib.sha1()
+    if str(path).endswith(ex.EXCHANGE_FORMATS["arrow"]):
+        table = ex.read_table(path)
+        columns = ((name, table.column(name).to_pandas()) for name in table.column_names)
+    else:
+        columns = pd.read_csv(path).items()
+    for name, values in columns:
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            values = values.astype("float64")
+        h.update(name.encode())
+        h.update(pd.util.hash_pandas_object(values, index=False).to_numpy().tobytes())
+
+    return h.hexdigest()
+
+
+def params_hash(params):
+    """
+    Hashes processing parameters (see prepare_processing_parameters) which affect outputs
+    """
+    relevant = {k: v for k, v in params.items() if k not in EXECUTION_PARAMS}
+    dumped = json.dumps(relevant, sort_keys=True, default=str)
+
+    return hashlib.sha1("{}|{}".format(MANIFEST_VERSION, dumped).encode()).hexdigest()
+
+
+def load_manifest(dir_with_ward_subdirs):
+    """
+    Returns manifest saved in district directory or an empty one
+    """
+    manifest_file = dir_with_ward_subdirs.joinpath(MANIFEST_FILENAME)
+    if manifest_file.exists():
+        try:
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                return manifest
+        except ValueError:
+            print("Ignoring corrupt manifest {}".format(manifest_file))
+
+    return {"version": MANIFEST_VERSION, "wards": {}}
+
+
+def save_manifest(dir_with_ward_subdirs, manifest):
+    """
+    Saves manifest to district directory through a temp file so that an
+    interrupted save doesn't corrupt it
+    """
+    manifest_file = dir_with_ward_subdirs.joinpath(MANIFEST_FILENAME)
+    tmp_file = "{}.tmp".format(manifest_file)
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def ward_input_hashes(input_files, params):
+    """
+    Hashes a ward's inputs, rows of ward CSV or Arrow files (see table_hash) and bytes of other files
+    :param input_files: dict of input name (e.g., df, poi, ea, buildings) to full path
+    :param params: processing parameters
+    :return: dict of input name to hash
+    """
+    ward_file_suffixes = tuple(ex.EXCHANGE_FORMATS.values())
+    hashes = {name: table_hash(f) if str(f).endswith(ward_file_suffixes) else file_hash(f)
+              for name, f in input_files.items()}
+    hashes["params"] = params_hash(params)
+
+    return hashes
+
+
+def ward_is_up_to_date(manifest, ward_name, hashes):
+    """
+    Checks whether a ward was processed with exactly the same inputs
+    """
+    return manifest["wards"].get(ward_name) == hashes
+
+
+def record_ward(manifest, ward_name, hashes):
+    """
+    Records the inputs a ward was successfully processed with
+    """
+    manifest["wards"][ward_name] = hashes
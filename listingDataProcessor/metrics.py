@@ -0,0 +1,236 @@
+"""
+Stage level instrumentation: wall and CPU time, peak memory, bytes read and written
+and counts (e.g., rows in and out) for each stage and ward, saved as JSON and CSV run reports
+"""
+import cProfile
+import datetime
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """
+    Returns peak resident memory of this process since start or since last reset_peak_rss
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1024 ** 2 if sys.platform == "darwin" else 1024
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+
+
+# StageTimers started and not stopped yet, outermost first
+running_timers = []
+
+
+def reset_peak_rss():
+    """
+    Resets peak resident memory so that it can be measured per stage (Linux only), the peak so far
+    is kept by running StageTimers so that a timer started within another (e.g., per ward within a
+    stage) doesn't hide the outer one's peak
+    """
+    if running_timers:
+        peak = peak_rss_mb()
+        for timer in running_timers:
+            timer.peak_rss = max_or_none(timer.peak_rss, peak)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def io_counters():
+    """
+    Returns bytes read and written by this process so far (Linux only)
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def max_or_none(a, b):
+    """
+    Returns the larger of two values either of which may be None
+    """
+    if a is None or b is None:
+        return b if a is None else a
+    return max(a, b)
+
+
+class StageTimer:
+    """
+    Measures wall time, CPU time, peak memory and I/O of the current process between start and stop,
+    timers may be nested (see reset_peak_rss)
+    """
+
+    def __init__(self):
+        self.peak_rss = None
+        reset_peak_rss()
+        running_timers.append(self)
+        self.read_start, self.written_start = io_counters()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def stop(self):
+        """
+        :return: dict with wall_seconds, cpu_seconds, peak_rss_mb, bytes_read and bytes_written
+        """
+        read, written = io_counters()
+        if self in running_timers:
+            running_timers.remove(self)
+        self.peak_rss = max_or_none(self.peak_rss, peak_rss_mb())
+        return {"wall_seconds": time.perf_counter() - self.wall_start,
+                "cpu_seconds": time.process_time() - self.cpu_start,
+                "peak_rss_mb": self.peak_rss,
+                "bytes_read": None if read is None else read - self.read_start,
+                "bytes_written": None if written is None else written - self.written_start}
+
+
+def counts_from_value(value):
+    """
+    Returns numeric counts from a stage return value (dict), lists are counted
+    """
+    counts = {}
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if isinstance(v, (list, tuple, set)):
+                counts[k] = len(v)
+            elif isinstance(v, (int, float)) and not isinstance(v, bool):
+                counts[k] = v
+
+    return counts
+
+
+def match_rates(counts):
+    """
+    Returns <layer>_match_rate for each pair of <layer>_points and <layer>_matched counts
+    (e.g., share of points joined to an EA)
+    """
+    rates = {}
+    for k, v in counts.items():
+        if k.endswith("_points"):
+            layer = k[:-len("_points")]
+            matched = counts.get("{}_matched".format(layer))
+            if matched is not None:
+                rates["{}_match_rate".format(layer)] = matched / v if v else None
+
+    return rates
+
+
+def add_counts(stats, **counts):
+    """
+    Adds counts to a stats dict (e.g., when processing in chunks), does nothing if stats is None
+    """
+    if stats is None:
+        return
+    for k, v in counts.items():
+        stats[k] = stats.get(k, 0) + v
+
+
+class RunReport:
+    """
+    Collects a record per stage and per ward within ward level stages
+    """
+
+    def __init__(self, profile_stages=None, profile_file_prefix=None):
+        """
+        :param profile_stages: stage names to run under cProfile
+        :param profile_file_prefix: path prefix for cProfile dumps, saved as <prefix>_<stage>.prof
+         or <prefix>_<stage>_<ward>.prof
+        """
+        self.profile_stages = set(profile_stages or [])
+        self.profile_file_prefix = profile_file_prefix
+        self.started = datetime.datetime.now().isoformat(timespec="seconds")
+        self.records = []
+
+    def profile_prefix(self, stage):
+        """
+        Returns cProfile dump file path without extension if the stage is profiled, otherwise None
+        """
+        if stage not in self.profile_stages or self.profile_file_prefix is None:
+            return None
+
+        return "{}_{}".format(self.profile_file_prefix, stage)
+
+    @contextmanager
+    def stage(self, stage, profile=True, **fields):
+        """
+        Measures a district level stage, counts can be added to the record yielded
+        :param stage: stage name
+        :param profile: run under cProfile if the stage is profiled, ward level stages
+         profile each ward instead (see parallel.run_ward_job)
+        :param fields: other fields for the record (e.g., district)
+        """
+        record = {"stage": stage, "ward": None, "success": True, **fields}
+        profile_prefix = self.profile_prefix(stage) if profile else None
+        profiler = cProfile.Profile() if profile_prefix else None
+        timer = StageTimer()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        except Exception:
+            record["success"] = False
+            raise
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats("{}.prof".format(profile_prefix))
+            record.update(timer.stop())
+            self.records.append(record)
+
+    def add_ward_results(self, stage, results, **fields):
+        """
+        Adds a record per ward from ward level stage results (see parallel.run_ward_job)
+        """
+        for r in results:
+            record = {"stage": stage, "ward": r["ward"], "success": r["success"], "error": r["error"], **fields}
+            record.update({k: r.get(k) for k in ["wall_seconds", "cpu_seconds", "peak_rss_mb",
+                                                 "bytes_read", "bytes_written"]})
+            counts = counts_from_value(r["value"])
+            record.update(counts)
+            record.update(match_rates(counts))
+            self.records.append(record)
+
+    def to_frame(self):
+        return pd.DataFrame(self.records)
+
+    def slowest_wards(self, n=5):
+        """
+        Returns the n slowest ward records across ward level stages
+        """
+        df = self.to_frame()
+        if df.empty or "ward" not in df.columns:
+            return df
+        return df[df["ward"].notna()].nlargest(n, "wall_seconds")
+
+    def save(self, json_file, csv_file=None):
+        """
+        Saves records as JSON (with run start time) and optionally as CSV
+        """
+        with open(json_file, "w") as f:
+            json.dump({"started": self.started, "records": self.records}, f, indent=2, default=str)
+        if csv_file:
+            self.to_frame().to_csv(csv_file, index=False)
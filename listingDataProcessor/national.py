@@ -0,0 +1,84 @@
+"""
+Out-of-core national mode: aggregates building footprints at EA level for a whole
+province or country. Footprint layers at that scale don't fit in memory, so buildings
+are streamed in batches through a prebuilt EA lookup and counts are accumulated per EA,
+e.g.
+
+    python national.py --ea EA_NATIONAL.shp --buildings BUILDINGS_NATIONAL.parquet --output ea_buildings.csv
+"""
+import argparse
+import os
+
+import pandas as pd
+
+import utils as ut
+import storage as st
+import ea_index as eai
+from data_processor import prepare_processing_parameters
+
+
+def count_buildings_by_ea(ea_file, buildings_file, ea_aggregation_id, crs_info, batch_size=500000,
+                          value_col='n_HH', cache_file=None, raster_resolution=None, stats=None):
+    """
+    Sums building footprints points per EA without loading all buildings at once,
+    memory is bounded by the number of EAs and batch_size
+    :param ea_file: EA layer (province or country level)
+    :param buildings_file: building footprints points layer (GeoParquet or any format GDAL reads)
+    :param ea_aggregation_id: EA column for aggregating attributes
+    :param crs_info: CRS being used in this processing (WGS84)
+    :param batch_size: number of buildings held in memory at a time
+    :param value_col: buildings column summed per EA
+    :param cache_file: cache the EA lookup (see ea_index.load_or_build_ea_index), None builds it in memory
+    :param raster_resolution: also use an EA ID raster with this cell size (see ea_index.EARaster),
+     cached next to cache_file, unless it would have more than ea_index.MAX_CELLS cells
+    :param stats: dict to add number of buildings and buildings matched to an EA to
+    :return: data frame with ea_aggregation_id and StructCntBlds, one row per EA
+    """
+    ea = st.read_file(ea_file, columns=[ea_aggregation_id])
+    if ea.crs != crs_info:
+        ea = ea.to_crs(crs_info)
+    if cache_file:
+        ea_index = eai.load_or_build_ea_index(cache_file, ea=ea, ea_aggregation_id=ea_aggregation_id,
+                                              crs_info=crs_info, ea_file=ea_file)
+        if raster_resolution:
+            ea_index = eai.load_or_build_ea_raster(os.path.splitext(cache_file)[0] + "_raster",
+                                                   ea_index=ea_index, resolution=raster_resolution)
+    else:
+        ea_index = eai.EAIndex.build(ea, layer_hash=None)
+        if raster_resolution:
+            ea_index = eai.ea_raster_or_index(ea_index, raster_resolution)
+
+    batches = st.iter_file_batches(buildings_file, columns=[value_col], batch_size=batch_size)
+    totals = ut.sum_point_batches_by_ea(ea, batches, value_col, crs_info, ea_index=ea_index, stats=stats)
+
+    df = pd.DataFrame({ea_aggregation_id: ea[ea_aggregation_id].to_numpy(), 'StructCntBlds': totals})
+
+    return df.groupby(ea_aggregation_id, sort=False).sum().reset_index()
+
+
+def main():
+    params = prepare_processing_parameters()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ea", required=True, help="EA layer")
+    parser.add_argument("--buildings", required=True, help="building footprints points layer")
+    parser.add_argument("--output", required=True, help="CSV file to save counts per EA to")
+    parser.add_argument("--batch-size", type=int, default=500000)
+    parser.add_argument("--value-col", default="n_HH")
+    parser.add_argument("--cache-file", default=None, help="file to cache EA lookup in (.npz)")
+    parser.add_argument("--raster-resolution", type=float, default=None,
+                        help="cell size of EA ID raster in CRS units, see ea_index.EARaster, the EA index "
+                             "alone is used if the raster would have more than ea_index.MAX_CELLS cells")
+    args = parser.parse_args()
+
+    stats = {}
+    df = count_buildings_by_ea(args.ea, args.buildings, ea_aggregation_id=params['ea_aggregation_id'],
+                               crs_info=params['crs'], batch_size=args.batch_size, value_col=args.value_col,
+                               cache_file=args.cache_file, raster_resolution=args.raster_resolution,
+                               stats=stats)
+    df.to_csv(args.output, index=False)
+    print("{} of {} buildings matched to {} EAs".format(stats.get("bld_matched", 0), stats.get("bld_points", 0),
+                                                        len(df)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Runs independent ward level processing jobs, optionally in a pool of processes
+"""
+import cProfile
+import heapq
+import itertools
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics as mt
+import writer as wr
+
+
+def run_job(func, args=(), kwargs=None, profile_file=None):
+    """
+    Runs func and records the outcome rather than raising
+    :param func: module level function or method of a picklable object, called as func(*args, **kwargs)
+    :param profile_file: if given, func runs under cProfile dumped to this file
+    :return: dict with success, error, traceback, value returned by func and
+     timings (see metrics.StageTimer)
+    """
+    result = {"success": True, "error": None, "traceback": None, "value": None}
+    profiler = cProfile.Profile() if profile_file else None
+    timer = mt.StageTimer()
+    try:
+        if profiler:
+            result["value"] = profiler.runcall(func, *args, **(kwargs or {}))
+        else:
+            result["value"] = func(*args, **(kwargs or {}))
+    except Exception as e:
+        result["success"] = False
+        result["error"] = repr(e)
+        result["traceback"] = traceback.format_exc()
+    finally:
+        # also stopped when interrupted so that it isn't left running (see metrics.reset_peak_rss)
+        result.update(timer.stop())
+    if profiler:
+        profiler.dump_stats(profile_file)
+
+    return result
+
+
+def run_ward_job(func, ward_dir, kwargs, profile_file_prefix=None, journal=None, stage=None, writer=None):
+    """
+    Runs func for a single ward and records the outcome rather than raising
+    :param func: module level function or method of a picklable object, called as func(ward_dir, **kwargs)
+    :param ward_dir: ward directory
+    :param kwargs: other keyword arguments for func
+    :param profile_file_prefix: if given, func runs under cProfile dumped to <prefix>_<ward>.prof
+    :param journal: journal.RunJournal to record the result in as soon as the ward succeeds, so
+     that a run resumed after a crash skips it
+    :param stage: stage name the result is recorded for
+    :param writer: writer.BackgroundWriter passed to func which queues its writes under ward_dir, the
+     result is only recorded in the journal once they are saved
+    :return: dict with ward and the outcome (see run_job)
+    """
+    ward_name = ward_dir.parts[-1]
+    profile_file = "{}_{}.prof".format(profile_file_prefix, ward_name) if profile_file_prefix else None
+
+    if writer is not None:
+        kwargs = {**kwargs, "writer": writer}
+    result = {"ward": ward_name, **run_job(func, (ward_dir,), kwargs, profile_file)}
+    if journal is not None and result["success"]:
+        if writer is not None:
+            writer.submit(ward_dir, journal.record, stage, result, ward=ward_name)
+        else:
+            journal.record(stage, result, ward=ward_name)
+
+    return result
+
+
+def run_for_each_ward(func, ward_dirs, kwargs=None, max_workers=1, profile_file_prefix=None, journal=None,
+                      stage=None, write_queue_size=0):
+    """
+    Runs func for each ward, wards are independent so with max_workers > 1
+    they are processed in a pool of processes. Outputs are the same as a serial run
+    :param func: see run_ward_job
+    :param ward_dirs: ward directories
+    :param kwargs: other keyword arguments for func
+    :param max_workers: number of processes, 1 runs wards one after another in this process
+    :param profile_file_prefix: see run_ward_job
+    :param journal, stage: see run_ward_job
+    :param write_queue_size: when wards run one after another, queue their writes to a background
+     thread (see writer.BackgroundWriter) so that a ward is processed while the previous one is saved,
+     func then takes a writer argument. Wards whose writes fail are marked as failed. 0 saves each ward
+     before the next one starts
+    :return: list of results (see run_ward_job), one per ward in the same order as ward_dirs
+    """
+    kwargs = kwargs or {}
+    ward_dirs = list(ward_dirs)
+
+    if max_workers <= 1 or len(ward_dirs) <= 1:
+        if not write_queue_size:
+            return [run_ward_job(func, w, kwargs, profile_file_prefix, journal, stage) for w in ward_dirs]
+        writer = wr.BackgroundWriter(queue_size=write_queue_size)
+        try:
+            results = [run_ward_job(func, w, kwargs, profile_file_prefix, journal, stage, writer) for w in ward_dirs]
+        finally:
+            errors = writer.close()
+        for w, r in zip(ward_dirs, results):
+            if w in errors and r["success"]:
+                r.update(success=False, **errors[w])
+        return results
+
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(ward_dirs))) as executor:
+        futures = [executor.submit(run_ward_job, func, w, kwargs, profile_file_prefix, journal, stage)
+                   for w in ward_dirs]
+        return [f.result() for f in futures]
+
+
+def run_largest_first(tasks, on_done, max_workers=1):
+    """
+    Runs a queue of jobs, the largest ready job is started whenever a process is free so that
+    large jobs don't end up holding up the end of the run. Jobs may add follow up jobs when
+    they finish (e.g., ward jobs of a district once its CSV file is split by ward)
+    :param tasks: initial jobs as tuples (size, key, func, args), func(*args) runs through run_job
+    :param on_done: called as on_done(key, result) in this process when a job finishes (result
+     see run_job), returns a list of follow up jobs in the same form as tasks
+    :param max_workers: number of processes, 1 runs jobs one after another in this process
+    :return:
+    """
+    queue = []
+    # keeps jobs of equal size in the order added and avoids comparing keys
+    order = itertools.count()
+
+    def push(new_tasks):
+        for size, key, func, args in new_tasks:
+            heapq.heappush(queue, (-size, next(order), key, func, args))
+    push(tasks)
+
+    if max_workers <= 1:
+        while queue:
+            _, _, key, func, args = heapq.heappop(queue)
+            push(on_done(key, run_job(func, args)) or [])
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while queue or running:
+            while queue and len(running) < max_workers:
+                _, _, key, func, args = heapq.heappop(queue)
+                running[executor.submit(run_job, func, args)] = key
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                push(on_done(running.pop(f), f.result()) or [])
+
+
+def ward_subdirs(dir_with_ward_subdirs):
+    """
+    Returns ward directories within a district directory in a fixed order,
+    hidden directories (e.g., the run journal) aren't wards
+    """
+    return sorted(w for w in dir_with_ward_subdirs.iterdir() if w.is_dir() and not w.name.startswith("."))
+
+
+def report_failures(results, stage):
+    """
+    Prints wards which failed in a stage with the traceback
+    :return: number of failed wards
+    """
+    failed = [r for r in results if not r["success"]]
+    for r in failed:
+        print("{} failed for ward {}: {}\n{}".format(stage, r["ward"], r["error"], r["traceback"]))
+
+    return len(failed)
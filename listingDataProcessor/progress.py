@@ -0,0 +1,468 @@
+"""
+Fieldwork progress during listing: running totals per EA (households, population and POIs
+listed) and daily progress, updated from each new raw CSV export without processing the
+district. Only records captured since the last update (by GPSLocation__Timestamp) are
+cleaned, assigned to EAs and added to the totals, e.g.
+
+    python progress.py --raw-csv Lusaka.csv --ea-demarcation-dir DEMARCATION_DATA --province LUSAKA --district LUSAKA
+
+Progress is kept in <district dir>/fieldwork_progress:
+
+    state.json                  latest capture time taken in, EA layers records were assigned with and
+                                earliest capture time of records of wards without an EA layer yet
+    ea_totals.parquet           one row per EA with running totals
+    daily.parquet               one row per EA and day of capture, with the day's counts and totals to date
+    seen/<update>_<frame>.npy   coordinates keys of DFs and POIs taken in up to an update, sorted so that
+                                they are looked up memory-mapped, duplicates are dropped across updates
+
+Exports are synced from tablets at different times, so records captured up to
+progress_lookback_hours before the latest capture time taken in are looked at again,
+those already taken in are recognized by their coordinates. Only identical coordinates are
+dropped across updates, near duplicates (see dedup_radius_m) aren't. Records of a ward without
+an EA layer yet aren't taken in, they are read again by each update until the layer is added.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import utils as ut
+import storage as st
+import ea_index as eai
+import metrics as mt
+from data_processor import DataProcessor, prepare_processing_parameters
+
+# bump when progress tables change so that progress is started over
+PROGRESS_VERSION = 2
+
+PROGRESS_DIRNAME = "fieldwork_progress"
+
+STATE_FILENAME = "state.json"
+
+TIMESTAMP_COL = "GPSLocation__Timestamp"
+
+# raw columns progress is computed from besides the ward, structure type and fallback coordinates columns
+RAW_COLUMNS = ["GPSLocation__Latitude", "GPSLocation__Longitude", TIMESTAMP_COL, "Household_Population"]
+
+PROGRESS_COLS = ["HHPop", "StructCntHHs", "StructCntPOIs"]
+
+# rows per chunk when the raw CSV file is read
+CHUNK_SIZE = 200000
+
+# parameters which change how records are counted, progress is started over when they change
+PROGRESS_PARAMS = ["cols_df", "cols_poi", "new_names_df", "new_names_poi", "fallback_coords_cols", "schema",
+                   "struct_type_col", "res_struct_val", "ward_id_col", "ea_aggregation_id",
+                   "ward_level_ea_filename", "crs", "lon", "lat"]
+
+
+class DemarcationChanged(Exception):
+    """
+    Raised when the EA layer of a ward changed since records were assigned to its EAs
+    """
+
+
+class ProgressStore:
+    """
+    Progress tables of a district directory. An update is committed in two steps: tables are
+    written under temporary names, the state is saved listing them, and they are renamed. A
+    state listing tables not yet renamed is completed when loaded, so an update interrupted
+    at any point is either taken in whole or not at all
+    """
+
+    def __init__(self, dir_with_ward_subdirs):
+        self.progress_dir = Path(dir_with_ward_subdirs).joinpath(PROGRESS_DIRNAME)
+        self.state_file = self.progress_dir.joinpath(STATE_FILENAME)
+        self.seen_dir = self.progress_dir.joinpath("seen")
+
+    def table_file(self, name):
+        return self.progress_dir.joinpath("{}.parquet".format(name))
+
+    def load_state(self):
+        """
+        Returns the state of the last update, completing it if it was interrupted, None if there is none
+        """
+        if not self.state_file.exists():
+            return None
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except ValueError:
+            print("Ignoring corrupt progress state {}".format(self.state_file))
+            return None
+        if state.get("version") != PROGRESS_VERSION:
+            return None
+
+        committing = state.pop("committing", None)
+        if committing:
+            for name in committing:
+                tmp_file = st.temporary_path(self.table_file(name))
+                if tmp_file.exists():
+                    os.replace(tmp_file, self.table_file(name))
+            self.save_state(state)
+
+        return state
+
+    def save_state(self, state):
+        tmp_file = st.temporary_path(self.state_file)
+        with open(tmp_file, "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.state_file)
+
+    def load_table(self, name):
+        """
+        Returns a progress table (ea_totals or daily), None if there is none yet
+        """
+        path = self.table_file(name)
+        if not path.exists():
+            return None
+
+        return pd.read_parquet(path)
+
+    def seen_file(self, update, frame):
+        return self.seen_dir.joinpath("{:06d}_{}.npy".format(update, frame))
+
+    def seen_keys(self, update, frame):
+        """
+        Returns the sorted coordinates keys of a frame taken in up to an update, memory-mapped
+        """
+        path = self.seen_file(update, frame)
+        if not path.exists():
+            return np.empty(0, dtype=np.uint64)
+
+        return np.load(path, mmap_mode="r")
+
+    def seen_coordinates(self, last_update):
+        """
+        Returns coordinates taken in up to last_update, they are looked up in the memory-mapped
+        keys of the update rather than loaded
+        :return: dict with "df" and "poi" utils.CoordinateSet
+        """
+        return {frame: ut.CoordinateSet(segments=[self.seen_keys(last_update, frame)]) for frame in ["df", "poi"]}
+
+    def commit(self, state, tables, seen_keys):
+        """
+        Saves an update, the keys of coordinates taken in are merged with those of the last update
+        into files of this update, files of an update which didn't complete are overwritten and
+        those of earlier updates are removed once the update is committed
+        :param state: state after the update, state["update"] numbers the update
+        :param tables: dict of table name to data frame
+        :param seen_keys: dict of df and poi to keys of coordinates taken in
+        """
+        self.seen_dir.mkdir(parents=True, exist_ok=True)
+        for frame in ["df", "poi"]:
+            seen = self.seen_keys(state["update"] - 1, frame)
+            keys = np.unique(seen_keys.get(frame, np.empty(0, dtype=np.uint64)))
+            merged = np.insert(seen, np.searchsorted(seen, keys), keys)
+            seen_file = self.seen_file(state["update"], frame)
+            tmp_file = st.temporary_path(seen_file)
+            with open(tmp_file, "wb") as f:
+                np.save(f, merged)
+            os.replace(tmp_file, seen_file)
+
+        for name, df in tables.items():
+            df.to_parquet(st.temporary_path(self.table_file(name)), index=False)
+        self.save_state({**state, "committing": list(tables)})
+        # completes the update as loading the state would after a crash
+        self.load_state()
+        for f in self.seen_dir.glob("[0-9]*_*.npy"):
+            if int(f.stem.split("_")[0]) < state["update"]:
+                f.unlink()
+
+    def reset(self):
+        shutil.rmtree(self.progress_dir, ignore_errors=True)
+        self.progress_dir.mkdir(parents=True)
+
+
+def progress_params_hash(params):
+    """
+    Hashes the processing parameters in PROGRESS_PARAMS
+    """
+    relevant = {k: params[k] for k in PROGRESS_PARAMS}
+    dumped = json.dumps(relevant, sort_keys=True, default=str)
+
+    return hashlib.sha1("{}|{}".format(PROGRESS_VERSION, dumped).encode()).hexdigest()
+
+
+def columns_to_load(params):
+    """
+    Returns the raw CSV columns progress is computed from
+    """
+    cols = [params['ward_id_col'], params['struct_type_col']] + RAW_COLUMNS + params['fallback_coords_cols']
+
+    return list(dict.fromkeys(cols))
+
+
+def parse_timestamps(values):
+    """
+    Returns capture times as UTC times without time zone, values which aren't ISO 8601 times are missing
+    """
+    times = pd.to_datetime(values, errors="coerce", utc=True, format="ISO8601")
+
+    return times.dt.tz_localize(None)
+
+
+def coordinate_keys(df, lat="Latitude", lon="Longitude"):
+    """
+    Returns coordinates keys of rows as utils.drop_duplicate_coordinates adds them to seen coordinates
+    """
+    return ut.coordinate_keys(df[lat], df[lon])
+
+
+def read_new_records(raw_csv_file, params, since, seen_coordinates, chunk_size=CHUNK_SIZE, stats=None):
+    """
+    Reads records captured at or after since, cleaned and separated into DFs and POIs as when the district
+    is processed (see utils.sanitize_and_separate_df_pois), other records are dropped as they are read
+    :param since: capture time, None takes all records
+    :param seen_coordinates: see utils.drop_duplicate_coordinates, updated in place
+    :return: DF and POIs data frames
+    """
+    wanted = set(columns_to_load(params))
+    cols_df = [c for c in params['cols_df'] if c in wanted]
+    cols_poi = [c for c in params['cols_poi'] if c in wanted]
+    frames = {"df": [], "poi": []}
+    chunks = ut.create_df_in_chunks(raw_csv_file, usecols=columns_to_load(params),
+                                    dtypes=ut.read_dtypes(params['schema']), chunksize=chunk_size, stats=stats)
+    for chunk in chunks:
+        times = parse_timestamps(chunk[TIMESTAMP_COL])
+        is_new = times.notna() if since is None else times >= since
+        mt.add_counts(stats, rows_read=chunk.shape[0], timestamp_missing=int(times.isna().sum()))
+        if not is_new.any():
+            continue
+        df_dwellings, df_pois = ut.sanitize_and_separate_df_pois(
+            df=chunk[is_new.to_numpy()], output_file_dwelling=None, output_file_pois=None,
+            struct_type_col=params['struct_type_col'], null_feat_cat_replacement="missing",
+            cols_to_keep_df=cols_df, cols_to_keep_poi=cols_poi, new_col_names_df=params['new_names_df'],
+            new_col_names_poi=params['new_names_poi'], residential_struct_category=params['res_struct_val'],
+            seen_coordinates=seen_coordinates, stats=stats, schema=params['schema'], release_input=True)
+        frames["df"].append(df_dwellings)
+        frames["poi"].append(df_pois)
+
+    return [pd.concat(frames[f], ignore_index=True) if frames[f] else None for f in ["df", "poi"]]
+
+
+def ward_names(df, params):
+    """
+    Returns the ward directory name of each row of a DF or POIs data frame
+    """
+    return df[params['ward_id_col']].astype(str).str.upper()
+
+
+def progress_points(df_dwellings, df_pois, params):
+    """
+    Returns one row per DF and POI with its ward directory name, coordinates, capture time and counts
+    """
+    points = []
+    timestamp = params['new_names_df'].get(TIMESTAMP_COL, TIMESTAMP_COL)
+    for df, is_hh in [(df_dwellings, True), (df_pois, False)]:
+        if df is None or df.empty:
+            continue
+        points.append(pd.DataFrame({
+            "ward": ward_names(df, params).to_numpy(),
+            "x": df[params['lon']].to_numpy(dtype=float, na_value=np.nan),
+            "y": df[params['lat']].to_numpy(dtype=float, na_value=np.nan),
+            "captured": parse_timestamps(df[timestamp]).to_numpy(),
+            "HHPop": df["HHPop"].to_numpy(dtype=float, na_value=0) if is_hh else 0.0,
+            "StructCntHHs": int(is_hh), "StructCntPOIs": int(not is_hh)}))
+    if not points:
+        return pd.DataFrame(columns=["ward", "x", "y", "captured"] + PROGRESS_COLS)
+
+    return pd.concat(points, ignore_index=True)
+
+
+def assign_points_to_eas(points, dir_with_ward_subdirs, params, ea_layers, stats=None):
+    """
+    Assigns points to the EAs of their ward, the EA index cached in the ward directory when it is
+    processed is used (see ea_index.load_or_build_ea_index)
+    :param points: see progress_points
+    :param ea_layers: dict of ward name to hash of the EA layer records were assigned with so far
+    :return: points matched to an EA with an ea column (a point within several EAs is there for each),
+     dict of ward name to EA IDs and dict of ward name to EA layer hash
+    """
+    ea_id = params['ea_aggregation_id']
+    ea_filename = params['ward_level_ea_filename']
+    matched, ward_eas, layer_hashes = [], {}, {}
+    for ward, positions in points.groupby("ward", sort=False).indices.items():
+        ward_dir = Path(dir_with_ward_subdirs).joinpath(ward)
+        ea_file = ward_dir.joinpath("{}.shp".format(ea_filename))
+        if not ea_file.exists():
+            mt.add_counts(stats, points_without_ea_layer=len(positions))
+            continue
+        ea = st.read_file(ea_file, columns=[ea_id])
+        if params['ea_index_cache']:
+            ea_index = eai.load_or_build_ea_index(ward_dir.joinpath("{}_index.npz".format(ea_filename)), ea=ea,
+                                                  ea_aggregation_id=ea_id, crs_info=params['crs'],
+                                                  ea_file=ea_file)
+            layer_hash = ea_index.layer_hash
+        else:
+            ea_index = None
+            layer_hash = eai.ea_layer_hash(ea, ea_id, params['crs'])
+        if ea_layers.get(ward, layer_hash) != layer_hash:
+            raise DemarcationChanged(ward)
+        if ea.crs != params['crs']:
+            ea = ea.to_crs(params['crs'])
+
+        ward_points = points.iloc[positions]
+        pts_idx, ea_idx = ut.assign_xy_to_ea(ea, ward_points["x"].to_numpy(), ward_points["y"].to_numpy(),
+                                             ea_index=ea_index)
+        mt.add_counts(stats, points=len(ward_points), points_matched=len(np.unique(pts_idx)))
+        matched.append(ward_points.iloc[pts_idx].assign(ea=ea[ea_id].to_numpy()[ea_idx]))
+        ward_eas[ward] = pd.unique(ea[ea_id])
+        layer_hashes[ward] = layer_hash
+    if not matched:
+        return points.iloc[:0].assign(ea=None), ward_eas, layer_hashes
+
+    return pd.concat(matched, ignore_index=True), ward_eas, layer_hashes
+
+
+def add_to_ea_totals(totals, points, new_wards):
+    """
+    Adds points to the running totals of their EA
+    :param totals: EA totals saved so far, None if there are none
+    :param points: points with an ea column (see assign_points_to_eas)
+    :param new_wards: dict of ward name to EA IDs of wards without totals yet, their EAs get a
+     row even if no point was listed in them
+    :return: EA totals
+    """
+    frames = [points[["ward", "ea"] + PROGRESS_COLS].assign(last_captured=points["captured"])]
+    frames += [pd.DataFrame({"ward": ward, "ea": eas, **{c: 0 for c in PROGRESS_COLS}, "last_captured": pd.NaT})
+               for ward, eas in new_wards.items()]
+    if totals is not None:
+        frames.insert(0, totals.drop(columns="TotalStruct"))
+    totals = pd.concat(frames, ignore_index=True).groupby(["ward", "ea"], sort=True, as_index=False).agg(
+        {**{c: "sum" for c in PROGRESS_COLS}, "last_captured": "max"})
+    totals["TotalStruct"] = totals.StructCntHHs + totals.StructCntPOIs
+
+    return totals
+
+
+def add_to_daily(daily, points):
+    """
+    Adds points to the counts of their EA on the day they were captured, totals to date (<col>_to_date)
+    are updated for the days after
+    :param daily: daily progress saved so far, None if there is none
+    :param points: see add_to_ea_totals
+    :return: daily progress
+    """
+    frames = [points[["ward", "ea"] + PROGRESS_COLS].assign(day=points["captured"].dt.normalize())]
+    if daily is not None:
+        frames.insert(0, daily[["day", "ward", "ea"] + PROGRESS_COLS])
+    daily = pd.concat(frames, ignore_index=True).groupby(["day", "ward", "ea"], sort=True, as_index=False)[
+        PROGRESS_COLS].sum()
+    to_date = daily.groupby(["ward", "ea"], sort=False)[PROGRESS_COLS].cumsum()
+    for c in PROGRESS_COLS:
+        daily["{}_to_date".format(c)] = to_date[c]
+
+    return daily
+
+
+def update_progress(raw_csv_file, dir_with_ward_subdirs, params, chunk_size=CHUNK_SIZE, rebuild=False, stats=None):
+    """
+    Takes in records of a raw CSV export captured since the last update: adds them to the running
+    totals of their EA and to the daily progress. Progress is started over if there is none yet,
+    if the parameters in PROGRESS_PARAMS or the EA layer of a ward changed, or if rebuild
+    :param raw_csv_file: raw CSV export of the district, all records so far
+    :param dir_with_ward_subdirs: district directory
+    :param params: processing parameters (see data_processor.prepare_processing_parameters)
+    :param chunk_size: rows read at a time
+    :param rebuild: start over from all records of raw_csv_file
+    :param stats: dict to add counts of records read, taken in and assigned to an EA to
+    :return: EA totals (see add_to_ea_totals)
+    """
+    store = ProgressStore(dir_with_ward_subdirs)
+    state = None if rebuild else store.load_state()
+    params_hash = progress_params_hash(params)
+    if state is not None and state["params"] != params_hash:
+        print("Processing parameters changed, starting fieldwork progress over")
+        state = None
+    if state is None:
+        store.reset()
+        state = {"version": PROGRESS_VERSION, "params": params_hash, "update": 0, "latest_captured": None,
+                 "ea_layers": {}, "records": 0}
+
+    since = None
+    if state["latest_captured"]:
+        # records of wards without an EA layer at the last update are read again
+        since = min(pd.Timestamp(t) for t in [state["latest_captured"], state.get("pending_since")] if t)
+        since -= pd.Timedelta(hours=params['progress_lookback_hours'])
+    seen_coordinates = store.seen_coordinates(state["update"])
+    df_dwellings, df_pois = read_new_records(raw_csv_file, params, since, seen_coordinates, chunk_size=chunk_size,
+                                             stats=stats)
+    points = progress_points(df_dwellings, df_pois, params)
+    try:
+        matched, ward_eas, layer_hashes = assign_points_to_eas(points, dir_with_ward_subdirs, params,
+                                                               state["ea_layers"], stats=stats)
+    except DemarcationChanged as e:
+        print("EA layer of ward {} changed, starting fieldwork progress over".format(e))
+        if stats is not None:
+            stats.clear()
+        return update_progress(raw_csv_file, dir_with_ward_subdirs, params, chunk_size=chunk_size, rebuild=True,
+                               stats=stats)
+
+    totals = store.load_table("ea_totals")
+    if points.empty:
+        print("No new records since {}".format(state["latest_captured"]))
+        return totals
+
+    new_wards = {w: eas for w, eas in ward_eas.items() if w not in state["ea_layers"]}
+    tables = {"ea_totals": add_to_ea_totals(totals, matched, new_wards),
+              "daily": add_to_daily(store.load_table("daily"), matched)}
+    # records of wards without an EA layer are left pending rather than seen so that they are taken in
+    # once the layer is added
+    pending_wards = set(points["ward"]) - set(layer_hashes)
+    is_pending = points["ward"].isin(pending_wards)
+    seen_keys = {frame: coordinate_keys(df[~ward_names(df, params).isin(pending_wards).to_numpy()])
+                 for frame, df in [("df", df_dwellings), ("poi", df_pois)] if df is not None}
+    taken_in = int((~is_pending).sum())
+    latest = points["captured"].max()
+    if state["latest_captured"]:
+        latest = max(latest, pd.Timestamp(state["latest_captured"]))
+    state["latest_captured"] = latest.isoformat()
+    state["pending_since"] = points["captured"][is_pending].min().isoformat() if is_pending.any() else None
+    state.update(update=state["update"] + 1, records=state["records"] + taken_in,
+                 ea_layers={**state["ea_layers"], **layer_hashes}, updated=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    store.commit(state, tables, seen_keys)
+
+    totals = tables["ea_totals"]
+    mt.add_counts(stats, records_taken_in=taken_in, records_pending=len(points) - taken_in)
+    if pending_wards:
+        print("{} records of wards without an EA layer left pending: {}".format(
+            len(points) - taken_in, ", ".join(sorted(pending_wards))))
+    print("{} new records up to {}: {} EAs with listings out of {}, {:.0f} households, {:.0f} POIs, "
+          "{:.0f} people listed so far".format(taken_in, state["latest_captured"],
+                                               int((totals.TotalStruct > 0).sum()), len(totals),
+                                               totals.StructCntHHs.sum(), totals.StructCntPOIs.sum(),
+                                               totals.HHPop.sum()))
+
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--raw-csv", required=True, help="raw CSV export of the district")
+    parser.add_argument("--ea-demarcation-dir", required=True,
+                        help="directory with <province>/<district>/<ward> directories")
+    parser.add_argument("--province", required=True)
+    parser.add_argument("--district", required=True)
+    parser.add_argument("--rebuild", action="store_true", help="start over from all records of the export")
+    args = parser.parse_args()
+
+    params = prepare_processing_parameters()
+    raw_csv = Path(args.raw_csv)
+    dp = DataProcessor(raw_csv_dir=raw_csv.parent, csv_filename=raw_csv,
+                       ea_demarcation_dir=Path(args.ea_demarcation_dir), province=args.province,
+                       district=args.district, params=params)
+    stats = {}
+    update_progress(dp.raw_csv_filename, dp.dir_with_ward_subdirs, params,
+                    chunk_size=dp.raw_listing_chunk_size() or CHUNK_SIZE, rebuild=args.rebuild, stats=stats)
+    if stats.get("timestamp_missing"):
+        print("{} records without a valid {} can't be taken in".format(stats["timestamp_missing"], TIMESTAMP_COL))
+
+
+if __name__ == '__main__':
+    main()
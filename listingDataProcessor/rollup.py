@@ -0,0 +1,135 @@
+"""
+National store of EA attributes with precomputed roll-ups at each admin level
+(EA -> ward -> constituency -> district -> province -> national) saved as Parquet
+tables, so that coverage figures are read without touching geometry files:
+
+    store_dir/ea/<province>/<district>.parquet  one row per EA, written per district
+    store_dir/<level>.parquet                   one row per admin unit of the level
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+import utils as ut
+
+# admin levels from the largest, each level is grouped by its own and the larger levels' columns
+ADMIN_LEVELS = ["province", "district", "constituency", "ward"]
+ROLLUP_LEVELS = ["national"] + ADMIN_LEVELS
+
+
+def district_file(store_dir, province, district):
+    """
+    Returns the EA table file of a district
+    """
+    return os.path.join(store_dir, "ea", province, "{}.parquet".format(district))
+
+
+def write_table(df, path):
+    """
+    Saves a table, written to a temp file first so that readers never see a partial table
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = "{}.tmp".format(path)
+    df.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, path)
+
+
+def load_district_eas(store_dir, province, district):
+    """
+    Returns EA rows of a district, None if the district isn't in the store
+    """
+    path = district_file(store_dir, province, district)
+    if not os.path.exists(path):
+        return None
+
+    return pd.read_parquet(path)
+
+
+def update_district_eas(store_dir, province, district, ward_eas):
+    """
+    Replaces the EA rows of the wards given, rows of other wards of the
+    district (e.g., skipped as up to date) are kept
+    :param store_dir: store directory
+    :param ward_eas: list of data frames with constituency, ward, ea and utils.EA_ATTRIBUTE_COLS columns
+    :return: EA rows of the district
+    """
+    frames = [df.assign(province=province, district=district)[ADMIN_LEVELS + ["ea"] + ut.EA_ATTRIBUTE_COLS]
+              for df in ward_eas]
+    existing = load_district_eas(store_dir, province, district)
+    if existing is not None:
+        updated = set().union(*[set(df["ward"]) for df in frames])
+        frames.insert(0, existing[~existing["ward"].isin(updated)])
+    eas = pd.concat(frames, ignore_index=True) if frames else existing
+    if eas is not None:
+        write_table(eas.sort_values(["ward", "ea"], ignore_index=True),
+                    district_file(store_dir, province, district))
+
+    return eas
+
+
+def load_eas(store_dir):
+    """
+    Returns EA rows of all districts in the store
+    """
+    ea_dir = os.path.join(store_dir, "ea")
+    files = sorted(os.path.join(root, f) for root, _, names in os.walk(ea_dir)
+                   for f in names if f.endswith(".parquet"))
+    if not files:
+        return pd.DataFrame(columns=ADMIN_LEVELS + ["ea"] + ut.EA_ATTRIBUTE_COLS)
+
+    return pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+
+
+def rollup(eas, level):
+    """
+    Sums EA attributes by admin unit of a level and adds the number of EAs and the
+    ListingToImagery ratio (listed structures per building footprint, missing
+    where there are no footprints)
+    :param eas: EA rows (see load_eas)
+    :param level: one of ROLLUP_LEVELS
+    :return: data frame with a row per admin unit
+    """
+    if level == "national":
+        df = eas[ut.EA_ATTRIBUTE_COLS].sum().to_frame().T
+        df.insert(0, "EAs", len(eas))
+    else:
+        keys = ADMIN_LEVELS[:ADMIN_LEVELS.index(level) + 1]
+        grouped = eas.groupby(keys, dropna=False, sort=True)
+        df = grouped[ut.EA_ATTRIBUTE_COLS].sum()
+        df.insert(0, "EAs", grouped.size())
+        df = df.reset_index()
+    blds = df['StructCntBlds'].astype(float)
+    # sums of an empty store are objects rather than numbers
+    df['ListingToImagery'] = (df['TotalStruct'].astype(float) / blds).where(blds > 0, np.nan)
+
+    return df
+
+
+def build_rollups(store_dir):
+    """
+    Recomputes the roll-up table of each level from the EA rows of all districts
+    :return: dict of level to roll-up data frame
+    """
+    eas = load_eas(store_dir)
+    tables = {}
+    for level in ROLLUP_LEVELS:
+        tables[level] = rollup(eas, level)
+        write_table(tables[level], os.path.join(store_dir, "{}.parquet".format(level)))
+
+    return tables
+
+
+def query(store_dir, level, columns=None, **admin_units):
+    """
+    Reads the roll-up of a level, e.g. query(store_dir, "ward", district="LUSAKA")
+    returns ward coverage figures of one district
+    :param store_dir: store directory
+    :param level: one of ROLLUP_LEVELS
+    :param columns: columns to read, None reads all
+    :param admin_units: admin level columns and the value to keep
+    :return: data frame
+    """
+    filters = [(k, "==", v) for k, v in admin_units.items()] or None
+
+    return pd.read_parquet(os.path.join(store_dir, "{}.parquet".format(level)), columns=columns, filters=filters)
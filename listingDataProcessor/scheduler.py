@@ -0,0 +1,264 @@
+"""
+Batch mode: processes every district export found under a raw CSV directory. District jobs
+(raw CSV file to ward files) and ward jobs (ward layers and EA attributes) of all
+districts share one queue in a pool of processes, largest jobs first, e.g.
+
+    python scheduler.py --raw-dir data/listingRawFiles --ea-demarcation-dir data/DEMARCATION_DATA --workers 8
+
+Raw CSV files are named <district>_District.csv and matched to <province>/<district>
+directories of the EA demarcation directory. A summary with a row per district is
+printed and saved to the EA demarcation directory.
+"""
+import argparse
+import datetime
+import time
+from pathlib import Path
+
+import pandas as pd
+
+import parallel as pl
+import rollup as rl
+from data_processor import DataProcessor, prepare_processing_parameters
+
+RAW_CSV_PATTERN = "*_District.csv"
+
+SUMMARY_FILENAME = "batch_run_summary.csv"
+
+
+def find_district_exports(raw_csv_dir, ea_demarcation_dir, pattern=RAW_CSV_PATTERN):
+    """
+    Finds raw CSV files (searched recursively) and the province and district directories they belong to,
+    district names are matched ignoring case
+    :param raw_csv_dir: directory with raw CSV files
+    :param ea_demarcation_dir: directory with <province>/<district>/<ward> directories
+    :param pattern: file name pattern of raw CSV files, the district is the part before "_District"
+    :return: list of dicts with province, district, csv_file and size (bytes), and list of
+     raw CSV files without a district directory
+    """
+    district_dirs = {}
+    for prov_dir in sorted(p for p in Path(ea_demarcation_dir).iterdir() if p.is_dir()):
+        for dist_dir in sorted(d for d in prov_dir.iterdir() if d.is_dir()):
+            district_dirs.setdefault(dist_dir.name.upper(), []).append(dist_dir)
+
+    exports, unmatched = [], []
+    for csv_file in sorted(Path(raw_csv_dir).rglob(pattern)):
+        name = csv_file.name[:-len(pattern.lstrip("*"))]
+        matches = district_dirs.get(name.upper(), [])
+        if len(matches) != 1:
+            unmatched.append(csv_file)
+            continue
+        exports.append({"province": matches[0].parent.name, "district": matches[0].name,
+                        "csv_file": csv_file, "size": csv_file.stat().st_size})
+
+    return exports, unmatched
+
+
+def ward_size(dp, ward_dir):
+    """
+    Returns size in bytes of a ward's DF and POIs CSV files and buildings layer, used to order jobs
+    """
+    files = dp.ward_input_files(ward_dir)
+
+    return sum(files[k].stat().st_size for k in ["df", "poi", "buildings"] if files[k].exists())
+
+
+def prepare_district(dp):
+    """
+    District job: runs the district level stages (see DataProcessor.prepare_wards)
+    :return: ward directories to process, the manifest and run report records of the stages
+    """
+    ward_dirs, manifest = dp.prepare_wards()
+
+    return ward_dirs, manifest, dp.report.records
+
+
+class BatchRun:
+    """
+    Keeps track of the districts in a batch while their jobs run (see parallel.run_largest_first)
+    """
+
+    def __init__(self, exports, ea_demarcation_dir, params):
+        """
+        :param exports: see find_district_exports
+        :param ea_demarcation_dir: directory with all EA demarcation
+        :param params: see prepare_processing_parameters
+        """
+        self.params = params
+        self.processors = {}
+        self.districts = {}
+        for e in exports:
+            key = (e["province"], e["district"])
+            self.processors[key] = DataProcessor(raw_csv_dir=e["csv_file"].parent, csv_filename=e["csv_file"],
+                                                 ea_demarcation_dir=Path(ea_demarcation_dir),
+                                                 province=e["province"], district=e["district"], params=params)
+            self.districts[key] = {"province": e["province"], "district": e["district"],
+                                   "raw_csv_mb": e["size"] / 1024 ** 2, "success": True, "error": None,
+                                   "wards_processed": 0, "failed_wards": 0, "district_seconds": 0.0,
+                                   "ward_seconds": 0.0, "peak_rss_mb": None, "pending": 0,
+                                   "ward_dirs": [], "manifest": None, "results_shp": [], "results_ea": []}
+
+    def district_tasks(self):
+        """
+        Returns a district job per district (see parallel.run_largest_first)
+        """
+        return [(d["raw_csv_mb"], ("district", key), prepare_district, (self.processors[key],))
+                for key, d in self.districts.items()]
+
+    def ward_tasks(self, key):
+        """
+        Returns ward jobs of a district, wards of a GeoPackage share a file so they make a single job
+        """
+        dp = self.processors[key]
+        ward_dirs = self.districts[key]["ward_dirs"]
+        groups = [ward_dirs] if dp.params["storage_format"] == "gpkg" else [[w] for w in ward_dirs]
+
+        return [(sum(ward_size(dp, w) for w in g) / 1024 ** 2, ("wards", key), dp.process_wards, (g,))
+                for g in groups if g]
+
+    def on_done(self, task, result):
+        """
+        Records a finished job and returns follow up jobs (see parallel.run_largest_first)
+        """
+        kind, key = task
+        d = self.districts[key]
+        d["peak_rss_mb"] = max(filter(None, [d["peak_rss_mb"], result["peak_rss_mb"]]), default=None)
+
+        if kind == "district":
+            d["district_seconds"] = result["wall_seconds"]
+            if not result["success"]:
+                d["success"] = False
+                d["error"] = result["error"]
+                print("Processing district {} failed: {}\n{}".format(d["district"], result["error"],
+                                                                    result["traceback"]))
+                self.finish_district(key, records=[])
+                return []
+            d["ward_dirs"], d["manifest"], d["records"] = result["value"]
+            tasks = self.ward_tasks(key)
+            d["pending"] = len(tasks)
+            if not tasks:
+                self.finish_district(key, d["records"])
+            return tasks
+
+        d["ward_seconds"] += result["wall_seconds"]
+        if result["success"]:
+            results_shp, results_ea = result["value"]
+            d["results_shp"] += results_shp
+            d["results_ea"] += results_ea
+        else:
+            # process_wards records failures per ward so this is unexpected (e.g., out of memory),
+            # none of the district's wards are then recorded as processed
+            d["success"] = False
+            d["error"] = result["error"]
+            print("Ward job of district {} failed: {}\n{}".format(d["district"], result["error"],
+                                                                 result["traceback"]))
+        d["pending"] -= 1
+        if d["pending"] == 0:
+            self.finish_district(key, d["records"])
+
+        return []
+
+    def finish_district(self, key, records):
+        """
+        Runs the stages after ward level stages of a district in this process and saves its run report
+        """
+        dp = self.processors[key]
+        d = self.districts[key]
+        dp.report.records = records
+        try:
+            if d["success"]:
+                dp.report_ward_layers(d["results_shp"])
+                pl.report_failures(d["results_ea"], stage="Appending attributes to ward shapefile")
+                for stage, results in [("create_ward_layers", d["results_shp"]),
+                                       ("append_building_attributes_to_ward_level_ea_shp", d["results_ea"])]:
+                    dp.report.add_ward_results(stage, results, district=dp.district)
+                dp.finish_wards(d["ward_dirs"], d["manifest"], d["results_shp"], d["results_ea"],
+                                build_rollups=False)
+        except Exception as e:
+            d["success"] = False
+            d["error"] = repr(e)
+            print("Finishing district {} failed: {}".format(d["district"], repr(e)))
+        finally:
+            if self.params['run_report']:
+                dp.save_run_report()
+        failed = {r["ward"] for r in d["results_shp"] + d["results_ea"] if not r["success"]}
+        d["wards_processed"] = len(d["ward_dirs"]) - len(failed) if d["success"] else 0
+        d["failed_wards"] = len(failed)
+        d["rows_in"] = next((r.get("rows_in") for r in records if r["stage"] == "process_raw_listing"), None)
+        # results hold data frames, they aren't needed once the district is done
+        d["results_shp"], d["results_ea"] = [], []
+        print("District {} done: {} wards processed, {} failed".format(d["district"], d["wards_processed"],
+                                                                      d["failed_wards"]))
+
+    def summary(self):
+        """
+        Returns a data frame with a row per district, largest raw CSV file first
+        """
+        cols = ["province", "district", "raw_csv_mb", "success", "error", "rows_in", "wards_processed",
+                "failed_wards", "district_seconds", "ward_seconds", "peak_rss_mb"]
+        df = pd.DataFrame([d for d in self.districts.values()], columns=cols)
+
+        return df.sort_values("raw_csv_mb", ascending=False, ignore_index=True)
+
+
+def run_batch(raw_csv_dir, ea_demarcation_dir, params, max_workers=1, provinces=None):
+    """
+    Processes all district exports found under raw_csv_dir (see find_district_exports)
+    :param raw_csv_dir: directory with raw CSV files
+    :param ea_demarcation_dir: directory with all EA demarcation
+    :param params: see prepare_processing_parameters, ward_workers is ignored in favour of max_workers
+    :param max_workers: number of processes shared by district and ward jobs of all districts
+    :param provinces: only process districts of these provinces, None processes all
+    :return: summary data frame with a row per district, also saved to the EA demarcation directory
+    """
+    started = time.perf_counter()
+    exports, unmatched = find_district_exports(raw_csv_dir, ea_demarcation_dir)
+    for f in unmatched:
+        print("No single district directory found for {}, skipping it".format(f))
+    if provinces:
+        provinces = {p.upper() for p in provinces}
+        exports = [e for e in exports if e["province"].upper() in provinces]
+    print("Processing {} districts with {} processes".format(len(exports), max_workers))
+
+    batch = BatchRun(exports, ea_demarcation_dir, params)
+    pl.run_largest_first(batch.district_tasks(), batch.on_done, max_workers=max_workers)
+
+    if params['rollup_store'] and exports:
+        rl.build_rollups(Path(ea_demarcation_dir).joinpath("national_rollup"))
+
+    summary = batch.summary()
+    summary.to_csv(Path(ea_demarcation_dir).joinpath(SUMMARY_FILENAME), index=False)
+    print_summary(summary, time.perf_counter() - started)
+
+    return summary
+
+
+def print_summary(summary, wall_seconds):
+    """
+    Prints the batch summary with totals
+    """
+    print("=" * 70)
+    print("Batch finished at {} in {:.1f} s".format(datetime.datetime.now().isoformat(timespec="seconds"),
+                                                     wall_seconds))
+    print(summary.drop(columns="error").to_string(index=False, float_format="{:.1f}".format))
+    print("Districts: {} succeeded, {} failed. Wards: {} processed, {} failed".format(
+        int(summary["success"].sum()), int((~summary["success"]).sum()),
+        int(summary["wards_processed"].sum()), int(summary["failed_wards"].sum())))
+    for _, row in summary[~summary["success"]].iterrows():
+        print("{}/{}: {}".format(row["province"], row["district"], row["error"]))
+
+
+def main():
+    params = prepare_processing_parameters()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--raw-dir", required=True, help="directory with raw CSV files (searched recursively)")
+    parser.add_argument("--ea-demarcation-dir", required=True, help="directory with all EA demarcation")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes")
+    parser.add_argument("--province", action="append", default=None,
+                        help="only process districts of this province, may be repeated")
+    args = parser.parse_args()
+
+    run_batch(args.raw_dir, args.ea_demarcation_dir, params, max_workers=args.workers, provinces=args.province)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""
+Storage backends for ward level layers (DFs, POIs and EAs).
+
+Layers can be stored as:
+    - shapefile: one <layer>.shp per ward directory (default)
+    - geoparquet: one compressed <layer>.parquet per ward directory
+    - gpkg: one <district>.gpkg per district directory with a layer per ward
+Shapefiles are always available as an export format.
+"""
+import json
+import os
+import geopandas as gpd
+
+STORAGE_FORMATS = {"shapefile": ".shp", "geoparquet": ".parquet", "gpkg": ".gpkg"}
+
+PARQUET_COMPRESSION = "zstd"
+
+# .shp is first, it is renamed last when replacing a shapefile (see replace_shapefile)
+SHAPEFILE_EXTENSIONS = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
+
+
+def layer_location(ward_dir, layer, storage_format):
+    """
+    Returns the file and layer name (only for GeoPackage) for a ward level layer
+    :param ward_dir: ward directory
+    :param layer: layer name, same as shapefile name without extension (e.g., LUSAKA CENTRAL_df, EA)
+    :param storage_format: one of STORAGE_FORMATS
+    :return: (path, layer name) tuple
+    """
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError("Unknown storage format {}, use one of {}".format(storage_format,
+                                                                          list(STORAGE_FORMATS)))
+
+    if storage_format == "gpkg":
+        ward_name = ward_dir.parts[-1]
+        district_dir = ward_dir.parent
+        gpkg = district_dir.joinpath("{}{}".format(district_dir.parts[-1], STORAGE_FORMATS["gpkg"]))
+        if not layer.startswith(ward_name):
+            layer = "{}_{}".format(ward_name, layer)
+        return gpkg, layer
+
+    return ward_dir.joinpath("{}{}".format(layer, STORAGE_FORMATS[storage_format])), None
+
+
+def layer_exists(ward_dir, layer, storage_format):
+    """
+    Checks whether a ward level layer has already been saved
+    """
+    path, layer_name = layer_location(ward_dir, layer, storage_format)
+    if not path.exists():
+        return False
+    if layer_name is None:
+        return True
+
+    return layer_name in list_layers(path)
+
+
+def list_layers(gpkg):
+    """
+    Returns names of layers in a GeoPackage
+    """
+    try:
+        return list(gpd.list_layers(gpkg)["name"])
+    except AttributeError:
+        # older geopandas
+        import fiona
+        return fiona.listlayers(gpkg)
+
+
+def gpkg_layer_stamp(ward_dir, layer_name):
+    """
+    Returns stamp file touched each time a GeoPackage layer is saved, the
+    GeoPackage itself is shared by all wards so its modification time can't be used
+    """
+    return ward_dir.joinpath(".{}.gpkg-stamp".format(layer_name))
+
+
+def layer_mtime(ward_dir, layer, storage_format):
+    """
+    Returns time a ward level layer was last saved or None if it doesn't exist
+    """
+    path, layer_name = layer_location(ward_dir, layer, storage_format)
+    if layer_name is not None:
+        path = gpkg_layer_stamp(ward_dir, layer_name)
+    if not path.exists():
+        return None
+
+    return os.path.getmtime(path)
+
+
+def layer_is_up_to_date(ward_dir, layer, storage_format, input_files):
+    """
+    Checks whether a ward level layer was saved after all the files it is created from
+    :param input_files: full paths of files the layer is created from
+    """
+    saved = layer_mtime(ward_dir, layer, storage_format)
+    if saved is None:
+        return False
+
+    return all(os.path.getmtime(f) <= saved for f in input_files)
+
+
+def layer_source_file(ward_dir, layer):
+    """
+    Returns file holding the hash of the input a ward level layer was saved from (see write_layer)
+    """
+    return ward_dir.joinpath(".{}.source".format(layer))
+
+
+def layer_source(ward_dir, layer, storage_format):
+    """
+    Returns hash of the input a ward level layer was saved from, None if the
+    layer doesn't exist or was saved without one
+    """
+    source_file = layer_source_file(ward_dir, layer)
+    if not source_file.exists() or not layer_exists(ward_dir, layer, storage_format):
+        return None
+
+    return source_file.read_text()
+
+
+def write_layer(gdf, ward_dir, layer, storage_format, source=None):
+    """
+    Saves a ward level layer using the storage format, a layer interrupted while
+    being saved never replaces the previous one: files are written under a temporary
+    name and renamed once complete, a GeoPackage layer is only taken as saved once
+    its stamp is touched (see gpkg_layer_stamp)
+    :param gdf: GeoDataFrame to save
+    :param ward_dir: ward directory
+    :param layer: layer name
+    :param storage_format: one of STORAGE_FORMATS
+    :param source: hash of the input the layer is created from, saved once the layer is (see layer_source)
+    :return: path of file saved
+    """
+    source_file = layer_source_file(ward_dir, layer)
+    if source_file.exists():
+        source_file.unlink()
+    path, layer_name = layer_location(ward_dir, layer, storage_format)
+    if storage_format == "geoparquet":
+        tmp_file = temporary_path(path)
+        gdf.to_parquet(tmp_file, compression=PARQUET_COMPRESSION, index=False)
+        os.replace(tmp_file, path)
+    elif storage_format == "gpkg":
+        stamp = gpkg_layer_stamp(ward_dir, layer_name)
+        if stamp.exists():
+            stamp.unlink()
+        gdf.to_file(path, layer=layer_name, driver="GPKG")
+        stamp.touch()
+    else:
+        tmp_file = temporary_path(path)
+        gdf.to_file(tmp_file)
+        replace_shapefile(tmp_file, path)
+    if source is not None:
+        source_file.write_text(source)
+
+    return path
+
+
+def temporary_path(path):
+    """
+    Returns hidden file next to path to write to before renaming it to path
+    """
+    return path.with_name(".{}.tmp{}".format(path.stem, path.suffix))
+
+
+def replace_shapefile(tmp_shp, shp):
+    """
+    Renames a shapefile and its sidecar files, the .shp file is renamed last so
+    that the shapefile only exists once all its files are in place. Sidecar files of
+    the previous shapefile which the new one doesn't have are removed
+    """
+    tmp_files = {ext: tmp_shp.with_suffix(ext) for ext in SHAPEFILE_EXTENSIONS}
+    for ext in SHAPEFILE_EXTENSIONS[::-1]:
+        if tmp_files[ext].exists():
+            os.replace(tmp_files[ext], shp.with_suffix(ext))
+        elif shp.with_suffix(ext).exists():
+            os.remove(shp.with_suffix(ext))
+
+
+def read_file(path, columns=None, layer=None):
+    """
+    Reads a vector file (e.g., shapefile) loading only the columns needed
+    :param path: full path of file
+    :param columns: attribute columns to load (geometry is always loaded), None loads all
+    :param layer: layer name for multi-layer files
+    :return: GeoDataFrame
+    """
+    kwargs = {}
+    if columns is not None:
+        kwargs["columns"] = list(columns)
+    if layer is not None:
+        kwargs["layer"] = layer
+
+    return gpd.read_file(path, **kwargs)
+
+
+def read_layer(ward_dir, layer, storage_format, columns=None):
+    """
+    Reads a ward level layer saved using the storage format
+    :param ward_dir: ward directory
+    :param layer: layer name
+    :param storage_format: one of STORAGE_FORMATS
+    :param columns: attribute columns to load (geometry is always loaded), None loads all
+    :return: GeoDataFrame
+    """
+    path, layer_name = layer_location(ward_dir, layer, storage_format)
+    if storage_format == "geoparquet":
+        if columns is not None:
+            columns = list(columns) + ["geometry"]
+        return gpd.read_parquet(path, columns=columns)
+
+    return read_file(path, columns=columns, layer=layer_name)
+
+
+def iter_file_batches(path, columns=None, batch_size=100000, layer=None):
+    """
+    Reads a vector file batch by batch so that files larger than memory (e.g., national
+    building footprints) can be processed, only one batch is held in memory at a time
+    :param path: full path of file, GeoParquet (.parquet) or any format GDAL reads
+    :param columns: attribute columns to load (geometry is always loaded), None loads all
+    :param batch_size: maximum number of rows in each batch
+    :param layer: layer name for multi-layer files
+    :return: iterator of GeoDataFrames
+    """
+    columns = list(columns) if columns is not None else None
+    if str(path).endswith(STORAGE_FORMATS["geoparquet"]):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        geo = json.loads(parquet_file.schema_arrow.metadata[b"geo"])
+        geometry_col = geo["primary_column"]
+        # CRS is left out of GeoParquet metadata when it is OGC:CRS84
+        crs = geo["columns"][geometry_col].get("crs", "OGC:CRS84")
+        batches = parquet_file.iter_batches(batch_size=batch_size,
+                                            columns=None if columns is None else columns + [geometry_col])
+        for batch in batches:
+            yield batch_to_geodataframe(batch, geometry_col, crs)
+        return
+
+    import pyogrio
+
+    with pyogrio.open_arrow(path, layer=layer, columns=columns, batch_size=batch_size,
+                            use_pyarrow=True) as (meta, reader):
+        geometry_col = meta["geometry_name"] or "wkb_geometry"
+        for batch in reader:
+            yield batch_to_geodataframe(batch, geometry_col, meta["crs"])
+
+
+def batch_to_geodataframe(batch, geometry_col, crs):
+    """
+    Converts an Arrow record batch with WKB geometries to a GeoDataFrame
+    """
+    df = batch.drop_columns([geometry_col]).to_pandas()
+    geometry = gpd.GeoSeries.from_wkb(batch.column(geometry_col).to_numpy(zero_copy_only=False), crs=crs)
+
+    return gpd.GeoDataFrame(df, geometry=geometry)
+
+
+def export_to_shapefile(ward_dir, layer, storage_format, output_shp=None):
+    """
+    Exports a ward level layer to shapefile, note that shapefile field
+    names are truncated to 10 characters
+    :param output_shp: full path of shapefile, defaults to <layer>.shp in ward directory
+    :return: path of shapefile
+    """
+    if output_shp is None:
+        output_shp = layer_location(ward_dir, layer, "shapefile")[0]
+    gdf = read_layer(ward_dir, layer, storage_format)
+    gdf.to_file(output_shp)
+
+    return output_shp
@@ -0,0 +1,212 @@
+"""
+Generates synthetic Survey Solutions style listing CSVs, EA demarcation and
+building footprints at configurable scale (one ward up to the whole country)
+for testing and benchmarking the data processor
+"""
+import math
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import box
+
+from data_processor import prepare_processing_parameters
+
+# number of provinces, districts per province, wards per district and structures per ward
+SCALES = {
+    "ward": {"provinces": 1, "districts": 1, "wards": 1, "structures": 2000},
+    "district": {"provinces": 1, "districts": 1, "wards": 30, "structures": 3000},
+    "province": {"provinces": 1, "districts": 10, "wards": 25, "structures": 3000},
+    "country": {"provinces": 10, "districts": 12, "wards": 25, "structures": 3000},
+}
+
+STRUCTURE_TYPES = ["Residential Building", "Commercial Building", "Religious Building",
+                   "Institutional Building", "Educational Building", "#NULL!"]
+STRUCTURE_TYPES_PROBS = [0.75, 0.1, 0.04, 0.04, 0.04, 0.03]
+
+# ward extent in degrees (about 5.5 km) and top left corner of first ward
+WARD_SIZE = 0.05
+ORIGIN = (25.0, -9.0)
+
+# about 2 metres in degrees, used for near duplicates
+NEAR_DUPLICATE_JITTER = 0.00002
+
+
+def ward_extent(ward_index):
+    """
+    Returns (xmin, ymin, xmax, ymax) of a ward, wards are laid out on a grid going south
+    """
+    wards_per_row = 200
+    col = ward_index % wards_per_row
+    row = ward_index // wards_per_row
+    xmin = ORIGIN[0] + col * WARD_SIZE
+    ymax = ORIGIN[1] - row * WARD_SIZE
+
+    return xmin, ymax - WARD_SIZE, xmin + WARD_SIZE, ymax
+
+
+def generate_ward_listing(rng, province, district, ward, extent, ea_codes, eas_per_side, n_structures,
+                          columns, null_coords_rate, duplicate_rate, near_duplicate_rate):
+    """
+    Returns a raw listing data frame for one ward
+    :param rng: numpy random generator
+    :param extent: ward extent, see ward_extent
+    :param ea_codes: EA codes ordered by EA grid row then column
+    :param eas_per_side: number of EAs along each side of ward
+    :param n_structures: number of structures listed
+    :param columns: raw CSV columns
+    :param null_coords_rate: share of structures with #NULL! GPS coordinates
+    :param duplicate_rate: share of structures captured twice with the same coordinates
+    :param near_duplicate_rate: share of structures captured twice a few metres apart
+    :return:
+    """
+    xmin, ymin, xmax, ymax = extent
+    n = n_structures
+    lon = rng.uniform(xmin, xmax, n)
+    lat = rng.uniform(ymin, ymax, n)
+    ea_col = np.minimum(((lon - xmin) / (xmax - xmin) * eas_per_side).astype(int), eas_per_side - 1)
+    ea_row = np.minimum(((lat - ymin) / (ymax - ymin) * eas_per_side).astype(int), eas_per_side - 1)
+    struct_type = rng.choice(STRUCTURE_TYPES, size=n, p=STRUCTURE_TYPES_PROBS)
+    residential = struct_type == "Residential Building"
+    males = rng.integers(0, 6, n)
+    females = rng.integers(0, 6, n)
+    timestamps = pd.Timestamp("2020-08-01") + pd.to_timedelta(rng.integers(0, 30 * 24 * 3600, n), unit="s")
+
+    df = pd.DataFrame({
+        'PROV': province, 'DIST': district, 'CONS': "{}_CONS".format(district), 'WARD': ward,
+        'REGION': rng.choice(["Rural", "Urban"], size=n), 'SEA': np.asarray(ea_codes)[ea_row * eas_per_side + ea_col],
+        'LOCALITY': "{}_LOC".format(ward),
+        'GPSLocation__Latitude': lat, 'GPSLocation__Longitude': lon,
+        'GPSLocation__Altitude': rng.uniform(1100, 1300, n).round(1),
+        'GPSLocation__Timestamp': timestamps.strftime("%Y-%m-%dT%H:%M:%S"),
+        'GeoLocation_Latitude': lat + rng.normal(0, 0.00001, n),
+        'GeoLocation_Longitude': lon + rng.normal(0, 0.00001, n),
+        'Structure_type_categorisation': struct_type,
+        'Structure_Name': ["STRUCT_{}".format(i) for i in range(n)],
+        'Males_in_structure': males, 'Females_in_structure': females,
+        'Number_of_Housing_Units': np.where(residential, rng.integers(1, 3, n), 0),
+        'Total_Households': np.where(residential, rng.integers(1, 3, n), 0),
+        'First_Head_Name': ["HEAD_{}".format(i) for i in range(n)],
+        'Males_in_Household': males, 'Females_in_Household': females,
+        'Household_Population': np.where(residential, males + females, 0),
+    })
+    for c in columns:
+        if c not in df.columns:
+            df[c] = np.where(residential, "", rng.choice(["Yes", "No"], size=n))
+
+    # =============================
+    # Duplicates and near duplicates
+    # =============================
+    dups = df.sample(frac=duplicate_rate, random_state=rng.integers(1 << 31))
+    near_dups = df.sample(frac=near_duplicate_rate, random_state=rng.integers(1 << 31)).copy()
+    near_dups['GPSLocation__Latitude'] += rng.uniform(-1, 1, len(near_dups)) * NEAR_DUPLICATE_JITTER
+    near_dups['GPSLocation__Longitude'] += rng.uniform(-1, 1, len(near_dups)) * NEAR_DUPLICATE_JITTER
+    df = pd.concat([df, dups, near_dups], ignore_index=True).sample(frac=1, random_state=rng.integers(1 << 31))
+
+    # =============================
+    # Null coordinates
+    # =============================
+    lon_str = df['GPSLocation__Longitude'].map("{:.7f}".format)
+    nulls = rng.random(len(df)) < null_coords_rate
+    df['GPSLocation__Longitude'] = lon_str.where(~nulls, "#NULL!")
+
+    return df[columns]
+
+
+def generate_ea_layers(rng, ward_dir, extent, ea_codes, eas_per_side, n_buildings):
+    """
+    Saves EA demarcation (EA.shp) and building footprints points (SIMULATED_HH_FAKE.shp) for one ward
+    """
+    xmin, ymin, xmax, ymax = extent
+    size_x = (xmax - xmin) / eas_per_side
+    size_y = (ymax - ymin) / eas_per_side
+    polygons = [box(xmin + c * size_x, ymin + r * size_y, xmin + (c + 1) * size_x, ymin + (r + 1) * size_y)
+                for r in range(eas_per_side) for c in range(eas_per_side)]
+    ea = gpd.GeoDataFrame({'SEA_CODE': ea_codes}, geometry=polygons, crs="EPSG:4326")
+    ea.to_file(ward_dir.joinpath("EA.shp"))
+
+    bld = gpd.GeoDataFrame({'n_HH': np.ones(n_buildings, dtype=int)},
+                           geometry=gpd.points_from_xy(rng.uniform(xmin, xmax, n_buildings),
+                                                       rng.uniform(ymin, ymax, n_buildings)), crs="EPSG:4326")
+    bld.to_file(ward_dir.joinpath("SIMULATED_HH_FAKE.shp"))
+
+
+def generate_irregular_eas(rng, extent, n_eas, crs="EPSG:4326"):
+    """
+    Returns irregular EA polygons (Voronoi cells of random points) covering an extent,
+    closer to real EA boundaries than the grid of generate_ea_layers
+    """
+    xmin, ymin, xmax, ymax = extent
+    seeds = shapely.multipoints(np.column_stack([rng.uniform(xmin, xmax, n_eas), rng.uniform(ymin, ymax, n_eas)]))
+    cells = shapely.get_parts(shapely.voronoi_polygons(seeds, extend_to=box(*extent)))
+    cells = shapely.intersection(cells, box(*extent))
+
+    return gpd.GeoDataFrame({'SEA_CODE': ["EA{:06d}".format(i) for i in range(len(cells))]}, geometry=cells,
+                            crs=crs)
+
+
+def generate_district(raw_csv_dir, ea_demarcation_dir, province, district, n_wards, structures_per_ward,
+                      first_ward_index=0, eas_per_ward=16, buildings_per_structure=1.2, null_coords_rate=0.05,
+                      duplicate_rate=0.02, near_duplicate_rate=0.02, seed=0):
+    """
+    Generates raw listing CSV (<district>_District.csv in raw_csv_dir) and ward
+    directories with EA and building footprints shapefiles for one district
+    :param raw_csv_dir: Directory to save raw CSV to
+    :param ea_demarcation_dir: directory for EA demarcation (<province>/<district>/<ward>)
+    :param first_ward_index: position of district's first ward in the national ward grid
+    :return: full path of raw CSV file
+    """
+    rng = np.random.default_rng(seed)
+    params = prepare_processing_parameters()
+    columns = list(dict.fromkeys(params['cols_df'] + params['cols_poi'] + params['fallback_coords_cols']))
+    eas_per_side = int(math.ceil(math.sqrt(eas_per_ward)))
+
+    raw_csv_dir.mkdir(parents=True, exist_ok=True)
+    csv_file = raw_csv_dir.joinpath("{}_District.csv".format(district.title()))
+    for w in range(n_wards):
+        ward = "{}_WARD_{:03d}".format(district, w)
+        ward_dir = ea_demarcation_dir.joinpath(province, district, ward.upper())
+        ward_dir.mkdir(parents=True, exist_ok=True)
+        extent = ward_extent(first_ward_index + w)
+        ea_codes = ["{}{:03d}{:03d}".format(district, w, e) for e in range(eas_per_side ** 2)]
+
+        generate_ea_layers(rng, ward_dir, extent, ea_codes, eas_per_side,
+                           n_buildings=int(structures_per_ward * buildings_per_structure))
+        df = generate_ward_listing(rng, province, district, ward, extent, ea_codes, eas_per_side,
+                                   n_structures=structures_per_ward, columns=columns,
+                                   null_coords_rate=null_coords_rate, duplicate_rate=duplicate_rate,
+                                   near_duplicate_rate=near_duplicate_rate)
+        df.to_csv(csv_file, index=False, mode="a" if w else "w", header=not w)
+
+    return csv_file
+
+
+def generate(scale, output_dir, seed=0, **kwargs):
+    """
+    Generates synthetic data at one of SCALES
+    :param scale: one of SCALES keys or a dict with the same keys
+    :param output_dir: raw CSVs are saved to output_dir/raw/<province> and
+     EA demarcation to output_dir/DEMARCATION_DATA
+    :param kwargs: other generate_district arguments
+    :return: list of dicts with province, district and csv_file
+    """
+    sizes = SCALES[scale] if isinstance(scale, str) else scale
+    output_dir = Path(output_dir)
+    ea_demarcation_dir = output_dir.joinpath("DEMARCATION_DATA")
+
+    districts = []
+    ward_index = 0
+    for p in range(sizes["provinces"]):
+        province = "PROVINCE_{:02d}".format(p)
+        for d in range(sizes["districts"]):
+            district = "P{:02d}D{:02d}".format(p, d)
+            csv_file = generate_district(output_dir.joinpath("raw", province), ea_demarcation_dir, province,
+                                         district, n_wards=sizes["wards"],
+                                         structures_per_ward=sizes["structures"], first_ward_index=ward_index,
+                                         seed=seed + len(districts), **kwargs)
+            districts.append({"province": province, "district": district, "csv_file": csv_file})
+            ward_index += sizes["wards"]
+
+    return districts
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# modules of the package import each other by name (e.g., import utils as ut)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,109 @@
+"""
+Small district for tests: three wards of 4 x 4 EAs with simulated buildings, and a raw
+CSV export of listings in them (see make_district)
+"""
+import contextlib
+import csv
+import io
+import random
+
+import geopandas as gpd
+from shapely.geometry import Point, box
+
+import data_processor as dp
+
+PROVINCE = "P"
+DISTRICT = "D"
+WARDS = ["WARD A", "WARD B", "WARD C"]
+EA_SIZE = 0.025
+
+
+def make_wards(demarcation_dir, wards=WARDS, seed=1, province=PROVINCE, district=DISTRICT):
+    """
+    Saves the EA and buildings layers of each ward
+    :return: district directory
+    """
+    rng = random.Random(seed)
+    district_dir = demarcation_dir.joinpath(province, district)
+    for ward in wards:
+        ward_dir = district_dir.joinpath(ward)
+        ward_dir.mkdir(parents=True)
+        polygons, codes = [], []
+        for i in range(4):
+            for j in range(4):
+                polygons.append(box(28.3 + i * EA_SIZE, -15.4 + j * EA_SIZE,
+                                    28.3 + (i + 1) * EA_SIZE, -15.4 + (j + 1) * EA_SIZE))
+                codes.append("{}{}{}".format(ward[-1], i, j))
+        gpd.GeoDataFrame({"SEA_CODE": codes, "n_HH": 0}, geometry=polygons, crs=4326).to_file(
+            ward_dir.joinpath("EA.shp"))
+        buildings = [Point(28.3 + rng.random() * 0.1, -15.4 + rng.random() * 0.1) for _ in range(300)]
+        gpd.GeoDataFrame({"n_HH": [1] * len(buildings)}, geometry=buildings, crs=4326).to_file(
+            ward_dir.joinpath("SIMULATED_HH_FAKE.shp"))
+
+    return district_dir
+
+
+def listing_rows(params, n=200, wards=WARDS, types=None, seed=0):
+    """
+    Returns raw CSV rows, one in ten with a bad longitude repaired from the fallback
+    coordinates, and the first five rows repeated at the end
+    :param types: structure types picked from, residential three times out of five by default
+    """
+    rng = random.Random(seed)
+    types = types or ["Residential Building"] * 3 + ["Commercial Building", "#NULL!"]
+    cols = list(dict.fromkeys(params['cols_df'] + params['cols_poi'] + params['fallback_coords_cols']))
+    rows = []
+    for i in range(n):
+        row = {c: "" for c in cols}
+        lat, lon = -15.4 + rng.random() * 0.1, 28.3 + rng.random() * 0.1
+        row.update(PROV="LUSAKA", DIST="LUSAKA", CONS="C1", WARD=rng.choice(wards), REGION="R", SEA=str(i % 7),
+                   LOCALITY="L", GeoLocation_Latitude=lat, GeoLocation_Longitude=lon, GPSLocation__Latitude=lat,
+                   GPSLocation__Longitude="#NULL!" if i % 10 == 0 else lon,
+                   GPSLocation__Timestamp="2020-08-{:02d}T10:00:00".format(1 + i % 20),
+                   Structure_type_categorisation=rng.choice(types), Household_Population=rng.randint(1, 9),
+                   Males_in_structure=1)
+        rows.append(row)
+
+    return rows + rows[:5]
+
+
+def write_raw_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return path
+
+
+def district_params(**overrides):
+    params = dp.prepare_processing_parameters()
+    params.update(crs="EPSG:4326", ward_workers=1)
+    params.update(overrides)
+
+    return params
+
+
+def make_district(tmp_path, params, **kwargs):
+    """
+    Saves a district with its raw CSV export
+    :param kwargs: see listing_rows
+    :return: (raw CSV file, demarcation directory, district directory)
+    """
+    demarcation_dir = tmp_path.joinpath("DEMARCATION_DATA")
+    district_dir = make_wards(demarcation_dir, wards=kwargs.get("wards", WARDS))
+    raw_csv = write_raw_csv(tmp_path.joinpath("{}_District.csv".format(DISTRICT)), listing_rows(params, **kwargs))
+
+    return raw_csv, demarcation_dir, district_dir
+
+
+def process_district(raw_csv, demarcation_dir, params):
+    """
+    Processes the district, returns the DataProcessor and what it printed
+    """
+    processor = dp.DataProcessor(raw_csv.parent, raw_csv, demarcation_dir, PROVINCE, DISTRICT, params)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        processor.process_data()
+
+    return processor, out.getvalue()
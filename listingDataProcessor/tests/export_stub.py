@@ -0,0 +1,123 @@
+"""
+Local stub of the Survey Solutions v2 export API for downloader tests: exports are started,
+polled and downloaded (with Range requests) as on a server. Failures are injected to test
+retries and resumed downloads
+"""
+import base64
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ExportStub:
+    """
+    Serves the export API on localhost, each export started gets the next archive
+    """
+
+    def __init__(self, archives, workspace="primary"):
+        """
+        :param archives: list of archive bytes, one per export started
+        """
+        self.archives = list(archives)
+        self.workspace = workspace
+        self.jobs = {}
+        self.requests = []
+        # number of 503 responses before answering status and file requests
+        self.status_errors = 0
+        self.file_errors = 0
+        # bytes sent before dropping the connection on the next file request
+        self.truncate_file_at = None
+        # polls an export is reported running before it completes
+        self.polls_until_ready = 1
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handler(self):
+        stub = self
+        prefix = "/{}/api/v2/export".format(self.workspace)
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                stub.requests.append(("POST", self.path, None))
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path != prefix or not stub.archives:
+                    self.send_json(404, {})
+                    return
+                job_id = len(stub.jobs) + 1
+                stub.jobs[job_id] = {"archive": stub.archives.pop(0), "polls": 0}
+                self.send_json(201, {"JobId": job_id})
+
+            def do_GET(self):
+                stub.requests.append(("GET", self.path, self.headers.get("Range")))
+                parts = self.path[len(prefix) + 1:].split("/")
+                job = stub.jobs.get(int(parts[0])) if parts[0].isdigit() else None
+                if not self.path.startswith(prefix) or job is None:
+                    self.send_json(404, {})
+                elif len(parts) == 1:
+                    self.status(job)
+                else:
+                    self.file(job)
+
+            def status(self, job):
+                if stub.status_errors:
+                    stub.status_errors -= 1
+                    self.send_json(503, {})
+                    return
+                job["polls"] += 1
+                ready = job["polls"] >= stub.polls_until_ready
+                self.send_json(200, {"ExportStatus": "Completed" if ready else "Running", "HasExportFile": ready})
+
+            def file(self, job):
+                if stub.file_errors:
+                    stub.file_errors -= 1
+                    self.send_json(503, {})
+                    return
+                data = job["archive"]
+                start = 0
+                if self.headers.get("Range"):
+                    start = int(self.headers["Range"].split("=")[1].split("-")[0])
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(data) - 1, len(data)))
+                else:
+                    self.send_response(200)
+                digest = base64.b64encode(hashlib.sha256(data).digest()).decode()
+                self.send_header("Repr-Digest", "sha-256=:{}:".format(digest))
+                self.send_header("Content-Length", str(len(data) - start))
+                self.end_headers()
+                if stub.truncate_file_at is not None:
+                    self.wfile.write(data[start:stub.truncate_file_at])
+                    stub.truncate_file_at = None
+                    self.close_connection = True
+                    return
+                self.wfile.write(data[start:])
+
+        return Handler
@@ -0,0 +1,70 @@
+import json
+
+import geopandas as gpd
+import pandas as pd
+
+import benchmark as bm
+import synthetic_data as sd
+
+SMALL = {"provinces": 1, "districts": 2, "wards": 2, "structures": 100}
+
+
+def test_generate(tmp_path):
+    districts = sd.generate(SMALL, tmp_path, seed=0)
+    assert [d["district"] for d in districts] == ["P00D00", "P00D01"]
+
+    params = sd.prepare_processing_parameters()
+    for d in districts:
+        df = pd.read_csv(d["csv_file"])
+        assert set(params["cols_df"]) <= set(df.columns)
+        # every ward has its structures plus some exact and near duplicates
+        counts = df.WARD.value_counts()
+        assert sorted(counts.index) == ["{}_WARD_{:03d}".format(d["district"], w) for w in range(2)]
+        assert (counts >= SMALL["structures"]).all() and (counts < SMALL["structures"] * 1.1).all()
+
+        for ward in counts.index:
+            ward_dir = tmp_path.joinpath("DEMARCATION_DATA", d["province"], d["district"], ward.upper())
+            eas = gpd.read_file(ward_dir.joinpath("EA.shp"))
+            assert len(eas) == 16 and eas.SEA_CODE.is_unique
+            assert len(gpd.read_file(ward_dir.joinpath("SIMULATED_HH_FAKE.shp"))) > 0
+
+    # the same seed gives the same data
+    again = sd.generate(SMALL, tmp_path.joinpath("again"), seed=0)
+    pd.testing.assert_frame_equal(pd.read_csv(again[0]["csv_file"]), pd.read_csv(districts[0]["csv_file"]))
+
+
+def test_run_benchmark(tmp_path):
+    output_file = tmp_path.joinpath("results.json")
+    results = bm.run_benchmark("ward", tmp_path, output_file, trace_memory=False)
+
+    assert list(results["stages"]) == bm.STAGES
+    for metrics in results["stages"].values():
+        assert metrics["wall_seconds"] >= 0 and metrics["peak_rss_mb"] > 0
+        assert metrics["peak_traced_mb"] is None
+    assert results["stages"]["process_raw_listing"]["peak_rss_over_input"] > 0
+    with open(output_file) as f:
+        assert json.load(f)["stages"] == results["stages"]
+    assert bm.compare_results(results, results) == []
+
+
+def test_measure():
+    value, metrics = bm.measure(sum, range(1000))
+    assert value == sum(range(1000))
+    assert set(metrics) == {"wall_seconds", "cpu_seconds", "peak_traced_mb", "peak_rss_mb", "max_rss_mb"}
+    assert metrics["peak_traced_mb"] is not None
+
+
+def test_compare_results():
+    baseline = {"stages": {"a": {"wall_seconds": 10.0, "peak_traced_mb": None, "peak_rss_mb": 100.0},
+                           "b": {"wall_seconds": 0.0, "peak_traced_mb": 5.0, "peak_rss_mb": 100.0}}}
+    current = {"stages": {"a": {"wall_seconds": 12.5, "peak_traced_mb": 50.0, "peak_rss_mb": 119.0},
+                          "b": {"wall_seconds": 3.0, "peak_traced_mb": 5.5, "peak_rss_mb": 100.0},
+                          "c": {"wall_seconds": 99.0}}}
+
+    # missing or zero baseline values and new stages are not compared
+    assert bm.compare_results(baseline, current) == [
+        {"stage": "a", "metric": "wall_seconds", "baseline": 10.0, "current": 12.5}]
+    assert bm.compare_results(baseline, current, tolerance=0.05) == [
+        {"stage": "a", "metric": "wall_seconds", "baseline": 10.0, "current": 12.5},
+        {"stage": "a", "metric": "peak_rss_mb", "baseline": 100.0, "current": 119.0},
+        {"stage": "b", "metric": "peak_traced_mb", "baseline": 5.0, "current": 5.5}]
@@ -0,0 +1,100 @@
+import pandas as pd
+import pytest
+
+import csv_reader as cr
+
+HEADER = "WARD,Structure_Name,Household_Population\n"
+
+
+def write_latin1_in_the_middle(path, rows=120000):
+    """
+    Writes a CSV file larger than two 1 MB samples with Latin-1 accents only in its middle rows
+    """
+    lines = [HEADER]
+    for i in range(rows):
+        name = "Chipat\xe9 n\xba{}".format(i) if i == rows // 2 else "STRUCT_{}".format(i)
+        lines.append("WARD_{},{},{}\n".format(i % 7, name, i % 9))
+    path.write_bytes("".join(lines).encode("latin1"))
+
+    return lines
+
+
+def test_latin1_in_the_middle_of_a_large_file(tmp_path):
+    path = tmp_path.joinpath("listing.csv")
+    write_latin1_in_the_middle(path)
+    assert path.stat().st_size > 2 << 20
+
+    df = pd.concat(cr.iter_csv(path, chunksize=50000), ignore_index=True)
+    assert len(df) == 120000
+    assert df.loc[60000, "Structure_Name"] == "Chipat\xe9 n\xba60000"
+    assert df.loc[59999, "Structure_Name"] == "STRUCT_59999"
+
+
+def test_utf8_file(tmp_path):
+    path = tmp_path.joinpath("listing.csv")
+    path.write_bytes((HEADER + "WARD_1,Chipat\xe9,4\n").encode("utf-8"))
+
+    df = next(cr.iter_csv(path))
+    assert df.loc[0, "Structure_Name"] == "Chipat\xe9"
+
+
+@pytest.mark.parametrize("read_size", [1, 7, 1 << 20])
+def test_utf8_or_latin1(tmp_path, read_size):
+    # UTF-8 characters split between reads, Latin-1 bytes and a Latin-1 byte at the end
+    text = "\u20ac Chipat\xe9 \u0144".encode("utf-8") + "Chipat\xe9 n\xba".encode("latin1") + b" \xe9\xe9 ok \xe9"
+    path = tmp_path.joinpath("mixed.txt")
+    path.write_bytes(text)
+
+    with cr.Utf8OrLatin1(open(path, "rb")) as f:
+        converted = b"".join(iter(lambda: f.read(read_size), b""))
+        assert f.fallback_used
+    assert converted.decode("utf-8") == "\u20ac Chipat\xe9 \u0144Chipat\xe9 n\xba \xe9\xe9 ok \xe9"
+
+
+def test_malformed_rows_are_quarantined(tmp_path):
+    path = tmp_path.joinpath("listing.csv")
+    path.write_text(HEADER + 'WARD_1,"Name, with comma",4\n'
+                             "WARD_2,too,many,fields\n"
+                             'WARD_3,"quoted\nline break",5\n'
+                             "WARD_4,too few\n"
+                             "WARD_5,STRUCT_5,6\n")
+    quarantine_file = tmp_path.joinpath("bad_lines.csv")
+    stats = {}
+
+    df = pd.concat(cr.iter_csv(path, quarantine_file=quarantine_file, stats=stats), ignore_index=True)
+
+    assert list(df["WARD"]) == ["WARD_1", "WARD_3", "WARD_5"]
+    assert list(df["Structure_Name"]) == ["Name, with comma", "quoted\nline break", "STRUCT_5"]
+    assert list(df["Household_Population"]) == [4, 5, 6]
+    assert stats["bad_lines"] == 2
+    bad = pd.read_csv(quarantine_file)
+    assert list(bad.columns) == cr.QUARANTINE_COLUMNS
+    # lines count the header
+    assert list(bad["line"]) == [3, 5]
+    assert list(bad["expected_fields"]) == [3, 3]
+    assert list(bad["actual_fields"]) == [4, 2]
+    assert list(bad["text"]) == ["WARD_2,too,many,fields", "WARD_4,too few"]
+
+
+def test_quarantine_file_of_previous_read_is_removed(tmp_path):
+    path = tmp_path.joinpath("listing.csv")
+    path.write_text(HEADER + "WARD_1,STRUCT_1,4\n")
+    quarantine_file = tmp_path.joinpath("bad_lines.csv")
+    quarantine_file.write_text("stale")
+
+    next(cr.iter_csv(path, quarantine_file=quarantine_file))
+
+    assert not quarantine_file.exists()
+
+
+def test_numbers_are_inferred_as_read_csv(tmp_path):
+    path = tmp_path.joinpath("listing.csv")
+    path.write_text("WARD,Count,Missing,Junk\nWARD_1,4,1.5,3\nWARD_2,5,,#NULL!\n")
+
+    df = next(cr.iter_csv(path, dtypes={"WARD": "category"}))
+    expected = pd.read_csv(path, dtype={"WARD": "category"})
+
+    assert isinstance(df["WARD"].dtype, pd.CategoricalDtype)
+    for c in ["Count", "Missing"]:
+        pd.testing.assert_series_equal(df[c], expected[c])
+    assert list(df["Junk"]) == list(expected["Junk"])
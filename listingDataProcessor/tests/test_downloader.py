@@ -0,0 +1,152 @@
+import io
+import json
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import downloader as dl
+from export_stub import ExportStub
+
+QUESTIONNAIRE = "11111111111111111111111111111111$1"
+
+
+def export_archive(rows, seed=0):
+    """
+    Returns a Survey Solutions like tabular export archive, stored uncompressed so that
+    its size is about that of the data
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({"interview__key": ["{:08x}".format(i) for i in range(rows)],
+                       "noise": [rng.bytes(24).hex() for _ in range(rows)]})
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as z:
+        z.writestr("listing.tab", df.to_csv(sep="\t", index=False))
+        z.writestr("export__readme.txt", "stub export")
+
+    return buf.getvalue(), df
+
+
+def downloader(stub, tmp_path):
+    return dl.ExportDownloader(base_url=stub.base_url, workspace=stub.workspace, user="api", password="secret",
+                               raw_csv_dir=tmp_path, max_workers=2, poll_interval=0)
+
+
+JOB = {"province": "LUSAKA", "district": "LUSAKA", "questionnaire_id": QUESTIONNAIRE}
+
+
+def read_csv(path):
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def test_download_unpacks_and_cleans_up(tmp_path):
+    archive, df = export_archive(100)
+    with ExportStub([archive]) as stub:
+        result = downloader(stub, tmp_path).download_job(JOB)
+
+    assert result["success"], result["traceback"]
+    pd.testing.assert_frame_equal(read_csv(result["csv_file"]), df)
+    district_dir = tmp_path.joinpath("LUSAKA", "LUSAKA")
+    assert not list(district_dir.glob("*.zip*"))
+    assert not district_dir.joinpath(dl.EXPORT_JOB_FILENAME).exists()
+
+
+def test_rerun_requests_a_new_export(tmp_path):
+    first, _ = export_archive(50, seed=1)
+    second, df = export_archive(80, seed=2)
+    with ExportStub([first, second]) as stub:
+        d = downloader(stub, tmp_path)
+        assert d.download_job(JOB)["success"]
+        result = d.download_job(JOB)
+        started = [r for r in stub.requests if r[0] == "POST"]
+
+    assert result["success"], result["traceback"]
+    assert len(started) == 2
+    pd.testing.assert_frame_equal(read_csv(result["csv_file"]), df)
+
+
+def test_interrupted_download_resumes_same_export(tmp_path):
+    archive, df = export_archive(60000)
+    assert len(archive) > 3 << 20
+    with ExportStub([archive]) as stub:
+        d = downloader(stub, tmp_path)
+        stub.truncate_file_at = len(archive) - (1 << 20)
+        failed = d.download_job(JOB)
+        assert not failed["success"]
+        assert list(tmp_path.joinpath("LUSAKA", "LUSAKA").glob("*.part"))
+
+        result = d.download_job(JOB)
+        ranges = [r[2] for r in stub.requests if r[1].endswith("/file")]
+        started = [r for r in stub.requests if r[0] == "POST"]
+
+    assert result["success"], result["traceback"]
+    assert len(started) == 1
+    assert ranges[0] is None and ranges[1].startswith("bytes=") and ranges[1] != "bytes=0-"
+    pd.testing.assert_frame_equal(read_csv(result["csv_file"]), df)
+
+
+def test_partial_download_of_another_export_is_not_resumed(tmp_path):
+    archive, df = export_archive(100)
+    district_dir = tmp_path.joinpath("LUSAKA", "LUSAKA")
+    district_dir.mkdir(parents=True)
+    district_dir.joinpath("LUSAKA_export_99.zip.part").write_bytes(b"bytes of another export")
+    with ExportStub([archive]) as stub:
+        result = downloader(stub, tmp_path).download_job(JOB)
+        ranges = [r[2] for r in stub.requests if r[1].endswith("/file")]
+
+    assert result["success"], result["traceback"]
+    assert ranges == [None]
+    assert not list(district_dir.glob("*.part"))
+    pd.testing.assert_frame_equal(read_csv(result["csv_file"]), df)
+
+
+def test_transient_errors_are_retried(tmp_path):
+    archive, df = export_archive(100)
+    with ExportStub([archive]) as stub:
+        stub.status_errors = 2
+        stub.file_errors = 1
+        stub.polls_until_ready = 3
+        result = downloader(stub, tmp_path).download_job(JOB)
+
+    assert result["success"], result["traceback"]
+    pd.testing.assert_frame_equal(read_csv(result["csv_file"]), df)
+
+
+def test_checksum_mismatch_fails_and_starts_over(tmp_path, monkeypatch):
+    archive, df = export_archive(100)
+    real_sha256 = dl.reported_sha256
+    monkeypatch.setattr(dl, "reported_sha256", lambda headers: "0" * 64)
+    with ExportStub([archive]) as stub:
+        d = downloader(stub, tmp_path)
+        failed = d.download_job(JOB)
+        assert not failed["success"]
+        assert "Checksum" in failed["error"]
+        assert not list(tmp_path.joinpath("LUSAKA", "LUSAKA").glob("*.zip*"))
+
+        monkeypatch.setattr(dl, "reported_sha256", real_sha256)
+        result = d.download_job(JOB)
+
+    assert result["success"], result["traceback"]
+    pd.testing.assert_frame_equal(read_csv(result["csv_file"]), df)
+
+
+@pytest.mark.parametrize("header", ["Repr-Digest", "Digest"])
+def test_reported_sha256(header):
+    value = "sha-256=:47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU=:"
+    if header == "Digest":
+        value = "SHA-256=47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU="
+    assert dl.reported_sha256({header: value}) == "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+    assert dl.reported_sha256({}) is None
+
+
+def test_interrupted_job_is_tied_to_questionnaire(tmp_path):
+    district_dir = tmp_path.joinpath("LUSAKA", "LUSAKA")
+    district_dir.mkdir(parents=True)
+    with open(district_dir.joinpath(dl.EXPORT_JOB_FILENAME), "w") as f:
+        json.dump({"questionnaire_id": "other$1", "job_id": 7}, f)
+    d = dl.ExportDownloader(base_url="http://127.0.0.1:1", workspace="primary", user="u", password="p",
+                            raw_csv_dir=tmp_path)
+
+    assert d.interrupted_job(JOB) is None
+    assert d.interrupted_job({**JOB, "questionnaire_id": "other$1"}) == 7
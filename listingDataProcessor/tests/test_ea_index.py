@@ -0,0 +1,71 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import box
+
+import ea_index as eai
+
+
+@pytest.fixture
+def index():
+    eas = [box(i, j, i + 1, j + 1) for i in range(10) for j in range(10)]
+    return eai.EAIndex.build(gpd.GeoDataFrame(geometry=eas), layer_hash="eas")
+
+
+def test_raster_matches_index(index):
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(-1, 11, 5000), rng.uniform(-1, 11, 5000)
+    raster = eai.ea_raster_or_index(index, 0.3)
+
+    assert isinstance(raster, eai.EARaster)
+    for got, expected in zip(raster.query_points(x, y), index.query_points(x, y)):
+        np.testing.assert_array_equal(got, expected)
+
+
+def test_raster_over_max_cells_falls_back_to_index(index, monkeypatch, tmp_path):
+    monkeypatch.setattr(eai, "MAX_CELLS", 1000)
+    assert eai.EARaster.grid_shape(index, 0.3) == (34, 34)
+
+    with pytest.raises(ValueError):
+        eai.EARaster.build(index, 0.3)
+    assert eai.ea_raster_or_index(index, 0.3) is index
+    assert eai.load_or_build_ea_raster(tmp_path.joinpath("EA_raster"), index, 0.3) is index
+    assert not list(tmp_path.iterdir())
+    assert isinstance(eai.load_or_build_ea_raster(tmp_path.joinpath("EA_raster"), index, 0.5), eai.EARaster)
+
+
+def test_cached_index_keyed_on_file(tmp_path, monkeypatch):
+    ea_file = tmp_path.joinpath("EA.shp")
+    eas = gpd.GeoDataFrame({"SEA_CODE": [str(i) for i in range(4)]},
+                           geometry=[box(i, 0, i + 1, 1) for i in range(4)], crs=4326)
+    eas.to_file(ea_file)
+    cache_file = tmp_path.joinpath("EA_index.npz")
+
+    def load(**kwargs):
+        ea = gpd.read_file(ea_file)
+        return eai.load_or_build_ea_index(cache_file, ea=ea, ea_aggregation_id="SEA_CODE", crs_info="EPSG:4326",
+                                          ea_file=ea_file, **kwargs)
+    built = load()
+    assert built.file_signature == eai.ea_file_signature(ea_file, "SEA_CODE", "EPSG:4326")
+
+    # same size and modification time, the layer isn't hashed again
+    with monkeypatch.context() as m:
+        m.setattr(eai, "ea_layer_hash", lambda *args: pytest.fail("EA layer hashed"))
+        cached = load()
+    assert cached.layer_hash == built.layer_hash
+    np.testing.assert_array_equal(cached.query_points(np.array([0.5, 3.5]), np.array([0.5, 0.5]))[1], [0, 3])
+
+    # a file only touched is hashed, found unchanged and saved with its new signature
+    stat = ea_file.stat()
+    os.utime(ea_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert load().layer_hash == built.layer_hash
+    assert eai.cached_value(cache_file, "file_signature") == eai.ea_file_signature(ea_file, "SEA_CODE", "EPSG:4326")
+
+    # a changed EA is rebuilt
+    eas.geometry = [box(i, 0, i + 2, 1) for i in range(4)]
+    eas.to_file(ea_file)
+    rebuilt = load()
+    assert rebuilt.layer_hash != built.layer_hash
+    np.testing.assert_array_equal(rebuilt.query_points(np.array([1.5]), np.array([0.5]))[1], [0, 1])
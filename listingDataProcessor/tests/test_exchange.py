@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import exchange as ex
+
+
+def test_later_batches_widen_the_ward_file(tmp_path):
+    path = tmp_path.joinpath("WARD A_df.arrow")
+    with ex.ArrowWardWriters() as writers:
+        writers.write(path, pd.DataFrame({"SEA": ["1", "2"], "HHPop": np.array([3, 4], dtype="int8"),
+                                          "Type": pd.Categorical(["a", "b"])}))
+        # a column added and a count which doesn't fit int8
+        writers.write(path, pd.DataFrame({"SEA": ["3"], "HHPop": np.array([300], dtype="int16"),
+                                          "Type": pd.Categorical(["a"]), "Males": [1.5]}))
+        # a column left out and a missing count
+        writers.write(path, pd.DataFrame({"SEA": ["4"], "HHPop": [np.nan], "Males": [2.0]}))
+
+    df = ex.read_table(path).to_pandas()
+    assert list(df.columns) == ["SEA", "HHPop", "Type", "Males"]
+    assert df.SEA.tolist() == ["1", "2", "3", "4"]
+    assert df.HHPop.tolist()[:3] == [3, 4, 300] and np.isnan(df.HHPop.iloc[3])
+    assert df.Type.tolist()[:3] == ["a", "b", "a"] and pd.isna(df.Type.iloc[3])
+    # rows saved before the column was added come back missing
+    assert df.Males.isna().tolist() == [True, True, False, False]
+    assert df.Males.iloc[2:].tolist() == [1.5, 2.0]
+
+
+def test_ward_files_are_separate(tmp_path):
+    paths = [tmp_path.joinpath("WARD {}_poi.arrow".format(w)) for w in "AB"]
+    with ex.ArrowWardWriters() as writers:
+        for i in range(3):
+            for j, path in enumerate(paths):
+                writers.write(path, pd.DataFrame({"SEA": [str(10 * j + i)]}))
+
+    assert [ex.read_table(p).column("SEA").to_pylist() for p in paths] == [["0", "1", "2"], ["10", "11", "12"]]
+
+
+@pytest.fixture
+def points_file(tmp_path):
+    path = tmp_path.joinpath("WARD A_df.arrow")
+    with ex.ArrowWardWriters() as writers:
+        writers.write(path, pd.DataFrame({"Longitude": [28.3, 28.4], "Latitude": [-15.4, -15.5],
+                                          "HHPop": [3, 4], "SEA": ["1", "2"]}))
+        writers.write(path, pd.DataFrame({"Longitude": [28.5], "Latitude": [-15.6], "HHPop": [np.nan],
+                                          "SEA": ["3"]}))
+
+    return path
+
+
+def test_point_table(points_file):
+    points = ex.read_points(points_file, lon="Longitude", lat="Latitude", crs="EPSG:4326", columns=["HHPop"])
+
+    assert len(points) == 3
+    assert points.table.column_names == ["HHPop", "Longitude", "Latitude"]
+    np.testing.assert_array_equal(points.x, [28.3, 28.4, 28.5])
+    np.testing.assert_array_equal(points.values("HHPop"), [3, 4, np.nan])
+    # geometries are only built when asked for
+    assert points._geometry is None
+
+    projected = points.to_crs("EPSG:32735")
+    assert projected.table is points.table and projected._geometry is None
+    assert projected.to_crs("EPSG:32735") is projected
+    assert (projected.x > 100000).all() and points._geometry is None
+
+    gdf = points.to_geodataframe()
+    assert gdf.geometry.x.tolist() == [28.3, 28.4, 28.5] and gdf.geometry.y.tolist() == [-15.4, -15.5, -15.6]
+    assert gdf.crs.to_epsg() == 4326
+    assert gdf.HHPop.isna().tolist() == [False, False, True]
+    assert gdf.to_crs("EPSG:32735").geometry.x.round(3).tolist() == projected.x.round(3).tolist()
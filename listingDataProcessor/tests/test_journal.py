@@ -0,0 +1,59 @@
+import pandas as pd
+import pytest
+
+import data_processor as dp
+import manifest as mf
+import rollup as rl
+import storage as st
+from district_fixture import district_params, make_district, process_district, WARDS, PROVINCE, DISTRICT
+
+
+def ea_outputs(demarcation_dir, district_dir, storage_format):
+    layers = {w: pd.DataFrame(st.read_layer(district_dir.joinpath(w), "EA_attributes", storage_format))
+              for w in WARDS}
+    return layers, rl.load_district_eas(demarcation_dir.joinpath("national_rollup"), PROVINCE, DISTRICT)
+
+
+@pytest.mark.parametrize("storage_format", ["shapefile", "gpkg"])
+def test_interrupted_run_resumes(tmp_path, monkeypatch, storage_format):
+    params = district_params(storage_format=storage_format)
+    raw_csv, demarcation_dir, district_dir = make_district(tmp_path.joinpath("expected"), params)
+    process_district(raw_csv, demarcation_dir, params)
+    expected_layers, expected_store = ea_outputs(demarcation_dir, district_dir, storage_format)
+
+    raw_csv, demarcation_dir, district_dir = make_district(tmp_path.joinpath("resumed"), params)
+    ea_hash = mf.file_hash(district_dir.joinpath("WARD A", "EA.shp"))
+    append_attributes = dp.DataProcessor.append_building_attributes_to_ward_ea
+    calls = []
+
+    def crash_in_ward_b(self, ward_dir, **kwargs):
+        if ward_dir.name == "WARD B":
+            raise KeyboardInterrupt
+        return append_attributes(self, ward_dir, **kwargs)
+
+    def count_calls(self, ward_dir, **kwargs):
+        calls.append(ward_dir.name)
+        return append_attributes(self, ward_dir, **kwargs)
+
+    monkeypatch.setattr(dp.DataProcessor, "append_building_attributes_to_ward_ea", crash_in_ward_b)
+    with pytest.raises(KeyboardInterrupt):
+        process_district(raw_csv, demarcation_dir, params)
+
+    monkeypatch.setattr(dp.DataProcessor, "append_building_attributes_to_ward_ea", count_calls)
+    processor, out = process_district(raw_csv, demarcation_dir, params)
+    assert "Resuming unfinished run of D district" in out
+    assert "create_ward_layers: 3 wards already done, 0 to go" in out
+    assert calls == ["WARD B", "WARD C"]
+    assert processor.journal.entries()[-1]["event"] == "finished"
+
+    layers, store = ea_outputs(demarcation_dir, district_dir, storage_format)
+    for ward in WARDS:
+        pd.testing.assert_frame_equal(layers[ward], expected_layers[ward])
+    pd.testing.assert_frame_equal(store, expected_store)
+    # the EA layer itself is never written to
+    assert mf.file_hash(district_dir.joinpath("WARD A", "EA.shp")) == ea_hash
+
+    calls.clear()
+    _, out = process_district(raw_csv, demarcation_dir, params)
+    assert "Resuming" not in out and "0 of 3 wards have new inputs" in out
+    assert calls == []
@@ -0,0 +1,85 @@
+import pytest
+
+import exchange as ex
+import manifest as mf
+import storage as st
+from district_fixture import district_params, listing_rows, make_district, process_district, write_raw_csv
+
+
+@pytest.fixture
+def district(tmp_path):
+    params = district_params()
+    raw_csv, demarcation_dir, district_dir = make_district(tmp_path, params)
+    process_district(raw_csv, demarcation_dir, params)
+
+    return raw_csv, demarcation_dir, district_dir
+
+
+def test_unchanged_wards_skipped(district):
+    raw_csv, demarcation_dir, district_dir = district
+    manifest = mf.load_manifest(district_dir)
+    assert sorted(manifest["wards"]) == ["WARD A", "WARD B", "WARD C"]
+
+    params = district_params(ward_workers=2, write_queue_size=0, progress_lookback_hours=1)
+    _, out = process_district(raw_csv, demarcation_dir, params)
+    assert "0 of 3 wards have new inputs" in out
+
+
+def test_ward_with_new_inputs_rebuilt(district):
+    raw_csv, demarcation_dir, district_dir = district
+    ea_attributes = district_dir.joinpath("WARD B", "EA_attributes.shp")
+    saved = ea_attributes.stat().st_mtime_ns
+    ea = district_dir.joinpath("WARD A", "EA.dbf")
+    ea.write_bytes(ea.read_bytes().replace(b"A00", b"A99"))
+
+    _, out = process_district(raw_csv, demarcation_dir, district_params())
+    assert "1 of 3 wards have new inputs" in out
+    assert ea_attributes.stat().st_mtime_ns == saved
+    # ward files are rewritten but hold the same rows so the DF and POIs layers are kept
+    assert "Ward layers: 0 written, 2 skipped as up to date" in out
+
+    district_dir.joinpath("WARD C", "EA_attributes.shp").unlink()
+    _, out = process_district(raw_csv, demarcation_dir, district_params())
+    assert "1 of 3 wards have new inputs" in out
+
+
+@pytest.mark.parametrize("changed", [{"chunk_size": 50}, {"memory_budget_mb": 64}, {"dedup_radius_m": 5.0}])
+def test_params_changing_ward_files_rebuild_all_wards(district, changed):
+    raw_csv, demarcation_dir, _ = district
+    assert mf.params_hash(district_params(**changed)) != mf.params_hash(district_params())
+
+    _, out = process_district(raw_csv, demarcation_dir, district_params(**changed))
+    assert "3 of 3 wards have new inputs" in out
+
+
+@pytest.mark.parametrize("ward_exchange_format", ["arrow", "csv"])
+def test_record_added_only_rebuilds_its_ward(tmp_path, ward_exchange_format):
+    # ward files are written chunk by chunk, a record added first moves every chunk boundary
+    params = district_params(chunk_size=50, ward_exchange_format=ward_exchange_format)
+    raw_csv, demarcation_dir, district_dir = make_district(tmp_path, params)
+    process_district(raw_csv, demarcation_dir, params)
+    ward_a = district_dir.joinpath("WARD A")
+    pois = len(st.read_layer(ward_a, "WARD A_poi", "shapefile"))
+
+    rows = listing_rows(params, seed=0)
+    added = listing_rows(params, n=1, wards=["WARD A"], types=["Commercial Building"], seed=7)[:1]
+    write_raw_csv(raw_csv, added + rows)
+    _, out = process_district(raw_csv, demarcation_dir, params)
+    assert "1 of 3 wards have new inputs" in out
+    assert "Ward layers: 1 written, 1 skipped as up to date" in out
+    assert len(st.read_layer(ward_a, "WARD A_poi", "shapefile")) == pois + 1
+
+
+def test_ward_missing_from_export_loses_its_listings(tmp_path):
+    params = district_params()
+    raw_csv, demarcation_dir, district_dir = make_district(tmp_path, params)
+    process_district(raw_csv, demarcation_dir, params)
+    ward_c = district_dir.joinpath("WARD C")
+    assert ex.ward_file(ward_c, "df", "arrow").exists()
+
+    write_raw_csv(raw_csv, [r for r in listing_rows(params) if r["WARD"] != "WARD C"])
+    _, out = process_district(raw_csv, demarcation_dir, params)
+    assert "1 of 3 wards have new inputs" in out
+    assert not ex.ward_file(ward_c, "df", "arrow").exists()
+    assert st.read_layer(ward_c, "WARD C_df", "shapefile").empty
+    assert st.read_layer(ward_c, "EA_attributes", "shapefile").HHPop.sum() == 0
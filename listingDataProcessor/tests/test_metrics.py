@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import benchmark as bm
+import metrics as mt
+
+
+def allocate(mb=200):
+    """
+    Touches mb MB of memory and frees it, the peak resident memory grows by about mb
+    """
+    block = np.ones(mb * 1024 ** 2 // 8)
+    del block
+
+
+def resident_mb():
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) / 1024 for line in f if line.startswith("VmRSS:"))
+
+
+@pytest.fixture
+def peak_is_resettable():
+    try:
+        mt.reset_peak_rss()
+        open("/proc/self/clear_refs", "w").close()
+    except OSError:
+        pytest.skip("peak resident memory can't be reset on this platform")
+
+
+def ward_stage():
+    # ward timers within a stage, the memory is used before the first one starts
+    allocate()
+    return [mt.StageTimer().stop()["peak_rss_mb"] for _ in range(2)]
+
+
+def test_nested_timer_keeps_outer_peak(peak_is_resettable):
+    before = resident_mb()
+    outer = mt.StageTimer()
+    inner_peaks = ward_stage()
+    stage = outer.stop()
+
+    assert stage["peak_rss_mb"] > before + 150
+    assert all(p < before + 150 for p in inner_peaks)
+    assert outer not in mt.running_timers
+
+
+def test_measure_keeps_peak_before_ward_timers(peak_is_resettable):
+    before = resident_mb()
+    inner_peaks, metrics = bm.measure(ward_stage, trace_memory=False)
+
+    assert metrics["peak_rss_mb"] > before + 150
+    assert all(p < before + 150 for p in inner_peaks)
+
+
+def test_timer_stopped_when_stage_fails():
+    def fail():
+        raise ValueError("bad ward")
+
+    running = list(mt.running_timers)
+    with pytest.raises(ValueError):
+        bm.measure(fail, trace_memory=False)
+    assert mt.running_timers == running
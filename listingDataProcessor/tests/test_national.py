@@ -0,0 +1,74 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+import national as nt
+import storage as st
+
+BUILDINGS_FORMATS = {"geoparquet": "buildings.parquet", "gpkg": "buildings.gpkg", "shapefile": "buildings.shp"}
+
+
+@pytest.fixture
+def layers(tmp_path):
+    rng = np.random.default_rng(5)
+    # EA 7 is made of two polygons, some buildings are outside all EAs
+    ea = gpd.GeoDataFrame({"SEA_CODE": ["E{}".format(min(i, 7)) for i in range(9)]},
+                          geometry=[box(28 + i % 3 * 0.1, -15 + i // 3 * 0.1, 28.1 + i % 3 * 0.1,
+                                        -14.9 + i // 3 * 0.1) for i in range(9)], crs=4326)
+    ea_file = tmp_path.joinpath("EA.shp")
+    ea.to_file(ea_file)
+    n = 300
+    buildings = gpd.GeoDataFrame({"n_HH": rng.integers(0, 4, n)},
+                                 geometry=gpd.points_from_xy(rng.uniform(27.95, 28.35, n),
+                                                             rng.uniform(-15.05, -14.65, n)), crs=4326)
+    files = {}
+    for storage_format, name in BUILDINGS_FORMATS.items():
+        files[storage_format] = tmp_path.joinpath(name)
+        if storage_format == "geoparquet":
+            buildings.to_parquet(files[storage_format])
+        else:
+            buildings.to_file(files[storage_format])
+
+    return ea, buildings, ea_file, files
+
+
+def count_by_sjoin(ea, buildings):
+    joined = gpd.sjoin(buildings, ea, how="inner", predicate="within")
+    counts = joined.groupby("SEA_CODE").n_HH.sum()
+
+    return counts.reindex(pd.unique(ea.SEA_CODE), fill_value=0)
+
+
+@pytest.mark.parametrize("storage_format", list(BUILDINGS_FORMATS))
+def test_file_batches(layers, storage_format):
+    _, buildings, _, files = layers
+    batches = list(st.iter_file_batches(files[storage_format], columns=["n_HH"], batch_size=37))
+
+    assert len(batches) == 9 and all(len(b) <= 37 for b in batches)
+    df = pd.concat(batches, ignore_index=True)
+    assert list(df.columns) == ["n_HH", "geometry"] and df.crs.to_epsg() == 4326
+    assert df.n_HH.tolist() == buildings.n_HH.tolist()
+    assert df.geometry.geom_equals_exact(buildings.geometry, tolerance=1e-9).all()
+
+
+@pytest.mark.parametrize("storage_format", list(BUILDINGS_FORMATS))
+@pytest.mark.parametrize("lookup", ["index", "cached index", "raster"])
+def test_count_in_batches_matches_sjoin(layers, tmp_path, storage_format, lookup):
+    ea, buildings, ea_file, files = layers
+    kwargs = {}
+    if lookup != "index":
+        kwargs["cache_file"] = str(tmp_path.joinpath("EA_index.npz"))
+    if lookup == "raster":
+        kwargs["raster_resolution"] = 0.01
+    stats = {}
+
+    df = nt.count_buildings_by_ea(ea_file, files[storage_format], "SEA_CODE", "EPSG:4326", batch_size=37,
+                                  stats=stats, **kwargs)
+
+    expected = count_by_sjoin(ea, buildings)
+    assert df.SEA_CODE.tolist() == expected.index.tolist()
+    assert df.StructCntBlds.tolist() == expected.tolist()
+    assert stats["bld_points"] == len(buildings)
+    assert 0 < stats["bld_matched"] < len(buildings)
@@ -0,0 +1,32 @@
+import pandas as pd
+
+import storage as st
+from district_fixture import WARDS, district_params, make_district, process_district
+
+
+def ward_outputs(district_dir, params):
+    layers = {}
+    for ward in WARDS:
+        ward_dir = district_dir.joinpath(ward)
+        for layer in ["{}_df".format(ward), "{}_poi".format(ward), params["ward_level_ea_output_filename"]]:
+            layers[ward, layer] = st.read_layer(ward_dir, layer, params["storage_format"])
+
+    return layers
+
+
+def test_process_pool_matches_serial_run(tmp_path):
+    outputs = {}
+    for workers in [1, 2]:
+        params = district_params(ward_workers=workers)
+        raw_csv, demarcation_dir, district_dir = make_district(tmp_path.joinpath(str(workers)), params)
+        _, out = process_district(raw_csv, demarcation_dir, params)
+        assert "failed" not in out
+        outputs[workers] = ward_outputs(district_dir, params)
+
+    serial, pooled = outputs[1], outputs[2]
+    assert list(serial) == list(pooled)
+    for key, layer in serial.items():
+        assert len(layer) > 0, key
+        # wards are saved by different processes but rows and values are the same
+        pd.testing.assert_frame_equal(pooled[key].drop(columns="geometry"), layer.drop(columns="geometry"))
+        assert pooled[key].geometry.geom_equals_exact(layer.geometry, tolerance=1e-9).all(), key
@@ -0,0 +1,108 @@
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import progress as pg
+import storage as st
+from district_fixture import (district_params, listing_rows, make_wards, process_district, write_raw_csv,
+                              DISTRICT, WARDS)
+
+
+def update(raw_csv, district_dir, params, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return pg.update_progress(raw_csv, district_dir, params, chunk_size=60, **kwargs)
+
+
+@pytest.fixture
+def exports(tmp_path):
+    """
+    Two exports of a district, the second has all records and records of the last days of the
+    first which were synced late
+    """
+    params = district_params()
+    rows = listing_rows(params, n=400)
+    demarcation_dir = tmp_path.joinpath("DEMARCATION_DATA")
+    district_dir = make_wards(demarcation_dir)
+    day = [int(r["GPSLocation__Timestamp"][8:10]) for r in rows]
+    first = [r for i, (r, d) in enumerate(zip(rows, day)) if d < 10 or (d == 10 and i % 3)]
+    raw_csvs = [write_raw_csv(tmp_path.joinpath("export{}.csv".format(i)), e) for i, e in enumerate([first, rows])]
+    raw_csvs.append(write_raw_csv(tmp_path.joinpath("{}_District.csv".format(DISTRICT)), rows))
+
+    return params, raw_csvs, demarcation_dir, district_dir
+
+
+def test_incremental_progress_equals_rebuild(exports):
+    params, (first, second, _), _, district_dir = exports
+    update(first, district_dir, params)
+    totals = update(second, district_dir, params)
+    state = pg.ProgressStore(district_dir).load_state()
+    assert state["update"] == 2
+    assert state["records"] == totals[["StructCntHHs", "StructCntPOIs"]].to_numpy().sum()
+
+    # rerunning on the same export takes nothing in
+    pd.testing.assert_frame_equal(update(second, district_dir, params), totals)
+    assert pg.ProgressStore(district_dir).load_state()["update"] == 2
+
+    rebuilt = update(second, district_dir, params, rebuild=True)
+    pd.testing.assert_frame_equal(totals, rebuilt)
+    daily = pg.ProgressStore(district_dir).load_table("daily")
+    last = daily.sort_values("day").groupby(["ward", "ea"]).last()
+    assert (last["StructCntHHs_to_date"].sum(), last["HHPop_to_date"].sum()) == (
+        totals.StructCntHHs.sum(), totals.HHPop.sum())
+
+
+def test_progress_equals_processed_district(exports):
+    params, (first, second, district_csv), demarcation_dir, district_dir = exports
+    update(first, district_dir, params)
+    totals = update(second, district_dir, params)
+    process_district(district_csv, demarcation_dir, params)
+
+    for ward in WARDS:
+        ea = st.read_layer(district_dir.joinpath(ward), "EA_attributes", "shapefile")
+        ward_totals = totals[totals.ward == ward].set_index("ea").loc[ea.SEA_CODE]
+        np.testing.assert_array_equal(ward_totals.HHPop, ea.HHPop)
+        # shapefile field names are cut to 10 characters
+        np.testing.assert_array_equal(ward_totals.StructCntHHs, ea.StructCntH)
+        np.testing.assert_array_equal(ward_totals.StructCntPOIs, ea.StructCntP)
+
+
+def test_seen_coordinates_memory_mapped(exports):
+    params, (first, second, _), _, district_dir = exports
+    update(first, district_dir, params)
+    totals = update(second, district_dir, params)
+
+    store = pg.ProgressStore(district_dir)
+    assert sorted(f.name for f in store.seen_dir.iterdir()) == ["000002_df.npy", "000002_poi.npy"]
+    seen = store.seen_coordinates(2)
+    keys = seen["df"].segments[0]
+    assert isinstance(keys, np.memmap)
+    assert (keys[1:] > keys[:-1]).all()
+    assert len(seen["df"]) + len(seen["poi"]) == totals[["StructCntHHs", "StructCntPOIs"]].to_numpy().sum()
+
+
+def test_records_of_ward_without_ea_layer_left_pending(exports, tmp_path):
+    params, (first, second, _), _, district_dir = exports
+    ward_c = district_dir.joinpath("WARD C")
+    moved = tmp_path.joinpath("WARD C EA")
+    moved.mkdir()
+    for f in ward_c.glob("EA.*"):
+        f.rename(moved.joinpath(f.name))
+
+    stats = {}
+    totals = update(first, district_dir, params, stats=stats)
+    assert "WARD C" not in set(totals.ward) and stats["records_pending"] > 0
+    state = pg.ProgressStore(district_dir).load_state()
+    assert state["pending_since"] is not None
+    assert state["records"] == totals[["StructCntHHs", "StructCntPOIs"]].to_numpy().sum()
+
+    # the layer is added, records of the first export left pending are taken in with the second export
+    for f in moved.iterdir():
+        f.rename(ward_c.joinpath(f.name))
+    totals = update(second, district_dir, params)
+    assert pg.ProgressStore(district_dir).load_state()["pending_since"] is None
+
+    rebuilt = update(second, district_dir, params, rebuild=True)
+    pd.testing.assert_frame_equal(totals, rebuilt)
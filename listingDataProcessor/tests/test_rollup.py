@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import rollup as rl
+
+
+def ward_eas(constituency, ward, rows):
+    """
+    :param rows: (ea, HHPop, StructCntHHs, StructCntPOIs, StructCntBlds) tuples
+    """
+    df = pd.DataFrame(rows, columns=["ea", "HHPop", "StructCntHHs", "StructCntPOIs", "StructCntBlds"])
+    df["TotalStruct"] = df.StructCntHHs + df.StructCntPOIs
+
+    return df.assign(constituency=constituency, ward=ward)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store_dir = str(tmp_path.joinpath("national_rollup"))
+    rl.update_district_eas(store_dir, "P1", "D1", [
+        ward_eas("C1", "W1", [("E1", 10, 3, 1, 8), ("E2", 5, 2, 0, 0)]),
+        ward_eas("C1", "W2", [("E3", 7, 2, 2, 2)])])
+    rl.update_district_eas(store_dir, "P1", "D2", [ward_eas("C2", "W3", [("E4", 4, 1, 1, 4)])])
+    rl.update_district_eas(store_dir, "P2", "D3", [ward_eas("C3", "W4", [("E5", 9, 3, 0, 0)])])
+
+    return store_dir
+
+
+def test_rollup_totals(store):
+    tables = rl.build_rollups(store)
+
+    ward = tables["ward"].set_index("ward")
+    assert ward.EAs.to_dict() == {"W1": 2, "W2": 1, "W3": 1, "W4": 1}
+    assert ward.HHPop.to_dict() == {"W1": 15, "W2": 7, "W3": 4, "W4": 9}
+    assert ward.TotalStruct.to_dict() == {"W1": 6, "W2": 4, "W3": 2, "W4": 3}
+    assert ward.loc["W1", "district"] == "D1" and ward.loc["W3", "constituency"] == "C2"
+
+    district = tables["district"].set_index("district")
+    assert district.HHPop.to_dict() == {"D1": 22, "D2": 4, "D3": 9}
+    assert district.StructCntBlds.to_dict() == {"D1": 10, "D2": 4, "D3": 0}
+    province = tables["province"].set_index("province")
+    assert province.EAs.to_dict() == {"P1": 4, "P2": 1}
+    assert province.StructCntHHs.to_dict() == {"P1": 8, "P2": 3}
+    national = tables["national"].iloc[0]
+    assert (national.EAs, national.HHPop, national.TotalStruct, national.StructCntBlds) == (5, 35, 15, 14)
+
+    # listed structures per building footprint, missing without footprints
+    assert ward.ListingToImagery.loc[["W1", "W2", "W3"]].tolist() == [6 / 8, 4 / 2, 2 / 4]
+    assert np.isnan(ward.ListingToImagery["W4"]) and np.isnan(district.ListingToImagery["D3"])
+    assert province.ListingToImagery["P1"] == 12 / 14
+    assert national.ListingToImagery == 15 / 14
+
+
+def test_updated_ward_replaces_only_its_eas(store):
+    rl.update_district_eas(store, "P1", "D1", [ward_eas("C1", "W2", [("E3", 1, 1, 0, 1), ("E6", 2, 1, 0, 1)])])
+    eas = rl.load_district_eas(store, "P1", "D1")
+
+    assert eas.ea.tolist() == ["E1", "E2", "E3", "E6"]
+    assert eas.HHPop.tolist() == [10, 5, 1, 2]
+    district = rl.build_rollups(store)["district"].set_index("district")
+    assert district.loc["D1", "HHPop"] == 18 and district.loc["D1", "EAs"] == 4
+
+
+def test_query(store):
+    rl.build_rollups(store)
+
+    wards = rl.query(store, "ward", columns=["ward", "HHPop"], district="D1")
+    assert wards.to_dict("list") == {"ward": ["W1", "W2"], "HHPop": [15, 7]}
+    districts = rl.query(store, "district", province="P1")
+    assert districts.district.tolist() == ["D1", "D2"]
+    assert rl.query(store, "ward", province="P2", district="D1").empty
+    assert len(rl.query(store, "national")) == 1
+
+
+def test_empty_store(tmp_path):
+    tables = rl.build_rollups(str(tmp_path))
+
+    assert tables["ward"].empty
+    assert tables["national"].EAs.tolist() == [0]
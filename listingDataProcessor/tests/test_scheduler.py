@@ -0,0 +1,92 @@
+import pandas as pd
+
+import parallel as pl
+import scheduler as sc
+from district_fixture import district_params, listing_rows, make_wards, write_raw_csv
+
+
+def test_find_district_exports(tmp_path):
+    demarcation_dir = tmp_path.joinpath("DEMARCATION_DATA")
+    for d in ["P1/LUSAKA", "P1/CHONGWE", "P2/KAFUE", "P3/KAFUE"]:
+        demarcation_dir.joinpath(d).mkdir(parents=True)
+    raw_dir = tmp_path.joinpath("raw")
+    raw_dir.joinpath("P1").mkdir(parents=True)
+    files = {name: raw_dir.joinpath(name) for name in ["P1/Lusaka_District.csv", "Chongwe_District.csv",
+                                                        "Kafue_District.csv", "Mumbwa_District.csv", "notes.csv"]}
+    for i, f in enumerate(files.values()):
+        f.write_text("x" * (i + 1))
+
+    exports, unmatched = sc.find_district_exports(raw_dir, demarcation_dir)
+
+    assert [(e["province"], e["district"], e["csv_file"], e["size"]) for e in exports] == [
+        ("P1", "CHONGWE", files["Chongwe_District.csv"], 2), ("P1", "LUSAKA", files["P1/Lusaka_District.csv"], 1)]
+    # KAFUE is in two provinces
+    assert unmatched == [files["Kafue_District.csv"], files["Mumbwa_District.csv"]]
+
+
+def record(name):
+    return name
+
+
+def test_largest_job_runs_first():
+    order = []
+
+    def on_done(key, result):
+        assert result["success"]
+        order.append(key)
+        # the district job adds its ward jobs
+        if key == "district":
+            return [(8, "ward 8", record, ("ward 8",)), (0.5, "ward 0.5", record, ("ward 0.5",))]
+        return []
+
+    pl.run_largest_first([(1, "a", record, ("a",)), (5, "district", record, ("district",)),
+                          (1, "b", record, ("b",)), (3, "c", record, ("c",))], on_done)
+
+    assert order == ["district", "ward 8", "c", "a", "b", "ward 0.5"]
+
+
+def fail():
+    raise ValueError("bad job")
+
+
+def test_largest_first_in_a_pool_runs_every_job():
+    done = {}
+
+    def on_done(key, result):
+        done[key] = result
+        return [(1, "follow up", record, ("follow up",))] if key == 2 else []
+
+    pl.run_largest_first([(size, size, record, (size,)) for size in range(4)] + [(9, "fail", fail, ())],
+                         on_done, max_workers=2)
+
+    assert sorted(done, key=str) == [0, 1, 2, 3, "fail", "follow up"]
+    assert [done[k]["value"] for k in range(4)] == [0, 1, 2, 3]
+    assert not done["fail"]["success"] and "bad job" in done["fail"]["error"]
+
+
+def test_run_batch(tmp_path):
+    params = district_params(run_report=False)
+    demarcation_dir = tmp_path.joinpath("DEMARCATION_DATA")
+    raw_dir = tmp_path.joinpath("raw")
+    raw_dir.joinpath("P").mkdir(parents=True)
+    make_wards(demarcation_dir, district="LARGE")
+    make_wards(demarcation_dir, wards=["WARD A", "WARD B"], district="SMALL")
+    write_raw_csv(raw_dir.joinpath("P", "Large_District.csv"), listing_rows(params, n=300))
+    write_raw_csv(raw_dir.joinpath("Small_District.csv"), listing_rows(params, n=100, wards=["WARD A", "WARD B"]))
+    # a ward whose EA layer can't be read fails without stopping the batch
+    demarcation_dir.joinpath("P", "SMALL", "WARD B", "EA.shp").write_bytes(b"not a shapefile")
+
+    summary = sc.run_batch(raw_dir, demarcation_dir, params, max_workers=2)
+
+    saved = pd.read_csv(demarcation_dir.joinpath(sc.SUMMARY_FILENAME))
+    pd.testing.assert_frame_equal(saved[["district", "success", "rows_in", "wards_processed", "failed_wards"]],
+                                  pd.DataFrame({"district": ["LARGE", "SMALL"], "success": [True, True],
+                                                "rows_in": [305, 105], "wards_processed": [3, 1],
+                                                "failed_wards": [0, 1]}))
+    assert list(saved.columns) == list(summary.columns)
+    assert saved.raw_csv_mb.is_monotonic_decreasing
+    assert (saved.ward_seconds > 0).all() and saved.error.isna().all()
+    # the roll-up store has every ward which succeeded
+    wards = pd.read_parquet(demarcation_dir.joinpath("national_rollup", "ward.parquet"))
+    assert sorted(zip(wards.district, wards.ward)) == [("LARGE", "WARD A"), ("LARGE", "WARD B"),
+                                                       ("LARGE", "WARD C"), ("SMALL", "WARD A")]
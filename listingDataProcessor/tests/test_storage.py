@@ -0,0 +1,130 @@
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+import storage as st
+
+
+def points(n, offset=0):
+    return gpd.GeoDataFrame({"SEA_CODE": ["E{}".format(i + offset) for i in range(n)],
+                             "HHPop": [float(i + offset) for i in range(n)]},
+                            geometry=[Point(28.3 + i / 100, -15.4) for i in range(n)], crs=4326)
+
+
+@pytest.fixture
+def ward_dirs(tmp_path):
+    dirs = [tmp_path.joinpath("D", w) for w in ["WARD A", "WARD B"]]
+    for d in dirs:
+        d.mkdir(parents=True)
+
+    return dirs
+
+
+@pytest.mark.parametrize("storage_format", list(st.STORAGE_FORMATS))
+def test_layer_round_trip(ward_dirs, storage_format):
+    for i, ward_dir in enumerate(ward_dirs):
+        st.write_layer(points(3, offset=10 * i), ward_dir, "{}_df".format(ward_dir.name), storage_format)
+
+    for i, ward_dir in enumerate(ward_dirs):
+        layer = "{}_df".format(ward_dir.name)
+        assert st.layer_exists(ward_dir, layer, storage_format)
+        gdf = st.read_layer(ward_dir, layer, storage_format)
+        pd.testing.assert_frame_equal(pd.DataFrame(gdf.drop(columns="geometry")),
+                                      pd.DataFrame(points(3, offset=10 * i).drop(columns="geometry")))
+        assert gdf.geometry.equals(points(3).geometry)
+        assert gdf.crs.to_epsg() == 4326
+
+        selected = st.read_layer(ward_dir, layer, storage_format, columns=["HHPop"])
+        assert list(selected.columns) == ["HHPop", "geometry"]
+    assert not st.layer_exists(ward_dirs[0], "EA_attributes", storage_format)
+
+    if storage_format == "gpkg":
+        # one GeoPackage per district with a layer per ward
+        gpkg = ward_dirs[0].parent.joinpath("D.gpkg")
+        assert sorted(st.list_layers(gpkg)) == ["WARD A_df", "WARD B_df"]
+
+
+@pytest.mark.parametrize("storage_format", ["shapefile", "geoparquet"])
+def test_interrupted_write_keeps_previous_layer(ward_dirs, storage_format, monkeypatch):
+    ward_dir = ward_dirs[0]
+    path = st.write_layer(points(3), ward_dir, "EA_attributes", storage_format)
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(gpd.GeoDataFrame, "to_file", fail)
+    monkeypatch.setattr(gpd.GeoDataFrame, "to_parquet", fail)
+    with pytest.raises(OSError):
+        st.write_layer(points(5), ward_dir, "EA_attributes", storage_format)
+    monkeypatch.undo()
+
+    assert len(st.read_layer(ward_dir, "EA_attributes", storage_format)) == 3
+    # a later write replaces the layer and leaves no temporary files
+    assert st.write_layer(points(5), ward_dir, "EA_attributes", storage_format) == path
+    assert len(st.read_layer(ward_dir, "EA_attributes", storage_format)) == 5
+    assert not [f.name for f in ward_dir.iterdir() if f.name.startswith(".")]
+
+
+def test_interrupted_gpkg_write_not_taken_as_saved(ward_dirs, monkeypatch):
+    ward_dir = ward_dirs[0]
+    st.write_layer(points(3), ward_dir, "EA_attributes", "gpkg")
+    source = ward_dir.joinpath("EA.shp")
+    points(1).to_file(source)
+    source_mtime = source.stat().st_mtime
+    assert st.layer_mtime(ward_dir, "EA_attributes", "gpkg") is not None
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(gpd.GeoDataFrame, "to_file", fail)
+    with pytest.raises(OSError):
+        st.write_layer(points(5), ward_dir, "EA_attributes", "gpkg")
+
+    assert st.layer_mtime(ward_dir, "EA_attributes", "gpkg") is None
+    assert not st.layer_is_up_to_date(ward_dir, "EA_attributes", "gpkg", [source])
+    assert source.stat().st_mtime == source_mtime
+
+
+@pytest.mark.parametrize("storage_format", list(st.STORAGE_FORMATS))
+def test_layer_source_cleared_by_interrupted_write(ward_dirs, storage_format, monkeypatch):
+    ward_dir = ward_dirs[0]
+    st.write_layer(points(3), ward_dir, "WARD A_df", storage_format, source="abc")
+    assert st.layer_source(ward_dir, "WARD A_df", storage_format) == "abc"
+    assert st.layer_source(ward_dirs[1], "WARD B_df", storage_format) is None
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(gpd.GeoDataFrame, "to_file", fail)
+    monkeypatch.setattr(gpd.GeoDataFrame, "to_parquet", fail)
+    with pytest.raises(OSError):
+        st.write_layer(points(5), ward_dir, "WARD A_df", storage_format, source="def")
+    monkeypatch.undo()
+
+    # the previous layer may be kept but it isn't taken as saved from either input
+    assert st.layer_source(ward_dir, "WARD A_df", storage_format) is None
+    st.write_layer(points(5), ward_dir, "WARD A_df", storage_format, source="def")
+    assert st.layer_source(ward_dir, "WARD A_df", storage_format) == "def"
+
+
+def test_replaced_shapefile_drops_stale_sidecar_files(ward_dirs):
+    ward_dir = ward_dirs[0]
+    st.write_layer(points(3), ward_dir, "EA_attributes", "shapefile")
+    stale = ward_dir.joinpath("EA_attributes.cpg")
+    assert stale.exists()
+
+    tmp_shp = st.temporary_path(ward_dir.joinpath("EA_attributes.shp"))
+    points(4).to_file(tmp_shp)
+    tmp_shp.with_suffix(".cpg").unlink()
+    st.replace_shapefile(tmp_shp, ward_dir.joinpath("EA_attributes.shp"))
+
+    assert not stale.exists()
+    assert len(st.read_layer(ward_dir, "EA_attributes", "shapefile")) == 4
+
+
+@pytest.mark.parametrize("storage_format", ["geoparquet", "gpkg"])
+def test_export_to_shapefile(ward_dirs, storage_format):
+    ward_dir = ward_dirs[0]
+    st.write_layer(points(3), ward_dir, "WARD A_poi", storage_format)
+
+    shp = st.export_to_shapefile(ward_dir, "WARD A_poi", storage_format)
+    assert shp == ward_dir.joinpath("WARD A_poi.shp")
+    assert gpd.read_file(shp).SEA_CODE.tolist() == ["E0", "E1", "E2"]
@@ -0,0 +1,166 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+import ea_index as eai
+import utils as ut
+from district_fixture import district_params, make_district, process_district
+
+
+def repair_coordinates_row_by_row(df, cols):
+    """
+    Coordinate repair before it was vectorized: each value is converted with float()
+    and replaced with the fallback column if that fails
+    """
+    fix = ut.check_if_coordinates_colums_need_fixing(df=df, cols=cols)
+    if fix:
+        def convert_to_float(row):
+            try:
+                return float(row[fix["col_to_fix"]])
+            except Exception:
+                return row[fix["replace_col"]]
+        df[fix["col_to_fix"]] = pd.to_numeric(df.apply(convert_to_float, axis=1))
+
+    return df
+
+
+@pytest.mark.parametrize("dtype", [object, "str", "category"])
+def test_coordinate_repair_matches_row_by_row(dtype):
+    values = ["28.25", "#NULL!", "", "nan", "-NaN", " 28.5 ", "1e-3", "abc", "-15.5", "inf", "1_000", "0x10",
+              "28,5", "+3", np.nan, "#NULL!"]
+    fallback = np.arange(len(values)) + 0.5
+    fallback[1] = np.nan
+
+    def raw():
+        return pd.DataFrame({"lon": pd.Series(values, dtype=dtype), "lon_fallback": fallback})
+
+    expected = repair_coordinates_row_by_row(raw(), ["lon", "lon_fallback"])
+    df = raw()
+    report = ut.repair_coordinates(df, ["lon", "lon_fallback"])
+
+    np.testing.assert_array_equal(df.lon.to_numpy(), expected.lon.to_numpy())
+    assert df.lon.dtype == np.float64
+    assert report == {"col_fixed": "lon", "repaired": 5, "missing": 4}
+
+
+def test_duplicate_coordinates_dropped_across_chunks():
+    chunks = [pd.DataFrame({"Latitude": [-15.1, -15.1, -15.2], "Longitude": [28.1, 28.1, 28.2]}),
+              pd.DataFrame({"Latitude": [-15.2, -15.3], "Longitude": [28.2, 28.3]}),
+              pd.DataFrame({"Latitude": [-15.1, -15.3, -15.4], "Longitude": [28.1, 28.3, 28.4]})]
+    seen = ut.CoordinateSet()
+    kept = [ut.drop_duplicate_coordinates(c, seen_coordinates=seen) for c in chunks]
+
+    assert [len(k) for k in kept] == [2, 1, 1]
+    assert kept[2].Latitude.tolist() == [-15.4]
+    assert len(seen) == 4
+
+
+def test_coordinate_set():
+    keys = ut.coordinate_keys(pd.Series(["-15.1", "-15.2", None]), pd.Series([28.1, 28.2, 28.3]))
+    assert keys.dtype == np.uint64
+    assert (keys == ut.coordinate_keys([-15.1, -15.2, np.nan], [28.1, 28.2, 28.3])).all()
+
+    seen = ut.CoordinateSet(segments=[np.sort(keys[:1])])
+    assert seen.contains(keys).tolist() == [True, False, False]
+    seen.add(keys[1:])
+    assert seen.contains(keys).all()
+    assert seen.keys.nbytes == 16
+
+
+def test_near_duplicate_chain_not_collapsed():
+    # points 2 m apart along a street, each within 3 m of the next
+    chain = pd.DataFrame({"Latitude": -15.4 + np.arange(6) * 2 / 110574.0, "Longitude": 28.3},
+                         index=list("abcdef"))
+    assert ut.near_duplicate_clusters(chain.Latitude, chain.Longitude, 3).tolist() == [0, 0, 2, 2, 4, 4]
+
+    kept, report = ut.drop_near_duplicate_coordinates(chain, 3)
+    assert kept.index.tolist() == ["a", "c", "e"]
+    assert report.ClusterID.tolist() == ["a", "c", "e"]
+    assert (report.DistanceM < 3).all()
+
+
+def test_near_duplicate_joins_first_point_kept():
+    lat = -15.4 + np.array([0, 10, 5, 0.5, np.nan]) / 110574.0
+    assert ut.near_duplicate_clusters(lat, np.full(5, 28.3), 6).tolist() == [0, 1, 0, 0, 4]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 50])
+def test_near_duplicates_found_across_chunks(chunk_size):
+    rng = np.random.default_rng(11)
+    # points re-captured a few metres from each other around 60 structures, some without coordinates
+    centres = rng.integers(0, 60, 300)
+    df = pd.DataFrame({"Latitude": -15.4 + centres * 1e-4 + rng.normal(0, 2e-5, 300),
+                       "Longitude": 28.3 + centres % 7 * 1e-4 + rng.normal(0, 2e-5, 300)})
+    df.loc[::37, "Latitude"] = np.nan
+    expected, expected_report = ut.drop_near_duplicate_coordinates(df, 4)
+
+    kept_points = ut.KeptPoints(4)
+    chunks = [ut.drop_near_duplicate_coordinates(df.iloc[i:i + chunk_size], 4, kept_points=kept_points)
+              for i in range(0, len(df), chunk_size)]
+
+    assert pd.concat([c[0] for c in chunks]).index.tolist() == expected.index.tolist()
+    report = pd.concat([c[1] for c in chunks])
+    assert report.index.tolist() == expected_report.index.tolist()
+    assert report.ClusterID.tolist() == expected_report.ClusterID.tolist()
+    np.testing.assert_allclose(report.DistanceM, expected_report.DistanceM)
+    assert len(kept_points) == expected.Latitude.notna().sum()
+
+
+def test_near_duplicates_report_of_district_in_chunks(tmp_path):
+    reports = {}
+    for chunk_size in [None, 7]:
+        params = district_params(chunk_size=chunk_size, memory_budget_mb=None, dedup_radius_m=400.0)
+        raw_csv, demarcation_dir, district_dir = make_district(tmp_path.joinpath(str(chunk_size)), params, n=400)
+        process_district(raw_csv, demarcation_dir, params)
+        reports[chunk_size] = [pd.read_csv(district_dir.joinpath("D_District_near_duplicates_{}.csv".format(f)))
+                               for f in ["df", "poi"]]
+
+    # ClusterID is the row number in the raw CSV file whichever chunk the row kept is in
+    for whole, chunked in zip(reports[None], reports[7]):
+        assert len(whole) > 0
+        pd.testing.assert_frame_equal(chunked, whole)
+
+
+def aggregate_by_sjoin(ea, hh, poi, bld, ea_id):
+    """
+    EA attributes as they were computed before the joins were fused: one spatial join per layer
+    """
+    counts = []
+    for points, values in [(hh, {"HHPop": hh.HHPop, "StructCntHHs": 1}), (poi, {"StructCntPOIs": 1}),
+                           (bld, {"StructCntBlds": bld.n_HH})]:
+        points = gpd.GeoDataFrame(values, index=points.index, geometry=points.geometry)
+        joined = gpd.sjoin(ea[[ea_id, "geometry"]], points, how="inner", predicate="contains")
+        counts.append(joined.drop(columns=["geometry", "index_right"]).groupby(ea_id).sum())
+    df = pd.concat(counts, axis=1).reindex(pd.unique(ea[ea_id])).fillna(0)
+    df["TotalStruct"] = df.StructCntHHs + df.StructCntPOIs
+
+    return df[ut.EA_ATTRIBUTE_COLS]
+
+
+@pytest.mark.parametrize("lookup", [None, "index", "raster"])
+def test_fused_ea_aggregation_matches_sjoin(lookup):
+    rng = np.random.default_rng(3)
+    # EA 7 is made of two polygons and the points are also around the EAs
+    eas = gpd.GeoDataFrame({"SEA_CODE": [str(min(i, 7)) for i in range(9)]},
+                           geometry=[box(i % 3, i // 3, i % 3 + 1, i // 3 + 1) for i in range(9)], crs=4326)
+
+    def points(n, **values):
+        return gpd.GeoDataFrame(values, geometry=gpd.points_from_xy(rng.uniform(-0.5, 3.5, n),
+                                                                    rng.uniform(-0.5, 3.5, n)), crs=4326)
+
+    hh = points(500, HHPop=rng.integers(1, 9, 500).astype(float))
+    poi = points(200)
+    bld = points(800, n_HH=rng.integers(0, 3, 800))
+    ea_index = None
+    if lookup:
+        ea_index = eai.EAIndex.build(eas, layer_hash=None)
+    if lookup == "raster":
+        ea_index = eai.ea_raster_or_index(ea_index, 0.1)
+    batches = [bld.iloc[:300], bld.iloc[300:]] if lookup == "raster" else bld
+
+    fused = ut.aggregate_points_by_ea(eas, hh, poi, batches, "SEA_CODE", crs_info=eas.crs, ea_index=ea_index)
+    expected = aggregate_by_sjoin(eas, hh, poi, bld, "SEA_CODE")
+
+    pd.testing.assert_frame_equal(fused.set_index("SEA_CODE").astype(float), expected.astype(float))
@@ -0,0 +1,40 @@
+import pytest
+
+import storage as st
+import utils as ut
+from district_fixture import district_params, listing_rows, make_wards, process_district, write_raw_csv
+
+
+@pytest.mark.parametrize("exchange_format, storage_format", [("arrow", "shapefile"), ("csv", "shapefile"),
+                                                             ("arrow", "geoparquet"), ("csv", "gpkg")])
+def test_ward_without_pois_or_dfs(tmp_path, exchange_format, storage_format):
+    params = district_params(ward_exchange_format=exchange_format, storage_format=storage_format)
+    rows = listing_rows(params)
+    # only dwellings are listed in WARD A and only POIs in WARD B
+    for row in rows:
+        if row["WARD"] == "WARD A":
+            row["Structure_type_categorisation"] = "Residential Building"
+        elif row["WARD"] == "WARD B":
+            row["Structure_type_categorisation"] = "Commercial Building"
+    demarcation_dir = tmp_path.joinpath("DEMARCATION_DATA")
+    district_dir = make_wards(demarcation_dir)
+    raw_csv = write_raw_csv(tmp_path.joinpath("D_District.csv"), rows)
+
+    processor, out = process_district(raw_csv, demarcation_dir, params)
+    assert "failed" not in out
+
+    ward_a, ward_b = district_dir.joinpath("WARD A"), district_dir.joinpath("WARD B")
+    pois = st.read_layer(ward_a, "WARD A_poi", storage_format)
+    assert len(pois) == 0
+    assert "MultResBld" in pois.columns
+    assert len(st.read_layer(ward_b, "WARD B_df", storage_format)) == 0
+    ea_a = st.read_layer(ward_a, "EA_attributes", storage_format)
+    ea_b = st.read_layer(ward_b, "EA_attributes", storage_format)
+    # shapefile field names are cut to 10 characters
+    assert ea_a["StructCntPOIs"[:10] if storage_format == "shapefile" else "StructCntPOIs"].sum() == 0
+    assert ea_a["HHPop"].sum() > 0
+    assert ea_b["HHPop"].sum() == 0
+
+    # rerun skips the ward files saved but not the empty layers
+    result = ut.create_shp_for_ward(ward_a, **processor.ward_layer_kwargs())
+    assert result == {"written": ["WARD A_poi"], "skipped": ["WARD A_df"], "rows_written": 0}
@@ -0,0 +1,68 @@
+import threading
+
+import pytest
+
+import writer as wr
+
+
+def test_failed_write_raises_on_exit():
+    done = []
+
+    def write(key, value):
+        if (key, value) == ("a", 1):
+            raise OSError("disk full")
+        done.append((key, value))
+
+    with pytest.raises(wr.WriteError) as raised:
+        with wr.BackgroundWriter(threads=2) as writer:
+            for value in range(3):
+                writer.submit("a", write, "a", value)
+                writer.submit("b", write, "b", value)
+
+    assert list(raised.value.errors) == ["a"]
+    assert "disk full" in raised.value.errors["a"]["error"]
+    # writes with the failed key after the failure are skipped, other keys carry on
+    assert [v for k, v in done if k == "a"] == [0]
+    assert [v for k, v in done if k == "b"] == [0, 1, 2]
+
+
+@pytest.mark.parametrize("queue_size", [0, 2])
+def test_writes_with_the_same_key_keep_their_order(queue_size):
+    written = {}
+
+    def write(key, value):
+        written.setdefault(key, []).append(value)
+
+    with wr.BackgroundWriter(threads=3, queue_size=queue_size) as writer:
+        for value in range(50):
+            for key in ["ward_{}".format(k) for k in range(5)]:
+                writer.submit(key, write, key, value)
+
+    assert written == {"ward_{}".format(k): list(range(50)) for k in range(5)}
+
+
+def test_full_queue_blocks_the_producer():
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_write():
+        started.set()
+        release.wait(5)
+
+    writer = wr.BackgroundWriter(threads=1, queue_size=2)
+    writer.submit("k", slow_write)
+    started.wait(5)
+    # the thread is busy, two writes fit in the queue and the next one waits
+    writer.submit("k", lambda: None)
+    writer.submit("k", lambda: None)
+    submitted = threading.Event()
+    producer = threading.Thread(target=lambda: (writer.submit("k", lambda: None), submitted.set()))
+    producer.start()
+
+    assert not submitted.wait(0.2)
+    release.set()
+    assert submitted.wait(5)
+    producer.join()
+    assert writer.close() == {}
+    with pytest.raises(RuntimeError):
+        writer.submit("k", lambda: None)
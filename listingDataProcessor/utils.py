@@ -1,55 +1,131 @@
 """
 Miscellaneous data processing utility functions.
 """
+import hashlib
+import json
 import os
+from contextlib import nullcontext
 import pandas as pd
 import geopandas as gpd
 import numpy as np
+import shapely
+import storage as st
+import parallel as pl
+import metrics as mt
+import exchange as ex
+import csv_reader as cr
+import writer as wr
+import manifest as mf
 
+# attributes appended to each EA
+EA_ATTRIBUTE_COLS = ['HHPop', 'StructCntHHs', 'StructCntPOIs', 'StructCntBlds', 'TotalStruct']
 
-def create_df(file):
+
+def create_df(file, usecols=None, dtypes=None, quarantine_file=None, stats=None):
     """
-    Returns a pandas data frame
+    Returns a pandas data frame, text is decoded as UTF-8 or Latin-1 and malformed rows are skipped
+    (see csv_reader.iter_csv)
 
     :param file: CSV file with raw hh listing data
+    :param usecols: Columns to load, those missing from the file are ignored, None loads all columns
+    :param dtypes: Dict of column name to dtype applied at read time (see read_dtypes)
+    :param quarantine_file: CSV file to save malformed rows to with their line number
+    :param stats: dict to add number of malformed rows to
     :return:
     """
-    encodings = ["ISO-8859-1", "latin1"]
+    return next(cr.iter_csv(file, usecols=usecols, dtypes=dtypes, quarantine_file=quarantine_file, stats=stats))
 
-    for encoding in encodings:
-        try:
-            df = pd.read_csv(file, encoding=encoding)
-            return df
-        except Exception as e:
-            continue
+
+def create_df_in_chunks(file, usecols=None, dtypes=None, chunksize=100000, quarantine_file=None, stats=None):
+    """
+    Returns an iterator of pandas data frames so that very large raw CSV
+    files can be processed chunk by chunk without loading the whole file
+
+    :param file: CSV file with raw hh listing data
+    :param usecols: Columns to load, those missing from the file are ignored
+    :param dtypes: Dict of column name to dtype applied at read time
+    :param chunksize: Number of rows in each chunk
+    :param quarantine_file: see create_df
+    :param stats: see create_df
+    :return: iterator of data frames
+    """
+    return cr.iter_csv(file, usecols=usecols, dtypes=dtypes, chunksize=chunksize, quarantine_file=quarantine_file,
+                       stats=stats)
 
 
-def create_df_without_pandas(file):
+def read_dtypes(schema):
     """
-    In case creating df with pandas fails due to encoding issues
-    we try this manual approach
-    :param file: CSV file with raw HH listing data
+    Returns the part of a schema which is declared to pd.read_csv: text and categoricals.
+    Numbers are converted after reading (see apply_schema) since they may contain
+    null strings (e.g., #NULL!) which would fail the read
+    :param schema: dict of column name to dtype
     :return:
     """
-    data = []
-    for line in open(file, 'rb'):
-        try:
-            # Decode to a fail-safe string for PY3
-            line = line.decode('latin1')
-            data.append(line.split(","))
-        except Exception as e:
-            pass
+    return {c: t for c, t in schema.items() if not pd.api.types.is_numeric_dtype(pd.api.types.pandas_dtype(t))}
+
+
+def compact_numeric(values, dtype):
+    """
+    Converts a column to a compact numeric dtype, junk values become missing.
+    Integer dtypes are only used when all values are whole and fit in the dtype,
+    otherwise values are kept as converted rather than truncated or overflowed
+    :param values: column to convert
+    :param dtype: target dtype (e.g., UInt16, float32)
+    :return:
+    """
+    values = pd.to_numeric(values, errors="coerce")
+    if pd.api.types.is_integer_dtype(dtype):
+        info = np.iinfo(dtype.numpy_dtype if hasattr(dtype, "numpy_dtype") else dtype)
+        valid = values.dropna()
+        if not valid.empty and (valid.min() < info.min or valid.max() > info.max or (valid % 1 != 0).any()):
+            return values
+
+    return values.astype(dtype)
+
+
+def apply_schema(df, schema):
+    """
+    Converts the columns of df present in the schema to their declared dtypes
+    (numbers after reading, categoricals if not declared at read time)
+    :param df: data frame, updated in place
+    :param schema: dict of column name to dtype
+    :return: df
+    """
+    for col, dtype in schema.items():
+        if col not in df.columns:
+            continue
+        dtype = pd.api.types.pandas_dtype(dtype)
+        if df[col].dtype == dtype:
+            continue
+        if pd.api.types.is_numeric_dtype(dtype):
+            df[col] = compact_numeric(df[col], dtype)
+        elif isinstance(dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(dtype)
 
-        try:
-            # Decode to a fail-safe string for PY3
-            line = line.decode('utf-8')
-            data.append(line.split(","))
-        except Exception as e:
-            pass
-    df = pd.DataFrame(data=data[1:], columns=data[0])
     return df
 
 
+def float_dtype_for_precision(max_abs_value, decimals):
+    """
+    Returns float32 if it resolves values up to max_abs_value to the given
+    number of decimals, otherwise float64
+    """
+    if np.spacing(np.float32(max_abs_value)) <= 0.5 * 10.0 ** -decimals:
+        return np.float32
+    return np.float64
+
+
+def replace_values(values, mapping):
+    """
+    Series.replace which also works for categoricals, new values are added as categories
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        new = [v for v in dict.fromkeys(mapping.values()) if v not in values.cat.categories]
+        return values.cat.add_categories(new).replace(mapping).cat.remove_unused_categories()
+
+    return values.replace(mapping)
+
+
 def check_if_coordinates_colums_need_fixing(df, cols):
     """
     Check if one of the coordinates columns (passed in pairs for lat, lon)
@@ -72,91 +148,474 @@ def check_if_coordinates_colums_need_fixing(df, cols):
     return fix_tuple
 
 
-def convert_to_float(row, col_to_fix, replace_col):
+def repair_coordinates(df, cols):
     """
-    Simply converts a string coordinate to float but also fix
-    those fixes those NULL coordinate strings by replacing with other available coordinate
+    Vectorized fix of a coordinate column with null strings (e.g., #NULL!)
+    or other junk values: such values are replaced with the other available
+    coordinate column and the column is converted to float
+    :param df: raw hh listing data frame, updated in place
+    :param cols: coordinates columns pair (column to check, fallback column)
+    :return: dict with column fixed, number of coordinates repaired and still missing
     """
+    report = {"col_fixed": None, "repaired": 0, "missing": int(df[cols[0]].isna().sum())}
+    to_fix_or_not_cols = check_if_coordinates_colums_need_fixing(df=df, cols=cols)
+    if not to_fix_or_not_cols:
+        return report
+
+    fix_col = to_fix_or_not_cols["col_to_fix"]
+    replace_col = to_fix_or_not_cols["replace_col"]
+    raw = df[fix_col]
+    coords = pd.to_numeric(raw, errors="coerce")
+
+    # values to_numeric rejects are converted as float() would, once per distinct value: strings
+    # such as "nan" are valid floats and are kept as missing rather than replaced, "1_000" is 1000
+    failed = coords.isna() & raw.notna()
+    rejected = raw[failed].astype(object)
+    floats = {}
+    for value in pd.unique(rejected):
+        try:
+            floats[value] = float(value)
+        except (TypeError, ValueError):
+            pass
+    coords[failed] = rejected.map(floats).astype(float)
+    unconvertible = failed.copy()
+    unconvertible[failed] = ~rejected.isin(list(floats))
+
+    df[fix_col] = coords.where(~unconvertible, df[replace_col])
 
-    try:
-        return float(row[col_to_fix])
-    except Exception as e:
-        return row[replace_col]
+    report["col_fixed"] = fix_col
+    report["repaired"] = int((unconvertible & df[replace_col].notna()).sum())
+    report["missing"] = int(df[fix_col].isna().sum())
+
+    return report
 
 
 def fix_coordinates(df, cols):
     """
     For coordinate column which require fixing, we it here
     """
-    to_fix_or_not_cols = check_if_coordinates_colums_need_fixing(df=df,
-                                                                 cols=cols)
-    if to_fix_or_not_cols:
-        fix_col = to_fix_or_not_cols["col_to_fix"]
-        replace_col = to_fix_or_not_cols["replace_col"]
-        df[fix_col] = df.apply(convert_to_float, args=(fix_col, replace_col), axis=1)
-        df[fix_col] = pd.to_numeric(df[fix_col])
+    repair_coordinates(df=df, cols=cols)
 
     return df
 
 
+def coordinate_keys(lat, lon):
+    """
+    Returns a 64 bit hash per coordinates pair, coordinates are compared as float64 so
+    that pairs read as float32 in one chunk and float64 in another have the same key
+    :param lat, lon: latitude and longitude arrays or Series
+    :return: uint64 array
+    """
+    coords = pd.DataFrame({c: pd.to_numeric(pd.Series(v), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+                           for c, v in [("lat", lat), ("lon", lon)]})
+
+    return pd.util.hash_pandas_object(coords, index=False).to_numpy()
+
+
+class CoordinateSet:
+    """
+    Set of coordinates keys (see coordinate_keys) kept as a sorted uint64 array, 8 bytes per
+    coordinates pair, so that coordinates seen while processing a large file chunk by chunk
+    take little memory. Keys saved earlier (e.g., memory-mapped files) can be added as
+    read-only segments which are looked up without being loaded
+    """
+
+    # bytes held per key, twice the key while keys are added (see add)
+    BYTES_PER_KEY = 16
+
+    def __init__(self, segments=()):
+        """
+        :param segments: sorted uint64 arrays of keys already seen
+        """
+        self.segments = list(segments)
+        self.keys = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return self.keys.size + sum(s.size for s in self.segments)
+
+    def contains(self, keys):
+        """
+        Returns a boolean array, True for keys in the set
+        """
+        found = np.zeros(len(keys), dtype=bool)
+        for sorted_keys in self.segments + [self.keys]:
+            if sorted_keys.size:
+                pos = np.minimum(np.searchsorted(sorted_keys, keys), sorted_keys.size - 1)
+                found |= sorted_keys[pos] == keys
+        return found
+
+    def add(self, keys):
+        """
+        Adds keys which aren't in the set yet
+        """
+        keys = np.unique(keys)
+        self.keys = np.insert(self.keys, np.searchsorted(self.keys, keys), keys)
+
+
+def drop_duplicate_coordinates(df, lat="Latitude", lon="Longitude", seen_coordinates=None):
+    """
+    Drops points with duplicate coordinates. When processing a file in chunks,
+    pass the same seen_coordinates set for every chunk so that duplicates
+    across chunks are also dropped
+    :param df: DF or POIs data frame
+    :param lat, lon: latitude and longitude column
+    :param seen_coordinates: CoordinateSet of coordinates seen in previous chunks, updated in place
+    :return: data frame without duplicate coordinates
+    """
+    df = df.drop_duplicates(subset=[lat, lon])
+    if seen_coordinates is None:
+        return df
+
+    keys = coordinate_keys(df[lat], df[lon])
+    is_new = ~seen_coordinates.contains(keys)
+    seen_coordinates.add(keys[is_new])
+
+    return df[is_new]
+
+
+def metric_coordinates(lat, lon):
+    """
+    Returns local metric coordinates (equirectangular) x and y in metres, accurate at the scale of a few metres
+    :param lat, lon: float arrays of latitude and longitude
+    """
+    return lon * 111320.0 * np.cos(np.radians(lat)), lat * 110574.0
+
+
+def grid_cell_keys(x, y, radius_m, dx=0, dy=0):
+    """
+    Returns an int64 key per point for its cell of a grid of radius_m cells, or the cell dx, dy cells away
+    :param x, y: metric coordinates (see metric_coordinates)
+    """
+    cx = np.floor(x / radius_m).astype(np.int64) + dx
+    cy = np.floor(y / radius_m).astype(np.int64) + dy
+
+    return cx * (1 << 32) + cy
+
+
+class KeptPoints:
+    """
+    Points kept by near duplicate detection in earlier chunks (see drop_near_duplicate_coordinates)
+    sorted by their cell of a grid of radius_m cells, so that points of a later chunk are only compared
+    with points kept in neighbouring cells. A point re-captured near a point of an earlier chunk is then
+    dropped as it would be if the whole file was processed at once
+    """
+
+    # bytes held per point kept, twice the cell key, coordinates and label while points are added (see add)
+    BYTES_PER_POINT = 64
+
+    def __init__(self, radius_m):
+        """
+        :param radius_m: see near_duplicate_clusters
+        """
+        self.radius_m = radius_m
+        self.cells = np.empty(0, dtype=np.int64)
+        self.lat = np.empty(0, dtype=np.float64)
+        self.lon = np.empty(0, dtype=np.float64)
+        self.labels = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return self.cells.size
+
+    def first_within(self, lat, lon):
+        """
+        Returns, for each point, position of the first point kept (lowest label) within radius_m metres, -1 if none
+        :param lat, lon: float arrays of latitude and longitude
+        """
+        first = np.full(lat.size, -1, dtype=np.int64)
+        if not self.cells.size or not lat.size:
+            return first
+
+        x, y = metric_coordinates(lat, lon)
+        kept_x, kept_y = metric_coordinates(self.lat, self.lon)
+        finite = np.isfinite(x) & np.isfinite(y)
+        x, y = np.where(finite, x, 0), np.where(finite, y, 0)
+        best = np.full(lat.size, np.iinfo(np.int64).max, dtype=np.int64)
+        for dx in [-1, 0, 1]:
+            for dy in [-1, 0, 1]:
+                keys = grid_cell_keys(x, y, self.radius_m, dx, dy)
+                starts = np.searchsorted(self.cells, keys, side="left")
+                counts = np.where(finite, np.searchsorted(self.cells, keys, side="right") - starts, 0)
+                # one (point, point kept) pair per point kept in the cell
+                points = np.repeat(np.arange(lat.size), counts)
+                offsets = np.arange(points.size) - np.repeat(np.cumsum(counts) - counts, counts)
+                kept = np.repeat(starts, counts) + offsets
+                close = (x[points] - kept_x[kept]) ** 2 + (y[points] - kept_y[kept]) ** 2 <= self.radius_m ** 2
+                points, kept = points[close], kept[close]
+                # pairs with the lowest label first so that each point keeps its first point kept
+                order = np.argsort(self.labels[kept], kind="stable")
+                points, kept = points[order], kept[order]
+                points, unique = np.unique(points, return_index=True)
+                kept = kept[unique]
+                better = self.labels[kept] < best[points]
+                best[points[better]] = self.labels[kept[better]]
+                first[points[better]] = kept[better]
+
+        return first
+
+    def add(self, lat, lon, labels):
+        """
+        Adds points kept
+        :param lat, lon: float arrays of latitude and longitude, points without coordinates are left out
+        :param labels: int labels of the points (e.g., row numbers in the file), increasing with file order
+        """
+        x, y = metric_coordinates(lat, lon)
+        finite = np.isfinite(x) & np.isfinite(y)
+        cells = grid_cell_keys(x[finite], y[finite], self.radius_m)
+        order = np.argsort(cells, kind="stable")
+        pos = np.searchsorted(self.cells, cells[order], side="right")
+        self.cells = np.insert(self.cells, pos, cells[order])
+        self.lat = np.insert(self.lat, pos, lat[finite][order])
+        self.lon = np.insert(self.lon, pos, lon[finite][order])
+        self.labels = np.insert(self.labels, pos, np.asarray(labels, dtype=np.int64)[finite][order])
+
+
+def near_duplicate_clusters(lat, lon, radius_m):
+    """
+    Clusters points around the points kept: taking points in order, a point within radius_m
+    metres of a point already kept joins the cluster of the first such point, otherwise
+    it is kept. Every point of a cluster is within radius_m of its kept point, so a chain of
+    points each a few metres apart isn't collapsed into one. Only points in neighbouring
+    cells of a grid of radius_m cells are compared
+    :param lat, lon: arrays of latitude and longitude
+    :param radius_m: distance in metres under which points are considered duplicates
+    :return: array with, for each point, position of the point kept for its cluster
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    kept = np.arange(lat.size)
+    pos = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+    if pos.size < 2:
+        return kept
+
+    x, y = metric_coordinates(lat, lon)
+    cells = pd.DataFrame({"cx": np.floor(x[pos] / radius_m).astype(np.int64),
+                          "cy": np.floor(y[pos] / radius_m).astype(np.int64), "i": pos})
+
+    # pairs of points in the same or neighbouring cells within radius
+    pairs_a = []
+    pairs_b = []
+    for dx, dy in [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]:
+        neighbours = cells.assign(cx=cells.cx + dx, cy=cells.cy + dy)
+        m = cells.merge(neighbours, on=["cx", "cy"], suffixes=("_a", "_b"))
+        a = m["i_a"].to_numpy()
+        b = m["i_b"].to_numpy()
+        if dx == 0 and dy == 0:
+            a, b = a[a < b], b[a < b]
+        close = (x[a] - x[b]) ** 2 + (y[a] - y[b]) ** 2 <= radius_m ** 2
+        pairs_a.append(a[close])
+        pairs_b.append(b[close])
+    a = np.concatenate(pairs_a)
+    b = np.concatenate(pairs_b)
+    # a is the earlier point of each pair, pairs sorted by later point then earlier point
+    a, b = np.minimum(a, b), np.maximum(a, b)
+    order = np.lexsort((a, b))
+    a, b = a[order], b[order]
+
+    # only points with an earlier point close by are looked at one by one, in order so
+    # that whether their earlier points are kept is already known
+    later, starts = np.unique(b, return_index=True)
+    ends = np.append(starts[1:], b.size)
+    earlier = a.tolist()
+    kept = kept.tolist()
+    for i, start, end in zip(later.tolist(), starts.tolist(), ends.tolist()):
+        for j in earlier[start:end]:
+            if kept[j] == j:
+                kept[i] = j
+                break
+
+    return np.array(kept)
+
+
+def drop_near_duplicate_coordinates(df, radius_m, lat="Latitude", lon="Longitude", kept_points=None, labels=None):
+    """
+    Drops points re-captured within radius_m metres of a point kept,
+    the first point of each cluster is kept (see near_duplicate_clusters). When processing
+    a file in chunks, pass the same kept_points for every chunk so that a point near a point
+    kept in an earlier chunk joins its cluster
+    :param df: DF or POIs data frame
+    :param radius_m: distance in metres under which points are considered duplicates
+    :param lat, lon: latitude and longitude column
+    :param kept_points: KeptPoints of earlier chunks, updated in place
+    :param labels: int labels rows are reported by, increasing with file order (e.g., row numbers
+     in the file), defaults to the index of df
+    :return: data frame without near duplicates and a report of the rows dropped with
+     ClusterID (label of row kept) and DistanceM (distance to row kept)
+    """
+    labels = df.index.to_numpy() if labels is None else np.asarray(labels)
+    lat_values = df[lat].to_numpy(dtype=float, na_value=np.nan)
+    lon_values = df[lon].to_numpy(dtype=float, na_value=np.nan)
+    cluster_lat, cluster_lon = lat_values.copy(), lon_values.copy()
+    cluster = labels.copy()
+
+    # points near a point kept in an earlier chunk join its cluster, they come before any point of this chunk
+    earlier = np.full(len(df), -1) if kept_points is None else kept_points.first_within(lat_values, lon_values)
+    joined = earlier >= 0
+    if joined.any():
+        cluster[joined] = kept_points.labels[earlier[joined]]
+        cluster_lat[joined] = kept_points.lat[earlier[joined]]
+        cluster_lon[joined] = kept_points.lon[earlier[joined]]
+
+    rest = np.flatnonzero(~joined)
+    first = rest[near_duplicate_clusters(lat_values[rest], lon_values[rest], radius_m)]
+    cluster[rest] = labels[first]
+    cluster_lat[rest], cluster_lon[rest] = lat_values[first], lon_values[first]
+    keep = np.zeros(len(df), dtype=bool)
+    keep[rest] = first == rest
+    if kept_points is not None:
+        kept_points.add(lat_values[keep], lon_values[keep], labels[keep])
+
+    report = df[~keep].copy()
+    report.insert(0, "ClusterID", cluster[~keep])
+    lat1, lon1 = np.radians(lat_values[~keep]), np.radians(lon_values[~keep])
+    lat2, lon2 = np.radians(cluster_lat[~keep]), np.radians(cluster_lon[~keep])
+    hav = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    report.insert(1, "DistanceM", 2 * 6371008.8 * np.arcsin(np.sqrt(hav)))
+
+    return df[keep], report
+
+
+def unique_coordinate_rows(df, positions, new_col_names, seen_coordinates=None, dedup_radius_m=None,
+                           kept_points=None):
+    """
+    Helper for "sanitize_and_separate_df_pois" which drops duplicate and near duplicate
+    coordinates among rows of df using only the coordinates columns
+    :param df: raw data frame
+    :param positions: positions of the rows of a frame (DF or POIs) in df
+    :param new_col_names: new column names of the frame, the raw coordinates columns are those renamed
+     to Latitude and Longitude
+    :param seen_coordinates: see drop_duplicate_coordinates
+    :param dedup_radius_m: see drop_near_duplicate_coordinates, None only drops identical coordinates
+    :param kept_points: see drop_near_duplicate_coordinates, rows are labelled by the index of df
+    :return: positions of rows kept and, with dedup_radius_m, a report of near duplicates dropped
+     (see drop_near_duplicate_coordinates) indexed by their positions, otherwise None
+    """
+    raw_names = {v: k for k, v in new_col_names.items()}
+    coords = pd.DataFrame({c: df[raw_names.get(c, c)].to_numpy()[positions] for c in ["Latitude", "Longitude"]},
+                          index=positions)
+    coords = drop_duplicate_coordinates(coords, seen_coordinates=seen_coordinates)
+    report = None
+    if dedup_radius_m:
+        # the cluster's row is reported by its index label like the row dropped
+        coords, report = drop_near_duplicate_coordinates(coords, dedup_radius_m, kept_points=kept_points,
+                                                         labels=df.index[coords.index.to_numpy()])
+        report = report[["ClusterID", "DistanceM"]]
+
+    return coords.index.to_numpy(), report
+
+
+def report_near_duplicates(df, report, cols, new_col_names, report_files, frame, append_output, stats=None):
+    """
+    Helper for "sanitize_and_separate_df_pois" which saves near duplicates dropped
+    (see unique_coordinate_rows) with the columns of their frame to report_files[frame]
+    """
+    rows = take_rows(df, report.index.to_numpy(), cols, new_col_names)
+    rows.insert(0, "ClusterID", report["ClusterID"].to_numpy())
+    rows.insert(1, "DistanceM", report["DistanceM"].to_numpy())
+    mt.add_counts(stats, **{"{}_near_duplicates_dropped".format(frame): rows.shape[0]})
+    if report_files:
+        rows.to_csv(report_files[frame], index=False, mode="a" if append_output else "w", header=not append_output)
+
+
+def take_rows(df, positions, cols, new_col_names):
+    """
+    Returns rows of df at positions with columns cols renamed
+    """
+    return pd.DataFrame({new_col_names.get(c, c): df[c].array.take(positions) for c in cols},
+                        index=df.index[positions])
+
+
+def separate_rows(df, frames, release_input=False):
+    """
+    Helper for "sanitize_and_separate_df_pois" which copies rows of df into several data frames
+    column by column
+    :param df: raw data frame
+    :param frames: list of (positions, columns, new column names) tuples, one per data frame
+    :param release_input: remove each column from df once copied, so that only one column
+     is held twice at a time
+    :return: list of data frames
+    """
+    columns = [{} for _ in frames]
+    for c in list(df.columns):
+        values = df[c].array
+        for (positions, cols, new_col_names), out in zip(frames, columns):
+            if c in cols:
+                out[new_col_names.get(c, c)] = values.take(positions)
+        if release_input:
+            del values
+            del df[c]
+
+    return [pd.DataFrame({new_col_names.get(c, c): out[new_col_names.get(c, c)] for c in cols},
+                         index=df.index[positions])
+            for (positions, cols, new_col_names), out in zip(frames, columns)]
+
+
 def sanitize_and_separate_df_pois(df, struct_type_col, null_feat_cat_replacement,
                                   output_file_dwelling, output_file_pois, cols_to_keep_df,
                                   new_col_names_df, cols_to_keep_poi, new_col_names_poi,
-                                  residential_struct_category):
+                                  residential_struct_category, append_output=False,
+                                  seen_coordinates=None, dedup_radius_m=None, dedup_report_files=None,
+                                  stats=None, schema=None, release_input=False, kept_points=None):
     """
     Does some cleaning and then split residential points (dwelling frame (DF)
-    from POIs
+    from POIs, each row kept is copied once and never the whole data frame
     :param df:
     :param struct_type_col: Column which has structure type categorization
     :param null_feat_cat_replacement: For features with no feature type category, value to replace
-    :param output_file_dwelling: Output CSV filename for DFs
-    :param output_file_pois: Output CSV filename for POIs
+    :param output_file_dwelling: Output CSV filename for DFs, None to skip saving
+    :param output_file_pois: Output CSV filename for POIs, None to skip saving
     :param cols_to_keep_df: For DF, which columns to keep as final
     :param new_col_names_df: new column names for DF
     :param cols_to_keep_poi: For POIs, which columns to keep as final
     :param new_col_names_poi: new column names for POIs
     :param residential_struct_category: category to use to separate residential (HHs/dwelling) from other structure
-    :return: saves processed DF and POIs ward level CSV file
+    :param append_output: append to the output CSV files (e.g., for chunks after the first one)
+    :param seen_coordinates: dict with "df" and "poi" CoordinateSets of coordinates seen in previous chunks
+    :param dedup_radius_m: also drop points within this distance (metres) of another point, None only
+     drops points with identical coordinates
+    :param dedup_report_files: dict with "df" and "poi" CSV files to save near duplicates dropped to
+    :param stats: dict to add row and coordinates repair counts to (see metrics.add_counts)
+    :param schema: dict of raw column name to compact dtype, applied once coordinates are repaired
+    :param release_input: move columns out of df as they are copied so that memory held stays about
+     the size of df, df is left without columns
+    :param kept_points: dict with "df" and "poi" KeptPoints of near duplicate clusters of previous chunks
+    :return: processed DF and POIs data frames, optionally saved as CSV files
     """
     # ============================
     #  do some clean up
     # ============================
+    mt.add_counts(stats, rows_in=df.shape[0])
     # replace #NULL!  with missing
-    df[struct_type_col].replace({"#NULL!": null_feat_cat_replacement}, inplace=True)
+    df[struct_type_col] = replace_values(df[struct_type_col], {"#NULL!": null_feat_cat_replacement})
     # fix coordinates-replace missing coordinates
-    df2 = fix_coordinates(df=df, cols=['GPSLocation__Longitude', 'GeoLocation_Longitude'])
-    df3 = fix_coordinates(df=df2, cols=['GPSLocation__Latitude', 'GeoLocation_Latitude'])
+    for coords_cols in [['GPSLocation__Longitude', 'GeoLocation_Longitude'],
+                        ['GPSLocation__Latitude', 'GeoLocation_Latitude']]:
+        report = repair_coordinates(df=df, cols=coords_cols)
+        mt.add_counts(stats, **{"{}_repaired".format(coords_cols[0]): report["repaired"],
+                                "{}_missing".format(coords_cols[0]): report["missing"]})
+    if schema:
+        apply_schema(df, schema)
 
     # ============================
     #  separate DFs and POIs
     # ============================
-    df_dwellings = df[df[struct_type_col] == residential_struct_category]
-    df_pois = df[df[struct_type_col] != residential_struct_category]
+    # rows to keep are found from the structure type and coordinates alone, and each
+    # row kept is then copied once into either the DF or the POIs data frame
+    is_residential = (df[struct_type_col] == residential_struct_category).to_numpy(dtype=bool, na_value=False)
+    frames = {"df": (np.flatnonzero(is_residential), cols_to_keep_df, new_col_names_df),
+              "poi": (np.flatnonzero(~is_residential), cols_to_keep_poi, new_col_names_poi)}
+    keep = []
+    for frame, (positions, cols, new_names) in frames.items():
+        # check for duplicate coordinates
+        mt.add_counts(stats, **{"{}_rows_in".format(frame): positions.size})
+        positions, report = unique_coordinate_rows(
+            df, positions, new_names, seen_coordinates=seen_coordinates[frame] if seen_coordinates else None,
+            dedup_radius_m=dedup_radius_m, kept_points=kept_points[frame] if kept_points else None)
+        if report is not None:
+            report_near_duplicates(df, report, cols, new_names, dedup_report_files, frame, append_output, stats)
+        mt.add_counts(stats, **{"{}_rows_out".format(frame): positions.size})
+        keep.append((positions, cols, new_names))
 
-    # ============================
-    #  process DFs
-    # =============================
-    df_dwellings = df_dwellings[cols_to_keep_df]
-    df_dwellings.rename(columns=new_col_names_df, inplace=True)  # rename cols
-
-    # check for duplicate coordinates and create HH ID
-    num_rows_before = df_dwellings.shape[0]
-    print(num_rows_before)
-    df_dwellings.drop_duplicates(subset=["Latitude", "Longitude"], inplace=True)
-    num_rows_after = df_dwellings.shape[0]
-    print(num_rows_after)
-
-    # ============================
-    #  process POIs
-    # ============================
-    df_pois = df_pois[cols_to_keep_poi]
-    df_pois.rename(columns=new_col_names_poi, inplace=True)  # rename cols
-    # check for duplicate coordinates and create HH ID
-    num_rows_before = df_pois.shape[0]
-    print(num_rows_before)
-    df_pois.drop_duplicates(subset=["Latitude", "Longitude"], inplace=True)
-    num_rows_after = df_pois.shape[0]
-    print(num_rows_after)
+    df_dwellings, df_pois = separate_rows(df, keep, release_input=release_input)
 
     # ============================
     #  do quick checks
@@ -166,8 +625,10 @@ def sanitize_and_separate_df_pois(df, struct_type_col, null_feat_cat_replacement
     struct_vals_poi = list(df_pois[struct_type_col].unique())
 
     # check that the DF dataframe only contains residential structures
-    assert len(struct_vals_df) == 1
-    assert struct_vals_df[0] == residential_struct_category
+    # (a chunk of a large file may have no dwellings at all)
+    assert len(struct_vals_df) <= 1
+    if struct_vals_df:
+        assert struct_vals_df[0] == residential_struct_category
 
     if residential_struct_category in struct_vals_poi:
         print("Error with separation of DF and POIs")
@@ -175,12 +636,65 @@ def sanitize_and_separate_df_pois(df, struct_type_col, null_feat_cat_replacement
     # ============================
     #  save files
     # ============================
-    df_dwellings.to_csv(output_file_dwelling, index=False)
-    df_pois.to_csv(output_file_pois, index=False)
+    mode = "a" if append_output else "w"
+    if output_file_dwelling:
+        df_dwellings.to_csv(output_file_dwelling, index=False, mode=mode, header=not append_output)
+    if output_file_pois:
+        df_pois.to_csv(output_file_pois, index=False, mode=mode, header=not append_output)
 
     return df_dwellings, df_pois
 
 
+def partition_by_ward(df, ward_id_col, output_folder, suffix, max_workers=1, already_written=None,
+                      arrow_writers=None, writer=None):
+    """
+    Splits processed DF or POIs data frame into ward level CSV files in a single pass:
+    rows are grouped by ward once and each group is saved in its ward directory, the
+    rows of a ward are only copied out of df when they are queued to be saved
+    :param df: processed DF or POIs data frame as returned by "sanitize_and_separate_df_pois"
+    :param ward_id_col:
+    :param output_folder: Dir (e.g., district level) containing ward directories
+    :param suffix: either df or poi
+    :param max_workers: number of threads writing ward CSV files in parallel
+    :param already_written: set of ward CSV files saved by previous calls (e.g., earlier chunks)
+     which are appended to rather than overwritten, updated in place
+    :param arrow_writers: exchange.ArrowWardWriters to save ward Arrow files through rather than CSV files
+    :param writer: writer.BackgroundWriter to queue ward files to, they may not be saved yet when this
+     returns (e.g., so that the next chunk is processed meanwhile), None saves them before returning
+    :return: list of ward files saved
+    """
+    exchange_format = "csv" if arrow_writers is None else "arrow"
+    jobs = []
+    # positions rather than iterating over the groups, which copies df sorted by ward at once
+    for w, positions in df.groupby(ward_id_col, sort=False, observed=True).indices.items():
+        outputdir = output_folder / w.upper()
+        outputdir.mkdir(exist_ok=True)
+        output_csv = ex.ward_file(outputdir, suffix, exchange_format)
+        append = already_written is not None and output_csv in already_written
+        jobs.append((positions, output_csv, append))
+
+    def save_ward_csv(dfw, output_csv, append):
+        if arrow_writers is not None:
+            arrow_writers.write(output_csv, dfw)
+        else:
+            dfw.to_csv(output_csv, index=False, mode="a" if append else "w", header=not append)
+
+    if writer is None:
+        writer = wr.BackgroundWriter(threads=max_workers, queue_size=wr.QUEUE_SIZE if max_workers > 1 else 0)
+    else:
+        writer = nullcontext(writer)
+    with writer as w:
+        # rows of a ward file are saved in order since writes are queued by file
+        for positions, output_csv, append in jobs:
+            w.submit(output_csv, save_ward_csv, df.take(positions), output_csv, append)
+
+    output_csvs = [job[1] for job in jobs]
+    if already_written is not None:
+        already_written.update(output_csvs)
+
+    return output_csvs
+
+
 def split_csv_into_wards(csv_file, ward_id_col, output_folder, suffix):
     """
     If CSV processed ward CSV ouputed from function "sanitize_and_separate_df_pois"
@@ -196,26 +710,22 @@ def split_csv_into_wards(csv_file, ward_id_col, output_folder, suffix):
     if len(wards) == 1:
         return
 
-    for w in wards:
-        dfw = df[df[ward_id_col] == w]
-        outputdir = output_folder / w.upper()
-        outputdir.mkdir(exist_ok=True)
-        output_csv = outputdir.joinpath("{}_{}.csv".format(w.upper(), suffix))
-        dfw.to_csv(output_csv, index=False)
+    partition_by_ward(df=df, ward_id_col=ward_id_col, output_folder=output_folder, suffix=suffix)
 
 
-def shpfile_from_csv(csv_file, crs, output_shp, project, lon, lat):
+def points_from_csv(csv_file, crs, project, lon, lat, schema=None):
     """
-    Given a CSV file, simply creates a shapefile
+    Given a CSV file, creates a points GeoDataFrame
     :param csv_file: the CSV file to use
     :param crs: Coordinate Reference System (CRS) to use
-    :param output_shp: Full path of output shapefile created
     :param lon, lat: longitude and latitude column in CSV
     :param project: whether to project or not
-    :return: saves SHP typically ward level shapefile
+    :param schema: dict of column name to dtype for the CSV columns
+    :return: GeoDataFrame
     """
-
-    df = pd.read_csv(csv_file)
+    df = pd.read_csv(csv_file, dtype=read_dtypes(schema) if schema else None)
+    if schema:
+        apply_schema(df, schema)
     gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[lon], df[lat]))
 
     # manage projections
@@ -223,149 +733,328 @@ def shpfile_from_csv(csv_file, crs, output_shp, project, lon, lat):
     if project:
         gdf = gdf.to_crs(crs)  # project to UTM Zone 36
 
+    return gdf
+
+
+def points_from_ward_file(ward_file, lon, lat, schema=None):
+    """
+    Creates a WGS84 points GeoDataFrame from a ward DF or POIs file (see exchange.py)
+    :param ward_file: ward CSV or Arrow file
+    :param lon, lat: longitude and latitude columns
+    :param schema: dict of column name to dtype for the ward file columns
+    :return: GeoDataFrame
+    """
+    if str(ward_file).endswith(ex.EXCHANGE_FORMATS["csv"]):
+        return points_from_csv(csv_file=os.path.abspath(ward_file), crs=None, project=False, lon=lon, lat=lat,
+                               schema=schema)
+
+    gdf = ex.read_points(ward_file, lon=lon, lat=lat, crs={'init': 'epsg:4326'}).to_geodataframe()
+    if schema:
+        apply_schema(gdf, schema)
+
+    return gdf
+
+
+def shpfile_from_csv(csv_file, crs, output_shp, project, lon, lat):
+    """
+    Given a CSV file, simply creates a shapefile
+    :param csv_file: the CSV file to use
+    :param crs: Coordinate Reference System (CRS) to use
+    :param output_shp: Full path of output shapefile created
+    :param lon, lat: longitude and latitude column in CSV
+    :param project: whether to project or not
+    :return: saves SHP typically ward level shapefile
+    """
+    gdf = points_from_csv(csv_file=csv_file, crs=crs, project=project, lon=lon, lat=lat)
+
     # save the shp file
     gdf.to_file(output_shp)
 
 
-def create_shp_for_each_ward(dir_with_ward_subdirs, crs, lon_col, lat_col):
+def ward_layer_tasks(ward_dir, exchange_format="csv", columns=None):
+    """
+    Declares the DF and POIs layers created for a ward and the processed file each is created from
+    :param ward_dir: ward directory with processed CSV or Arrow files
+    :param exchange_format: see exchange.EXCHANGE_FORMATS
+    :param columns: dict of df and poi to the columns of their ward files
+    :return: list of dicts with input file, output layer name and columns of the layer
+    """
+    ward_name = ward_dir.parts[-1]
+    columns = columns or {}
+    return [{"input": ex.ward_file(ward_dir, suffix, exchange_format), "layer": "{}_{}".format(ward_name, suffix),
+             "columns": columns.get(suffix)} for suffix in ["df", "poi"]]
+
+
+def empty_points(columns, lon, lat, schema=None):
+    """
+    Creates a WGS84 points GeoDataFrame without rows
+    :param columns: columns, only lon and lat if None
+    :param lon, lat: longitude and latitude columns
+    :param schema: dict of column name to dtype for the columns
+    :return: GeoDataFrame
+    """
+    columns = list(dict.fromkeys(columns or [lon, lat]))
+    df = pd.DataFrame({c: pd.Series(dtype="float64" if c in [lon, lat] else "str") for c in columns})
+    if schema:
+        apply_schema(df, schema)
+
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[lon], df[lat]), crs={'init': 'epsg:4326'})
+
+
+def ward_layer_source(ward_file, lon, lat, schema=None):
+    """
+    Hashes rows of a ward file (see manifest.table_hash) together with how a layer is created from them
+    :return: hex digest or None if the ward file doesn't exist
+    """
+    options = json.dumps([mf.MANIFEST_VERSION, lon, lat, schema], sort_keys=True, default=str)
+
+    return mf.table_hash(ward_file, hashlib.sha1(options.encode()))
+
+
+def create_shp_for_ward(ward_dir, crs, lon_col, lat_col, storage_format="shapefile", force=False, schema=None,
+                        exchange_format="csv", writer=None, columns=None):
+    """
+    Creates DF and POIs layers from the processed files in a ward directory,
+    each layer is saved once and skipped if it was saved from the same rows (see
+    ward_layer_source), ward files are rewritten by every run so their modification
+    time can't tell whether they changed. A ward
+    with DFs but no POIs (or the other way round) has no file for them, an empty
+    layer is saved instead
+    :param ward_dir: ward directory with processed CSV or Arrow files
+    :param crs: crs for shapefiles
+    :param storage_format: format for ward layers, see storage.STORAGE_FORMATS
+    :param force: save layers even if they are up to date
+    :param schema: dict of column name to dtype for the ward file columns
+    :param exchange_format: format of ward files, see exchange.EXCHANGE_FORMATS
+    :param writer: writer.BackgroundWriter to queue layers to under the ward directory, None saves
+     them before returning, the POIs layer is still built while the DF layer is saved
+    :param columns: dict of df and poi to the columns of their ward files, for empty layers
+    :return: dict with lists of "written" and "skipped" layers and number of "rows_written"
+    """
+    done = {"written": [], "skipped": [], "rows_written": 0}
+    with nullcontext(writer) if writer is not None else wr.BackgroundWriter() as w:
+        for task in ward_layer_tasks(ward_dir, exchange_format, columns=columns):
+            layer = task["layer"]
+            source = ward_layer_source(task["input"], lon=lon_col, lat=lat_col, schema=schema)
+            if source is None:
+                gdf = empty_points(task["columns"], lon=lon_col, lat=lat_col, schema=schema)
+            elif not force and st.layer_source(ward_dir, layer, storage_format) == source:
+                done["skipped"].append(layer)
+                continue
+            else:
+                gdf = points_from_ward_file(task["input"], lon=lon_col, lat=lat_col, schema=schema)
+            w.submit(ward_dir, st.write_layer, gdf, ward_dir=ward_dir, layer=layer, storage_format=storage_format,
+                     source=source)
+            done["written"].append(layer)
+            done["rows_written"] += len(gdf)
+
+    return done
+
+
+def create_shp_for_each_ward(dir_with_ward_subdirs, crs, lon_col, lat_col, storage_format="shapefile",
+                             max_workers=1, ward_dirs=None, profile_file_prefix=None, schema=None,
+                             exchange_format="csv", journal=None, journal_stage=None, write_queue_size=0,
+                             columns=None):
     """
     Given a district directory with processed CSV files (DFs and POIs),
     for each ward, this function loops through Go through each ward and create shp files
     :param dir_with_ward_subdirs: Dir (e.g., district level) containing ward directories with processed CSV
     :param crs: crs for shapefiles
-    :return: Saves ward shapefile to each ward folder within dir_with_ward_subdirs
-    """
-    for w in dir_with_ward_subdirs.iterdir():
-        if w.is_dir():
-            for f in w.iterdir():
-                filename = f.parts[-1]
-                if "poi" in filename or "df" in filename:
-                    ward_name = w.parts[-1]
-                    csv_df = os.path.abspath(w.joinpath("{}_df.csv".format(ward_name)))
-                    shp_file_df = os.path.abspath(w.joinpath("{}_df.shp".format(ward_name)))
-
-                    csv_poi = os.path.abspath(w.joinpath("{}_poi.csv".format(ward_name)))
-                    shp_file_poi = os.path.abspath(w.joinpath("{}_poi.shp".format(ward_name)))
-
-                    shpfile_from_csv(csv_file=csv_df, crs=crs, output_shp=shp_file_df, project=False, lon=lon_col,
-                                     lat=lat_col)
-                    shpfile_from_csv(csv_file=csv_poi, crs=crs, output_shp=shp_file_poi, project=False, lon=lon_col,
-                                     lat=lat_col)
-
-
-def append_building_attributes_to_ea(ea_shp, points_shp, agg_id, aggreg_func,
-                                     add_struct_cnt_col, struct_cnt_col_name, crs):
-    """
-    Add columns with population count (from HH listing), building count from HH listing (DF and POI) and
-     from satellite imagery building footprints to each EA for coverage
-    check
-    :param ea_shp: ward level EA shapefile to append attributes to
-    :param points_shp: either DF, POIs or building footprints
-    :param agg_id: EA col to use when aggregating attributes at EA level
-    :param aggreg_func: Aggregate function (e.g., sum, count)
-    :param add_struct_cnt_col: Helper column to help with aggregating
-    :param struct_cnt_col_name: New column name to be added for structure count
-    :param crs: CRS being used in this processing (WGS84)
-    :return: Returns a dataframe with agg_id and corresponding attribute (e.g., StructCntHHs, HHPop)
+    :param storage_format: format for ward layers, see storage.STORAGE_FORMATS
+    :param max_workers: number of processes handling wards in parallel
+    :param ward_dirs: only process these ward directories, defaults to all wards
+    :param profile_file_prefix: save a cProfile dump per ward, see parallel.run_ward_job
+    :param schema: see create_shp_for_ward
+    :param exchange_format: see create_shp_for_ward
+    :param journal: record each ward done in this journal under journal_stage, see parallel.run_ward_job
+    :param write_queue_size: see parallel.run_for_each_ward
+    :param columns: see create_shp_for_ward
+    :return: Saves ward shapefile to each ward folder within dir_with_ward_subdirs and
+     returns a result per ward (see parallel.run_ward_job)
+    """
+    if ward_dirs is None:
+        ward_dirs = pl.ward_subdirs(dir_with_ward_subdirs)
+    kwargs = {"crs": crs, "lon_col": lon_col, "lat_col": lat_col, "storage_format": storage_format,
+              "schema": schema, "exchange_format": exchange_format, "columns": columns}
+    return pl.run_for_each_ward(create_shp_for_ward, ward_dirs, kwargs=kwargs, max_workers=max_workers,
+                                profile_file_prefix=profile_file_prefix, journal=journal, stage=journal_stage,
+                                write_queue_size=write_queue_size)
+
+
+def assign_points_to_ea(ea, points, ea_index=None):
+    """
+    Batched point-in-polygon assignment of points to EAs using the EA spatial index
+    :param ea: EA GeoDataFrame
+    :param points: GeoSeries or array of points in the same CRS as ea
+    :param ea_index: prebuilt ea_index.EAIndex for ea (e.g., loaded from cache), None builds one
+    :return: (points positions, EA positions) arrays, a point within several EAs appears once for each
+    """
+    if ea_index is not None:
+        points = np.asarray(points)
+        return ea_index.query_points(shapely.get_x(points), shapely.get_y(points))
+
+    pts_idx, ea_idx = ea.sindex.query(np.asarray(points), predicate="within")
+
+    return pts_idx, ea_idx
+
+
+def assign_xy_to_ea(ea, x, y, ea_index=None):
+    """
+    Same as assign_points_to_ea for points given as coordinate arrays, point geometries
+    are only built if there is no EA index
+    """
+    if ea_index is not None:
+        return ea_index.query_points(x, y)
+
+    return ea.sindex.query(shapely.points(x, y), predicate="within")
+
+
+def point_coordinates(points, crs_info):
+    """
+    Returns x and y arrays of points in crs_info
+    :param points: GeoDataFrame or exchange.PointTable
+    """
+    if isinstance(points, ex.PointTable):
+        points = points.to_crs(crs_info)
+        return points.x, points.y
+
+    if points.crs != crs_info:
+        points = points.to_crs(crs_info)
+    geometries = np.asarray(points.geometry.values)
+
+    return shapely.get_x(geometries), shapely.get_y(geometries)
+
+
+def point_values(points, col):
+    """
+    Returns a numeric column of points (GeoDataFrame or exchange.PointTable) as a float array
+    """
+    if isinstance(points, ex.PointTable):
+        return points.values(col)
+
+    return points[col].to_numpy(dtype=float, na_value=np.nan)
+
+
+def sum_point_batches_by_ea(ea, batches, value_col, crs_info, ea_index=None, stats=None, layer="bld"):
+    """
+    Out-of-core point to EA aggregation: points are streamed in batches through the EA
+    lookup and summed per EA as they go, so memory is bounded by the number of EAs and
+    the batch size rather than by the number of points
+    :param ea: EA GeoDataFrame in crs_info
+    :param batches: iterable of points GeoDataFrames (see storage.iter_file_batches)
+    :param value_col: points column summed per EA
+    :param crs_info: CRS being used in this processing (WGS84)
+    :param ea_index: optional prebuilt ea_index.EAIndex for ea
+    :param stats: dict to add number of points and points matched to an EA to
+    :param layer: prefix of the counts added to stats
+    :return: array of value sums, one per EA in ea order
+    """
+    totals = np.zeros(len(ea))
+    for batch in batches:
+        if batch.crs != crs_info:
+            batch = batch.to_crs(crs_info)
+        pts_idx, ea_idx = assign_points_to_ea(ea, batch.geometry, ea_index=ea_index)
+        values = batch[value_col].to_numpy(dtype=float, na_value=np.nan)[pts_idx]
+        totals += np.bincount(ea_idx, weights=np.nan_to_num(values), minlength=len(ea))
+        mt.add_counts(stats, **{"{}_points".format(layer): len(batch),
+                                "{}_matched".format(layer): len(np.unique(pts_idx))})
+
+    return totals
+
+
+def aggregate_points_by_ea(ea, hh, poi, bldings, ea_aggregation_id, crs_info, ea_index=None, stats=None):
+    """
+    Fused aggregation of DFs, POIs and building footprints at EA level: the EA
+    spatial index is built once, all points are assigned to EAs in one batched query
+    and the attributes are computed in a single grouped reduction
+    :param ea: ward level EA GeoDataFrame
+    :param hh: ward level DF points with HHPop column, GeoDataFrame or exchange.PointTable
+    :param poi: ward level POIs points, GeoDataFrame or exchange.PointTable
+    :param bldings: ward level building footprints points with n_HH column, or an iterable of
+     batches of them which are streamed (see sum_point_batches_by_ea)
+    :param ea_aggregation_id: EA column for aggregating attributes
+    :param crs_info: CRS being used in this processing (WGS84)
+    :param ea_index: optional prebuilt ea_index.EAIndex for ea
+    :param stats: dict to add number of points and points matched to an EA to (per layer)
+    :return: data frame with ea_aggregation_id and EA_ATTRIBUTE_COLS, one row per EA
+     including EAs without any points
     """
     # =====================================================
     # Check and fix projection to ensure they are the same
     # =====================================================
-    shapes = {"points": points_shp, "ea": ea_shp}
-    for k, s in shapes.items():
-        this_crs = s.crs
-        if this_crs != crs:
-            s = s.to_crs(crs)
-            shapes[k] = s
+    streamed = not isinstance(bldings, gpd.GeoDataFrame)
+    if streamed:
+        bld = gpd.GeoDataFrame({'n_HH': []}, geometry=[], crs=crs_info)
+    else:
+        bld = bldings
+    if ea.crs != crs_info:
+        ea = ea.to_crs(crs_info)
 
-    # update shp files after fixing CRS
-    ea_shp = shapes["ea"]
-    points_shp = shapes["points"]
+    # =====================================================
+    # Stack coordinates of all points with their attributes
+    # =====================================================
+    n_hh, n_poi, n_bld = len(hh), len(poi), len(bld)
+    coordinates = [point_coordinates(p, crs_info) for p in [hh, poi, bld]]
+    x = np.concatenate([c[0] for c in coordinates])
+    y = np.concatenate([c[1] for c in coordinates])
+    attributes = pd.DataFrame({
+        'HHPop': np.concatenate([point_values(hh, 'HHPop'), np.zeros(n_poi + n_bld)]),
+        'StructCntHHs': np.repeat([1, 0, 0], [n_hh, n_poi, n_bld]),
+        'StructCntPOIs': np.repeat([0, 1, 0], [n_hh, n_poi, n_bld]),
+        'StructCntBlds': np.concatenate([np.zeros(n_hh + n_poi), point_values(bld, 'n_HH')]),
+    })
 
     # =====================================================
-    # Add count column for lack of concise solution
+    # Assign points to EAs and aggregate
     # =====================================================
-    if add_struct_cnt_col:
-        points_shp[struct_cnt_col_name] = 1
+    pts_idx, ea_idx = assign_xy_to_ea(ea, x, y, ea_index=ea_index)
+    if stats is not None:
+        matched = np.bincount(np.searchsorted([n_hh, n_hh + n_poi], np.unique(pts_idx), side="right"),
+                              minlength=3)
+        mt.add_counts(stats, eas=len(ea), hh_points=n_hh, hh_matched=int(matched[0]), poi_points=n_poi,
+                      poi_matched=int(matched[1]))
+        if not streamed:
+            mt.add_counts(stats, bld_points=n_bld, bld_matched=int(matched[2]))
+    ea_pts = attributes.iloc[pts_idx]
+    ea_pts.index = ea[ea_aggregation_id].to_numpy()[ea_idx]
 
-    ea_pts = gpd.sjoin(ea_shp, points_shp, how="inner", op="contains")
-    df_grp = ea_pts.groupby([agg_id]).agg(aggreg_func)
-    df = df_grp.reset_index()
+    ea_ids = pd.unique(ea[ea_aggregation_id])
+    df = ea_pts.groupby(level=0).sum().reindex(ea_ids, fill_value=0)
+    if streamed:
+        totals = sum_point_batches_by_ea(ea, bldings, 'n_HH', crs_info, ea_index=ea_index, stats=stats)
+        totals = pd.Series(totals, index=ea[ea_aggregation_id].to_numpy())
+        df['StructCntBlds'] += totals.groupby(level=0).sum().reindex(ea_ids, fill_value=0)
+    df['TotalStruct'] = df.StructCntHHs + df.StructCntPOIs
+    df.index.name = ea_aggregation_id
 
-    return df
+    return df.reset_index()
 
 
-def append_all_building_attributes_to_ea(ea_shp_file, building_footprints,
-                                         hhlisting_dwellings, hhlisting_pois,
-                                         ea_aggregation_id, output_ea_shpfile, crs_info):
+def summarize_building_attributes_by_ea(ea, bldings, hh, poi, ea_aggregation_id, crs_info, ea_index=None,
+                                        stats=None):
     """
-    A helper function which runs the
-    "append_building_attributes_to_ea" function for ward level DF, POI and building footprints shp file
-    :param ea_shp_file: ward level EA
-    :param building_footprints: ward level building footprints point shp file
-    :param hhlisting_dwellings: ward level DF shp file
-    :param hhlisting_pois: ward level POIs shp file
+    Appends HH listing based population and structure counts and building footprints
+    count to each EA, EAs without any points get zero counts
+    :param ea: ward level EA GeoDataFrame
+    :param bldings: ward level building footprints points, only n_HH column is needed,
+     or an iterable of batches of them (see aggregate_points_by_ea)
+    :param hh: ward level DF points, only HHPop column is needed
+    :param poi: ward level POIs points, no attribute column is needed
     :param ea_aggregation_id: EA column for aggregating attributes
-    :param output_ea_shpfile: Full path for updated shapefile after merging all attributes
-    :return: Saves EA shp file to output_ea_shpfile
+    :param crs_info: CRS being used in this processing (WGS84)
+    :param ea_index: optional prebuilt ea_index.EAIndex for ea
+    :param stats: see aggregate_points_by_ea
+    :return: EA GeoDataFrame with attributes appended
     """
-    # =============================
-    # Read shapefiles
-    # =============================
-    hh = gpd.read_file(hhlisting_dwellings)
-    poi = gpd.read_file(hhlisting_pois)
-    bldings = gpd.read_file(building_footprints)
-    ea = gpd.read_file(ea_shp_file)
+    ea_attributes = aggregate_points_by_ea(ea=ea, hh=hh, poi=poi, bldings=bldings,
+                                           ea_aggregation_id=ea_aggregation_id, crs_info=crs_info,
+                                           ea_index=ea_index, stats=stats)
 
     # =========================================
-    # Append Dwelling Frames Structure Count
+    # Merge to EA shapefile
     # =========================================
-    df_func = {'HHPop': 'sum', 'StructCntHHs': 'sum'}  # aggregate total populationn and struct count
-    ea_hh = append_building_attributes_to_ea(ea_shp=ea, points_shp=hh, agg_id=ea_aggregation_id,
-                                             aggreg_func=df_func,
-                                             add_struct_cnt_col=True, crs=crs_info,
-                                             struct_cnt_col_name='StructCntHHs')
+    # drop n_HH and attributes if they are already in the EA.shp
+    ea = ea.drop(columns=[c for c in ['n_HH'] + EA_ATTRIBUTE_COLS if c in ea.columns])
+    ea_out = ea.merge(right=ea_attributes, on=ea_aggregation_id, how='left')
 
-    # =========================================
-    # Append POIs Structure Count
-    # =========================================
-    poi_func = {'StructCntPOIs': 'sum'}  # aggregate total populationn and struct count
-    ea_pois = append_building_attributes_to_ea(ea_shp=ea, points_shp=poi, agg_id=ea_aggregation_id,
-                                               aggreg_func=poi_func,crs=crs_info,
-                                               add_struct_cnt_col=True,
-                                               struct_cnt_col_name='StructCntPOIs')
-
-    # =========================================
-    # Append building footprints Structure Count
-    # =========================================
-    # delete n_HH is its already in the EA.shp
-    ea_cols = list(ea.columns)
-    if 'n_HH' in ea_cols:
-        ea.drop(labels=['n_HH'], axis=1, inplace=True)
-    bld_func = {'n_HH': 'sum'}  # aggregate total populationn and struct count
-
-    ea_bld = append_building_attributes_to_ea(ea_shp=ea, points_shp=bldings,
-                                              agg_id=ea_aggregation_id,crs=crs_info,
-                                              aggreg_func=bld_func, struct_cnt_col_name=None,
-                                              add_struct_cnt_col=False)
-    ea_bld.rename(columns={'n_HH': 'StructCntBlds'}, inplace=True)
-
-    # =========================================
-    # Merge the three
-    # =========================================
-    ea_merged = ea_hh.merge(right=ea_pois, how="inner", on=ea_aggregation_id).merge(right=ea_bld, how='inner',
-                                                                                    on=ea_aggregation_id)
-    # this column gives total number of structures  based on HHListing
-    # for both POIs and residential
-    ea_merged['TotalStruct'] = ea_merged.StructCntHHs + ea_merged.StructCntPOIs
-
-    # =========================================
-    # Merge to EA shapefile and save to disk
-    # =========================================
-    ea_out = ea.merge(right=ea_merged, on=ea_aggregation_id, how='left')
-    ea_out.to_file(output_ea_shpfile)
-
-    # =========================================
-    # Do some checks
-    # =========================================
-    # TODO
+    return ea_out
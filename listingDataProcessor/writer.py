@@ -0,0 +1,107 @@
+"""
+Background writer so that saving files overlaps with computation: writes are queued to
+threads and run while the caller carries on with the next chunk or ward. Queues are
+bounded, submitting a write waits while the queue of its thread is full so that data
+frames waiting to be saved don't pile up in memory. A write which fails doesn't raise
+where it was submitted, failures are collected by key and surfaced once writing is done
+"""
+import queue
+import threading
+import traceback
+import zlib
+
+# writes waiting per thread before submitting another one waits
+QUEUE_SIZE = 4
+
+
+class WriteError(Exception):
+    """
+    Raised when a background writer is closed if any write failed
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("{} writes failed: {}".format(
+            len(errors), "; ".join("{}: {}".format(k, e["error"]) for k, e in errors.items())))
+
+
+class BackgroundWriter:
+    """
+    Runs writes in background threads, writes with the same key (e.g., a file or a ward)
+    run on the same thread one after another in the order they were submitted and are
+    skipped once one of them failed. Used as a context manager it waits for writes when
+    leaving the block and raises WriteError if any failed
+    """
+
+    def __init__(self, threads=1, queue_size=QUEUE_SIZE):
+        """
+        :param threads: number of threads writing
+        :param queue_size: writes waiting per thread, 0 runs each write when it is submitted
+        """
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.queues = []
+        self.threads = []
+        self.closed = False
+        if queue_size:
+            for _ in range(max(threads, 1)):
+                q = queue.Queue(maxsize=queue_size)
+                thread = threading.Thread(target=self.serve, args=(q,), daemon=True)
+                thread.start()
+                self.queues.append(q)
+                self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        if exc_type is None:
+            self.raise_errors()
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Queues func(*args, **kwargs), waits if the queue is full
+        :param key: writes with the same key run in order, errors are recorded by key
+        """
+        if self.closed:
+            raise RuntimeError("Background writer is closed")
+        if not self.queues:
+            self.run(key, func, args, kwargs)
+            return
+        # crc32 rather than hash() so that a key always goes to the same thread
+        self.queues[zlib.crc32(str(key).encode()) % len(self.queues)].put((key, func, args, kwargs))
+
+    def serve(self, q):
+        while True:
+            task = q.get()
+            if task is None:
+                return
+            self.run(*task)
+
+    def run(self, key, func, args, kwargs):
+        if key in self.errors:
+            return
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            with self.lock:
+                self.errors[key] = {"error": repr(e), "traceback": traceback.format_exc()}
+
+    def close(self):
+        """
+        Waits for queued writes to finish and stops the threads
+        :return: dict of key to error and traceback of writes which failed
+        """
+        if not self.closed:
+            self.closed = True
+            for q in self.queues:
+                q.put(None)
+            for thread in self.threads:
+                thread.join()
+
+        return self.errors
+
+    def raise_errors(self):
+        if self.errors:
+            raise WriteError(self.errors)